@@ -0,0 +1,412 @@
+"""
+Load generator for the file server.
+
+Starts a server on an ephemeral port, in this process or as a subprocess, drives concurrent Client sessions through a
+weighted mix of commands on synthetic files, then reports the throughput, the p50/p95/p99 latency of every command and
+the peak RSS. The results can be written as JSON and compared against a saved baseline:
+
+    python bench.py --sessions 16 --operations 500 --sizes 4K,1M,64M --json run.json
+    python bench.py --sessions 16 --operations 500 --sizes 4K,1M,64M --baseline run.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client.client import Client, ServerError
+from server.server import ENGINES
+
+HOST = "127.0.0.1"
+COMMANDS = ("cd", "mkdir", "ul", "dl", "info", "mv", "rm")
+DEFAULT_MIX = "cd=1,mkdir=1,ul=3,dl=3,info=2,mv=1,rm=1"
+SIZE_UNITS = {"": 1, "B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    """
+    :param text: a size such as '512', '4K', '1M' or '2G'
+    :return: the size in bytes
+    """
+    match = re.fullmatch(r"(\d+)([BKMG]?)", text.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_mix(text):
+    """
+    :param text: comma separated command=weight pairs, e.g. 'ul=3,dl=3,info=1'
+    :return: dict of the weights
+    """
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command in mix: {command}")
+        mix[command] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+def create_files(directory, sizes, content):
+    """
+    Writes one synthetic file per size in the given directory, in chunks so GB sized files do not need GBs of memory.
+    :param directory: where to create the files, the uploads are done from there
+    :param sizes: sizes in bytes
+    :param content: 'random' (incompressible), 'text' or 'zero'
+    :return: {size: file name}
+    """
+    files = {}
+    line = b"the quick brown fox jumps over the lazy dog 0123456789\n"
+    for size in sizes:
+        name = f"bench-{size}.bin" if content == "random" else f"bench-{size}.txt"
+        with open(os.path.join(directory, name), "wb") as file:
+            remaining = size
+            while remaining:
+                count = min(remaining, 1 << 20)
+                if content == "random":
+                    file.write(os.urandom(count))
+                elif content == "text":
+                    file.write((line * (count // len(line) + 1))[:count])
+                else:
+                    file.write(bytes(count))
+                remaining -= count
+        files[size] = name
+    return files
+
+
+class DiscardWriter:
+    """File-like sink for the downloads: the content is counted and dropped."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+class BenchSession:
+    """
+    One client session replaying the command mix in its own remote directory. The state needed to only issue valid
+    commands (the directories created, the files uploaded, whether the session is in its sub directory) is tracked
+    locally; a command whose precondition does not hold is replaced by the command creating it.
+    """
+
+    def __init__(self, index, port, files, mix, listing_mode, rng):
+        self.index = index
+        self.port = port
+        self.files = files
+        self.commands = list(mix)
+        self.weights = [mix[command] for command in self.commands]
+        self.rng = rng
+        self.client = Client(HOST, port, verbose=False)
+        self.client.listing_mode = listing_mode
+        self.client.verify = False
+        self.directories = []
+        self.uploaded = set()  # paths relative to the session directory
+        self.in_sub_directory = False
+        self.counter = 0
+        self.samples = {command: [] for command in COMMANDS}
+        self.errors = {command: 0 for command in COMMANDS}
+        self.transferred = {command: 0 for command in COMMANDS}
+
+    def relative(self, path):
+        """Path of a session directory entry as seen from the current remote working directory."""
+        if not self.in_sub_directory:
+            return path
+        return path[len("sub/"):] if path.startswith("sub/") else "../" + path
+
+    def connect(self):
+        self.client.initialize(HOST, self.port)
+        home = f"session-{self.index}"
+        self.client.request(f"mkdir {home}")
+        self.client.request(f"cd {home}")
+        self.client.request("mkdir sub")
+
+    def run(self, operations, deadline):
+        done = 0
+        while done < operations and time.perf_counter() < deadline:
+            self.step(self.rng.choices(self.commands, self.weights)[0])
+            done += 1
+        self.client.send_command(self.client.client_socket, "exit")
+        self.client.client_socket.close()
+
+    def step(self, command):
+        if command in ("dl", "info") and not self.uploaded:
+            command = "ul"
+        if command in ("mv", "rm") and not self.directories:
+            command = "mkdir"
+        started = time.perf_counter()
+        try:
+            transferred = getattr(self, "do_" + command)()
+        except ServerError:
+            self.errors[command] += 1
+            return
+        self.samples[command].append(time.perf_counter() - started)
+        self.transferred[command] += transferred
+
+    def do_cd(self):
+        self.client.request("cd .." if self.in_sub_directory else "cd sub")
+        self.in_sub_directory = not self.in_sub_directory
+        return 0
+
+    def do_mkdir(self):
+        self.counter += 1
+        name = f"d{self.counter}"
+        self.client.request(f"mkdir {self.relative(name)}")
+        self.directories.append(name)
+        return 0
+
+    def do_ul(self):
+        size = self.rng.choice(sorted(self.files))
+        if not self.client.issue_ul(f"ul {self.files[size]}", self.client.client_socket, self.client.eof_token):
+            raise ServerError(self.client.last_error)
+        self.uploaded.add(("sub/" if self.in_sub_directory else "") + self.files[size])
+        return size
+
+    def do_dl(self):
+        sink = DiscardWriter()
+        self.client.request(f"dl {self.relative(self.rng.choice(sorted(self.uploaded)))}", data_file=sink)
+        return sink.size
+
+    def do_info(self):
+        self.client.request(f"info {self.relative(self.rng.choice(sorted(self.uploaded)))}")
+        return 0
+
+    def do_mv(self):
+        name = self.directories.pop(self.rng.randrange(len(self.directories)))
+        self.counter += 1
+        new_name = f"d{self.counter}"
+        self.client.request(f"mv {self.relative(name)} {self.relative(new_name)}")
+        self.directories.append(new_name)
+        return 0
+
+    def do_rm(self):
+        name = self.directories.pop(self.rng.randrange(len(self.directories)))
+        self.client.request(f"rm {self.relative(name)}")
+        return 0
+
+
+def peak_rss_kib(pid=None):
+    """
+    Peak resident set size.
+    :param pid: process to look at, this process when None (Linux only for other processes)
+    :return: KiB, or None when unknown
+    """
+    if pid is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+@contextlib.contextmanager
+def start_server(mode, engine, root, deduplicate):
+    """
+    Runs a server on an ephemeral port for the duration of the benchmark.
+    :param mode: 'inprocess' (a daemon thread, its output is discarded) or 'subprocess'
+    :param engine: key of server.ENGINES
+    :param root: directory served
+    :param deduplicate: keep a content store of the uploads
+    :return: (port, function returning the peak RSS of the server in KiB)
+    """
+    if mode == "inprocess":
+        server = ENGINES[engine](HOST, 0, root, deduplicate=deduplicate)
+        threading.Thread(target=server.start, daemon=True).start()
+        if not server.ready.wait(10):
+            raise RuntimeError("the server did not start")
+        yield server.port, peak_rss_kib
+        return
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server", "server.py"),
+               "--engine", engine, "--root", root, "--port", "0"]
+    if not deduplicate:
+        command.append("--no-dedup")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        port = None
+        for line in process.stdout:
+            match = re.search(r"Server listening on [^:]+:(\d+)", line)
+            if match:
+                port = int(match.group(1))
+                break
+        if port is None:
+            raise RuntimeError("the server did not start")
+        # Keep draining the server output so it never blocks on a full pipe
+        threading.Thread(target=shutil.copyfileobj, args=(process.stdout, io.StringIO()), daemon=True).start()
+        yield port, lambda: peak_rss_kib(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_benchmark(args):
+    """
+    Runs one benchmark.
+    :param args: the parsed command line
+    :return: the results, as a JSON serializable dict
+    """
+    workspace = tempfile.mkdtemp(prefix="bench-")
+    root = os.path.join(workspace, "root")
+    local = os.path.join(workspace, "local")
+    os.makedirs(root)
+    os.makedirs(local)
+    previous_directory = os.getcwd()
+    try:
+        files = create_files(local, args.sizes, args.content)
+        # Client.issue_ul() uploads files by their local name, relative to the working directory
+        os.chdir(local)
+        with start_server(args.server, args.engine, root, args.dedup) as (port, server_rss):
+            rng = random.Random(args.seed)
+            sessions = [BenchSession(index, port, files, args.mix, args.listing, random.Random(rng.random()))
+                        for index in range(args.sessions)]
+            operations = args.operations if args.operations else float("inf")
+            # In-process, the server prints every command: keep that out of the measurements and the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                for session in sessions:
+                    session.connect()
+                started = time.perf_counter()
+                deadline = started + (args.duration or float("inf"))
+                threads = [threading.Thread(target=session.run, args=(operations, deadline)) for session in sessions]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            elapsed = time.perf_counter() - started
+            rss = {"client": peak_rss_kib(), "server": server_rss()}
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    commands = {}
+    total = 0
+    for command in COMMANDS:
+        samples = sorted(sample for session in sessions for sample in session.samples[command])
+        errors = sum(session.errors[command] for session in sessions)
+        if not samples and not errors:
+            continue
+        transferred = sum(session.transferred[command] for session in sessions)
+        total += len(samples)
+        commands[command] = {
+            "count": len(samples),
+            "errors": errors,
+            "ops_per_s": len(samples) / elapsed,
+            "mean_ms": 1000 * sum(samples) / len(samples) if samples else None,
+            "p50_ms": 1000 * percentile(samples, 0.50) if samples else None,
+            "p95_ms": 1000 * percentile(samples, 0.95) if samples else None,
+            "p99_ms": 1000 * percentile(samples, 0.99) if samples else None,
+            "bytes": transferred,
+            "mb_per_s": transferred / elapsed / (1 << 20),
+        }
+    return {
+        "config": {"sessions": args.sessions, "operations": args.operations, "duration": args.duration,
+                   "mix": args.mix, "sizes": args.sizes, "content": args.content, "engine": args.engine,
+                   "server": args.server, "listing": args.listing, "dedup": args.dedup, "seed": args.seed},
+        "elapsed_s": elapsed,
+        "operations": total,
+        "ops_per_s": total / elapsed,
+        "commands": commands,
+        "peak_rss_kib": rss,
+    }
+
+
+def print_report(results):
+    print(f"{results['operations']} operations in {results['elapsed_s']:.2f}s: {results['ops_per_s']:.1f} ops/s, "
+          f"peak RSS client {results['peak_rss_kib']['client']} KiB, server {results['peak_rss_kib']['server']} KiB")
+    print(f"{'command':<8}{'count':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'MB/s':>10}")
+    for command, figures in results["commands"].items():
+        print(f"{command:<8}{figures['count']:>8}{figures['errors']:>8}{figures['ops_per_s']:>10.1f}"
+              f"{figures['p50_ms'] or 0:>10.2f}{figures['p95_ms'] or 0:>10.2f}{figures['p99_ms'] or 0:>10.2f}"
+              f"{figures['mb_per_s']:>10.1f}")
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the changes against a baseline run and lists the regressions: a throughput lower, or a p95 latency higher,
+    by more than the threshold.
+    :param results: output of run_benchmark()
+    :param baseline: output of run_benchmark() loaded from a previous run
+    :param threshold: tolerated relative change, e.g. 0.1
+    :return: list of the regressions, as text
+    """
+    regressions = []
+    print(f"{'command':<8}{'ops/s':>20}{'p95 ms':>24}")
+    for command, figures in results["commands"].items():
+        base = baseline["commands"].get(command)
+        if base is None:
+            continue
+        throughput = figures["ops_per_s"] / base["ops_per_s"] - 1 if base["ops_per_s"] else 0.0
+        latency = figures["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] and figures["p95_ms"] else 0.0
+        print(f"{command:<8}{base['ops_per_s']:>9.1f} {throughput:>+9.1%}{base['p95_ms'] or 0:>13.2f} "
+              f"{latency:>+9.1%}")
+        if throughput < -threshold:
+            regressions.append(f"{command}: throughput {throughput:+.1%}")
+        if latency > threshold:
+            regressions.append(f"{command}: p95 latency {latency:+.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File server load generator")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent client sessions")
+    parser.add_argument("--operations", type=int, default=200, help="commands per session, 0 for no limit")
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds, 0 for no limit")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"command weights, default {DEFAULT_MIX}")
+    parser.add_argument("--sizes", type=lambda text: [parse_size(size) for size in text.split(",")],
+                        default=[parse_size(size) for size in ("1K", "64K", "1M")],
+                        help="comma separated sizes of the uploaded files, e.g. 100,4K,1M,1G")
+    parser.add_argument("--content", choices=("random", "text", "zero"), default="random",
+                        help="content of the synthetic files")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threaded")
+    parser.add_argument("--server", choices=("inprocess", "subprocess"), default="subprocess",
+                        help="where the server runs")
+    parser.add_argument("--listing", choices=("full", "delta", "none"), default="full",
+                        help="working directory info requested after each command")
+    parser.add_argument("--dedup", action="store_true", help="let the server deduplicate the uploads")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the command sequences")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against the results of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="tolerated change against the baseline")
+    args = parser.parse_args()
+    if not args.operations and not args.duration:
+        parser.error("--operations 0 needs a --duration")
+
+    results = run_benchmark(args)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print("Regressions: ", "; ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
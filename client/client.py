@@ -1,143 +1,971 @@
+import asyncio
+import glob
+import hashlib
+import itertools
+import json
+import os
+import posixpath
+import queue
+import random
+import secrets
 import socket
-from threading import Thread
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+# The code shared with the server is in transfer.py, at the root of the repository, also when this file is run as
+# a script
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.insert(1, REPOSITORY_ROOT)
+from transfer import (ARCHIVE_SENDFILE_MIN, BULK_COMMANDS, COMPRESSION_CODECS, ENTROPY_SAMPLE_SIZE,
+                      SIGNATURE_HEADER, TRANSFER_CHUNK_SIZE, DeltaWriter, HashingWriter, OffsetWriter, StreamCodec,
+                      TarExtractor, TransferStats, choose_compression, compute_delta, file_signatures, hash_file,
+                      iter_archive, preallocate, walk_tree)
+
+# Wire protocol, see server.py
+PROTOCOL_MAGIC = b"CS"
+PROTOCOL_VERSIONS = (1,)
+HEADER = struct.Struct("!2sBBHIQ")
+
+OP_HELLO = 1
+OP_COMMAND = 2
+OP_RESULT = 3
+OP_LISTING = 4
+OP_DATA = 5
+OP_END = 6
+OP_REPLY = 7
+OP_ERROR = 8
+OP_BUSY = 9
+
+# OP_COMMAND flags selecting the working directory info sent back after a command
+LISTING_MODES = {"full": 0, "none": 1, "delta": 2}
+FLAG_VERIFY = 0x4  # dl answers with the size, mtime and sha256 of the file before the content
+FLAG_ARCHIVE = 0x8  # dl / ul of a directory, its tree is streamed as a tar archive
+FLAG_COMPRESSED = 0x1  # OP_DATA flag: the payload is a chunk compressed with the session's codec
+
+RECEIVE_BUFFER_SIZE = 1 << 18
+PIPELINE_WINDOW = 256  # commands of a batch in flight at once
+STRIPES = 4  # sessions used by parallel transfers
+STRIPE_CHUNK_SIZE = 8 << 20  # bytes per range of a parallel transfer
+BUSY_RETRIES = 5  # attempts after the server refused a connection or a transfer with OP_BUSY
+ASYNC_FRAME_QUEUE = 16  # frames of a request an AsyncConnection buffers before it stops reading the connection
+
+
+class ServerError(Exception):
+    """Raised by Client.request() when the server answers a command with an error."""
+
+
+class ServerBusy(ServerError):
+    """Raised when the server refuses a connection or a command for lack of capacity (OP_BUSY)."""
+
+    def __init__(self, reason, retry_after):
+        ServerError.__init__(self, reason)
+        self.retry_after = retry_after
 
 
 class Client:
-    def __init__(self, host, port):
+    def __init__(self, host, port, verbose=True):
         Thread.__init__(self)
         self.host = host
         self.port = port
+        self.verbose = verbose  # print the working directory info and errors sent by the server
+        self.last_error = None
         self.client_socket = None
         self.eof_token = None
+        self.protocol_version = PROTOCOL_VERSIONS[-1]
+        self.request_ids = itertools.count(1)
+        self.header_buffer = bytearray(HEADER.size)
+        self.transfer_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.listing_mode = "full"
+        self.verify = True  # check the sha256 of downloads
+        self.stripes = STRIPES
+        self.stripe_chunk_size = STRIPE_CHUNK_SIZE
+        self.compression_codecs = COMPRESSION_CODECS  # codecs offered in the handshake, empty to disable compression
+        self.compression = None  # codec negotiated with the server
+        self.last_transfer = None  # TransferStats of the last file transfer
+        self.busy = None  # OP_BUSY answer to the last request, {"reason", "retry_after"}
+        self.busy_retries = BUSY_RETRIES
+
+    def send_frame(self, active_socket, opcode, payload=b"", request_id=0, flags=0):
+        """
+        Same implementation as in send_frame() in server.py
+        Sends a single message: the fixed size header followed by the payload.
+        :param active_socket: a socket object that is connected to the server
+        :param opcode: one of the OP_* constants
+        :param payload: bytes-like message body
+        :param request_id: id of the request this frame belongs to
+        :param flags: opcode specific flags
+        """
+        header = HEADER.pack(PROTOCOL_MAGIC, self.protocol_version, opcode, flags, request_id, len(payload))
+        if len(payload) <= 65536:
+            active_socket.sendall(header + payload)
+        else:
+            # Avoid copying large payloads just to prepend the header
+            active_socket.sendall(header)
+            active_socket.sendall(payload)
+
+    def send_file(self, active_socket, file, request_id=0, offset=0, count=None, codec=None):
+        """
+        Same implementation as in send_file() in server.py
+        Streams an open file as OP_DATA frames of at most TRANSFER_CHUNK_SIZE bytes followed by an OP_END frame. The
+        payloads are handed to the kernel with sendfile(), so the content is never copied into user space. With a
+        codec, the file is instead read chunk by chunk and every chunk is sent compressed, flagged FLAG_COMPRESSED.
+        :param active_socket: a socket object that is connected to the server
+        :param file: a file object opened in binary mode
+        :param request_id: id of the request this transfer belongs to
+        :param offset: position in the file to start from
+        :param count: number of bytes to send, defaults to the rest of the file
+        :param codec: name of the compression codec to use, None to send the file as is
+        :return: the TransferStats of the transfer
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        stats = TransferStats(codec)
+        if codec is not None:
+            compressor = StreamCodec(codec)
+            view = memoryview(self.transfer_buffer)
+        sent = 0
+        while sent < count:
+            if codec is None:
+                length = min(TRANSFER_CHUNK_SIZE, count - sent)
+                active_socket.sendall(HEADER.pack(PROTOCOL_MAGIC, self.protocol_version, OP_DATA, 0, request_id,
+                                                  length))
+                active_socket.sendfile(file, offset + sent, length)
+                stats.add(length, length)
+            else:
+                length = os.preadv(file.fileno(), [view[:min(len(view), count - sent)]], offset + sent)
+                if length == 0:
+                    raise ValueError("file shrank during the transfer")
+                started = time.thread_time()
+                payload = compressor.compress(view[:length])
+                stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, FLAG_COMPRESSED)
+                stats.add(length, len(payload))
+            sent += length
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        self.last_transfer = stats
+        return stats
+
+    def send_archive(self, active_socket, root, request_id=0, codec=None, buffer=None, hidden_paths=frozenset()):
+        """
+        Same implementation as in send_archive() in server.py
+        Streams a directory tree as a tar archive generated on the fly (see iter_archive()) in OP_DATA frames followed
+        by an OP_END frame. The headers and the small files are gathered in frames of up to TRANSFER_CHUNK_SIZE bytes,
+        compressed with the codec if any. Files of ARCHIVE_SENDFILE_MIN bytes or more get frames of their own: handed
+        to the kernel with sendfile() as send_file() does, or compressed chunk by chunk when choose_compression()
+        finds them worth it.
+        :param active_socket: a socket object that is connected to the peer
+        :param root: absolute path of the directory
+        :param request_id: id of the request this transfer belongs to
+        :param codec: name of the compression codec negotiated with the peer, None to send the archive as is
+        :param buffer: optional reusable bytearray the files are sampled into by choose_compression()
+        :param hidden_paths: absolute paths left out of the archive
+        :return: the TransferStats of the transfer
+        """
+        stats = TransferStats(codec)
+        compressor = StreamCodec(codec) if codec is not None else None
+        chunk_size = TRANSFER_CHUNK_SIZE if codec is None else RECEIVE_BUFFER_SIZE
+        buffer = buffer if buffer is not None else bytearray(RECEIVE_BUFFER_SIZE)
+        pending = bytearray()
+
+        def send(data, compress):
+            if compress:
+                started = time.thread_time()
+                payload = compressor.compress(data)
+                stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, FLAG_COMPRESSED)
+                stats.add(len(data), len(payload))
+            else:
+                self.send_frame(active_socket, OP_DATA, data, request_id)
+                stats.add(len(data), len(data))
+
+        for item in iter_archive(root, hidden_paths):
+            if not isinstance(item, tuple):
+                pending += item
+            else:
+                name, file, size = item
+                sent = 0
+                if size >= ARCHIVE_SENDFILE_MIN:
+                    if pending:
+                        send(pending, compressor is not None)
+                        pending.clear()
+                    file_codec = choose_compression(name, file.fileno(), codec, buffer)
+                    while sent < size:
+                        length = min(chunk_size if file_codec else TRANSFER_CHUNK_SIZE, size - sent)
+                        if file_codec is None:
+                            active_socket.sendall(HEADER.pack(PROTOCOL_MAGIC, self.protocol_version, OP_DATA, 0,
+                                                              request_id, length))
+                            active_socket.sendfile(file, sent, length)
+                            stats.add(length, length)
+                        else:
+                            data = os.pread(file.fileno(), length, sent)
+                            if len(data) != length:
+                                raise ValueError("file shrank during the transfer")
+                            send(data, True)
+                        sent += length
+                    continue
+                while sent < size:
+                    data = os.pread(file.fileno(), min(chunk_size - len(pending), size - sent), sent)
+                    if not data:
+                        raise ValueError("file shrank during the transfer")
+                    pending += data
+                    sent += len(data)
+                    if len(pending) >= chunk_size:
+                        send(pending, compressor is not None)
+                        pending.clear()
+            if len(pending) >= chunk_size:
+                send(pending, compressor is not None)
+                pending.clear()
+        if pending:
+            send(pending, compressor is not None)
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        return stats
 
-    def receive_message_ending_with_token(self, active_socket, buffer_size, eof_token):
+    def send_delta(self, active_socket, fd, signatures=None, request_id=0, codec=None):
         """
-        Same implementation as in receive_message_ending_with_token() in server.py
-        A helper method to receives a bytearray message of arbitrary size sent on the socket.
-        This method returns the message WITHOUT the eof_token at the end of the last packet.
+        Same implementation as in send_delta() in server.py
+        Streams the delta records rebuilding a file from the base file described by `signatures`, packed in OP_DATA
+        frames of at most TRANSFER_CHUNK_SIZE bytes (compressed with the codec, if any) followed by an OP_END frame.
         :param active_socket: a socket object that is connected to the server
-        :param buffer_size: the buffer size of each recv() call
-        :param eof_token: a token that denotes the end of the message.
-        :return: a bytearray message with the eof_token stripped from the end.
+        :param fd: descriptor of the file to send
+        :param signatures: signatures of the peer's version of the file, None if it has none
+        :param request_id: id of the request this transfer belongs to
+        :param codec: name of the compression codec to use, None to send the records as is
+        :return: the TransferStats of the transfer, raw_bytes being the size of the file
+        """
+        stats = TransferStats(codec)
+        compressor = StreamCodec(codec) if codec is not None else None
+        frame = bytearray()
+        for record in itertools.chain(compute_delta(fd, signatures), [None]):
+            if record is not None and len(frame) + len(record) <= TRANSFER_CHUNK_SIZE:
+                frame += record
+                continue
+            if frame:
+                payload, flags = frame, 0
+                if compressor is not None:
+                    started = time.thread_time()
+                    payload, flags = compressor.compress(frame), FLAG_COMPRESSED
+                    stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, flags)
+                stats.add(0, len(payload))
+            frame = bytearray(record or b"")
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        stats.raw_bytes = os.fstat(fd).st_size
+        return stats
+
+    def receive_exactly(self, active_socket, buffer):
+        """
+        Same implementation as in receive_exactly() in server.py
+        Fills the whole of the given preallocated buffer from the socket.
+        :param active_socket: a socket object that is connected to the server
+        :param buffer: a writable bytes-like object (bytearray / memoryview) of the expected size
+        :return: the filled buffer
+        """
+        view = memoryview(buffer)
+        received = 0
+        while received < len(view):
+            count = active_socket.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionError("connection closed by server")
+            received += count
+        return buffer
+
+    def receive_header(self, active_socket):
+        """
+        Same implementation as in receive_header() in server.py
+        Receives and validates a frame header, leaving the payload on the socket.
+        :param active_socket: a socket object that is connected to the server
+        :return: (opcode, flags, request_id, length)
+        """
+        self.receive_exactly(active_socket, self.header_buffer)
+        magic, version, opcode, flags, request_id, length = HEADER.unpack(self.header_buffer)
+        if magic != PROTOCOL_MAGIC:
+            raise ConnectionError("invalid frame header")
+        return opcode, flags, request_id, length
+
+    def receive_frame(self, active_socket):
+        """
+        Same implementation as in receive_frame() in server.py
+        Receives a single message. Exactly HEADER.size bytes are read for the header, then exactly `length` bytes are read
+        into a buffer preallocated for the payload.
+        :param active_socket: a socket object that is connected to the server
+        :return: (opcode, flags, request_id, payload) where payload is a bytearray
+        """
+        opcode, flags, request_id, length = self.receive_header(active_socket)
+        payload = bytearray(length)
+        if length:
+            self.receive_exactly(active_socket, payload)
+        return opcode, flags, request_id, payload
+
+    def receive_payload_into(self, active_socket, length, file):
+        """
+        Receives `length` payload bytes through the reusable transfer buffer and writes them to the given file. The
+        whole payload is received even if writing it fails, the error is raised afterwards.
+        :param active_socket: a socket object that is connected to the server
+        :param length: number of payload bytes to receive
+        :param file: a file object opened for binary writing, or None to discard the content
+        :return: the number of bytes received
+        """
+        view = memoryview(self.transfer_buffer)
+        remaining = length
+        error = None
+        while remaining:
+            chunk = view[:min(remaining, len(view))]
+            self.receive_exactly(active_socket, chunk)
+            remaining -= len(chunk)
+            if file is not None and error is None:
+                try:
+                    file.write(chunk)
+                except ConnectionError:
+                    raise
+                except (OSError, ValueError) as exception:
+                    error = exception
+        if error is not None:
+            raise error
+        return length
+
+    def send_command(self, active_socket, command_and_arg, flags=0):
+        """
+        Sends a command to the server tagged with a new request id. The listing_mode attribute ("full", "delta" or
+        "none") selects the working directory info the server sends back.
+        :param active_socket: a socket object that is connected to the server
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param flags: extra OP_COMMAND flags, e.g. FLAG_VERIFY
+        :return: the request id
+        """
+        request_id = next(self.request_ids)
+        flags |= LISTING_MODES[self.listing_mode]
+        self.send_frame(active_socket, OP_COMMAND, command_and_arg.encode(), request_id, flags)
+        return request_id
+
+    def receive_reply(self, active_socket, request_id, data_file=None):
+        """
+        Receives the frames answering a request until its final OP_REPLY / OP_ERROR frame. The working directory info is
+        displayed.
+        :param active_socket: a socket object that is connected to the server
+        :param request_id: id of the request being answered
+        :param data_file: file object the OP_DATA payloads of the request are streamed to, decompressed when flagged
+            FLAG_COMPRESSED. The TransferStats of the content are left in last_transfer. It can also be a function
+            returning the file object, called on the first OP_DATA frame with the OP_RESULT payloads received so far.
+            When the content cannot be written, the rest of the answer is still received (so the connection stays in
+            sync) and the error is raised at its end.
+        :return: list of the OP_RESULT payloads, or None if the server reported an error
+        """
+        results = []
+        stats = None
+        decompressor = None
+        error = None
+        while True:
+            opcode, flags, frame_request_id, length = self.receive_header(active_socket)
+            if frame_request_id != request_id:
+                raise ConnectionError(f"unexpected response for request {frame_request_id}")
+            if opcode == OP_DATA:
+                if stats is None:
+                    stats = self.last_transfer = TransferStats(None)
+                    if callable(data_file):
+                        data_file = data_file(results)
+                if error is not None:
+                    self.receive_payload_into(active_socket, length, None)
+                    continue
+                try:
+                    if flags & FLAG_COMPRESSED:
+                        if self.compression is None:
+                            raise ConnectionError("compressed data without a negotiated codec")
+                        if decompressor is None:
+                            decompressor = StreamCodec(self.compression)
+                            stats.codec = self.compression
+                        payload = self.receive_exactly(active_socket, bytearray(length))
+                        started = time.thread_time()
+                        data = decompressor.decompress(payload)
+                        stats.cpu_time += time.thread_time() - started
+                        if data_file is not None:
+                            data_file.write(data)
+                        stats.add(len(data), length)
+                    else:
+                        self.receive_payload_into(active_socket, length, data_file)
+                        stats.add(length, length)
+                except ConnectionError:
+                    raise
+                except (OSError, ValueError) as exception:
+                    error = exception
+                continue
+            payload = bytearray(length)
+            if length:
+                self.receive_exactly(active_socket, payload)
+            if error is not None and opcode in (OP_ERROR, OP_BUSY, OP_REPLY):
+                raise error
+            if opcode == OP_LISTING:
+                if self.verbose:
+                    print(payload.decode())
+            elif opcode == OP_RESULT:
+                results.append(payload)
+            elif opcode in (OP_ERROR, OP_BUSY):
+                self.refused(opcode, payload)
+                return None
+            elif opcode == OP_REPLY:
+                return results
+
+    def refused(self, opcode, payload):
+        """
+        Records the final OP_ERROR / OP_BUSY frame of a failed request in last_error, and busy for OP_BUSY.
+        :param opcode: OP_ERROR or OP_BUSY
+        :param payload: payload of the frame
+        """
+        if opcode == OP_BUSY:
+            self.busy = json.loads(payload)
+            self.last_error = f"server busy: {self.busy['reason']}"
+        else:
+            self.last_error = payload.decode()
+        if self.verbose:
+            print("Error: ", self.last_error)
+
+    def retry_when_busy(self, issue, command_and_arg, client_socket, eof_token):
+        """
+        Runs an issue_* method, and runs it again as long as the server refuses the command with OP_BUSY, at most
+        busy_retries times, waiting the delay the server asks for in between.
+        :param issue: the issue_* method, e.g. self.issue_dl
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: what the issue_* method returns
+        """
+        for attempt in range(self.busy_retries + 1):
+            self.busy = None
+            result = issue(command_and_arg, client_socket, eof_token)
+            if self.busy is None or attempt == self.busy_retries:
+                return result
+            self.wait_busy(self.busy["retry_after"])
+
+    def wait_busy(self, retry_after):
+        # Up to 50% jitter, so the clients refused together do not come back together
+        delay = retry_after * random.uniform(1, 1.5)
+        if self.verbose:
+            print(f"Retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    def request(self, command_and_arg, client_socket=None, data_file=None):
         """
-        data = active_socket.recv(buffer_size)
-        print(data.decode())
-        return data.decode('utf-8').strip().split(eof_token.decode())[0].encode("utf-8").strip()
+        Sends a command and waits for its reply.
+        :param command_and_arg: full command (with argument)
+        :param client_socket: the active client socket object, defaults to the one created by initialize()
+        :param data_file: file object the OP_DATA payloads of the reply are streamed to
+        :return: list of the OP_RESULT payloads
+        :raises ServerError: when the server reports an error
+        """
+        client_socket = client_socket or self.client_socket
+        request_id = self.send_command(client_socket, command_and_arg)
+        self.busy = None
+        results = self.receive_reply(client_socket, request_id, data_file)
+        if results is None:
+            if self.busy is not None:
+                raise ServerBusy(self.last_error, self.busy["retry_after"])
+            raise ServerError(self.last_error)
+        return results
 
     def initialize(self, host, port):
         """
         1) Creates a socket object and connects to the server.
-        2) receives the random token (10 bytes) used to indicate end of messages.
+        2) negotiates the protocol version, receiving the random session token (10 bytes).
         3) Displays the current working directory returned from the server (output of get_working_directory_info() at the server).
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param host: the ip address of the server
         :param port: the port number of the server
         :return: the created socket object
         :return: the eof_token
         """
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM):
-            client_socket.connect((host, port))
-            print('Connected to server at IP:', host, 'and Port:', port)
-            eof_token = client_socket.recv(1024)
-            print('Handshake Done. EOF is:', eof_token.decode())
+        for attempt in range(self.busy_retries + 1):
+            client_socket = socket.create_connection((host, port))
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.verbose:
+                print('Connected to server at IP:', host, 'and Port:', port)
+            hello = {"versions": list(PROTOCOL_VERSIONS), "compression": list(self.compression_codecs)}
+            self.send_frame(client_socket, OP_HELLO, json.dumps(hello).encode())
+            opcode, flags, request_id, payload = self.receive_frame(client_socket)
+            if opcode != OP_BUSY:
+                break
+            # The server is at capacity: it refused the session, connect again later
+            client_socket.close()
+            busy = json.loads(payload)
+            if attempt == self.busy_retries:
+                raise ServerBusy(busy["reason"], busy["retry_after"])
+            if self.verbose:
+                print("Server busy:", busy["reason"])
+            self.wait_busy(busy["retry_after"])
+        if opcode != OP_HELLO:
+            client_socket.close()
+            raise ConnectionError(f"handshake failed: {payload.decode()}")
+        hello = json.loads(payload)
+        self.protocol_version = hello["version"]
+        self.compression = hello.get("compression")
+        eof_token = hello["token"].encode()
+        if self.verbose:
+            print('Handshake Done. Protocol version:', self.protocol_version, 'Session token:', eof_token.decode(),
+                  'Compression:', self.compression or 'none')
 
-            server_messages = self.receive_message_ending_with_token(client_socket, 1024, eof_token)
-            return client_socket, eof_token
+        self.receive_reply(client_socket, 0)
+        self.client_socket, self.eof_token = client_socket, eof_token
+        return client_socket, eof_token
 
     def issue_cd(self, command_and_arg, client_socket, eof_token):
         """
         Sends the full cd command entered by the user to the server. The server changes its cwd accordingly and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        curr_working_dir = self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, command_and_arg)
+        self.receive_reply(client_socket, request_id)
 
     def issue_mkdir(self, command_and_arg, client_socket, eof_token):
         """
         Sends the full mkdir command entered by the user to the server. The server creates the sub directory and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, command_and_arg)
+        self.receive_reply(client_socket, request_id)
 
     def issue_rm(self, command_and_arg, client_socket, eof_token):
         """
         Sends the full rm command entered by the user to the server. The server removes the file or directory and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, command_and_arg)
+        self.receive_reply(client_socket, request_id)
 
     def issue_ul(self, command_and_arg, client_socket, eof_token):
         """
-        Sends the full ul command entered by the user to the server. Then, it reads the file to be uploaded as binary
-        and sends it to the server. The server creates the file on its end and sends back the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Sends the full ul command entered by the user to the server, with the size and sha256 of the file. The server
+        answers with the offset to start from, non zero when it holds the beginning of the file from an interrupted
+        upload, or tells that it already stores this content, in which case nothing is sent. Then, it reads the rest of the file to be uploaded as binary and sends it to the server. The server
+        verifies and creates the file on its end and sends back the new cwd info.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
+        :return: True if the file was uploaded
+        """
+        file_name = command_and_arg.split(" ")[1].strip()
+        if os.path.isdir(file_name):
+            return self.issue_ul_directory(file_name, client_socket)
+        with open(file_name, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            digest = hash_file(file.fileno(), hashlib.sha256(), self.transfer_buffer).hexdigest()
+            request_id = self.send_command(client_socket, f"ul {file_name} {size} {digest}")
+            opcode, flags, frame_request_id, payload = self.receive_frame(client_socket)
+            if opcode in (OP_ERROR, OP_BUSY):
+                self.refused(opcode, payload)
+                return False
+            upload = json.loads(payload)
+            offset = upload["offset"]
+            if upload.get("stored"):
+                if self.verbose:
+                    print("The server already holds this content, nothing to send")
+            else:
+                if offset and self.verbose:
+                    print(f"Resuming upload at byte {offset}")
+                codec = choose_compression(file_name, file.fileno(), self.compression, self.transfer_buffer, offset)
+                stats = self.send_file(client_socket, file, request_id, offset, size - offset, codec)
+                if self.verbose:
+                    print("Transfer: ", stats)
+        return self.receive_reply(client_socket, request_id) is not None
+
+    def issue_ul_directory(self, directory_name, client_socket):
+        """
+        ul of a directory: the tree is sent as a tar archive generated as it is sent (see send_archive()), which the
+        server extracts as it arrives into the directory of the same name, created if needed.
+        :param directory_name: path of the local directory
+        :param client_socket: the active client socket object.
+        :return: True if the directory was uploaded
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        file = open(command_and_arg.split(" ")[1].strip(), 'rb')
-        client_socket.sendall(file.read())
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, f"ul {directory_name}", FLAG_ARCHIVE)
+        stats = self.send_archive(client_socket, os.path.abspath(directory_name), request_id, self.compression,
+                                  self.transfer_buffer)
+        if self.verbose:
+            print("Transfer: ", stats)
+        return self.receive_reply(client_socket, request_id) is not None
 
     def issue_dl(self, command_and_arg, client_socket, eof_token):
         """
         Sends the full dl command entered by the user to the server. Then, it receives the content of the file via the
-        socket and re-creates the file in the local directory of the client. Finally, it receives the latest cwd info from
+        socket chunk by chunk and re-creates the file in the local directory of the client. Finally, it receives the latest cwd info from
         the server.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        The content is written to a partial file first. When a partial file is left by an interrupted download, only
+        the rest of the file is requested. With verify set, the server sends the sha256 of the file and the download is
+        checked before the partial file replaces the local file. 'dl <file> <offset> <length>' downloads a range of
+        the file instead, to the local file of the same name. A directory arrives as a tar archive, extracted as it is
+        received into the local directory of the same name (see TarExtractor).
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
-        :return:
+        :return: True if the file was downloaded
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        file_data = client_socket.recv(409600)
-        with open(command_and_arg.split(" ")[1].strip(), "wb") as file:
-            file.write(file_data)
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        arguments = command_and_arg.split()
+        file_name = arguments[1]
+        # A range ('dl <file> <offset> <length>') is neither resumed nor verified, the server's sha256 is that of the
+        # whole file, and it is received into a partial file of its own so it does not clobber a resumable one
+        ranged = any(argument != "0" for argument in arguments[2:4])
+        verify = self.verify and not ranged
+        partial_name = file_name + (".range.part" if ranged else ".part")
+        offset = os.path.getsize(partial_name) if not ranged and os.path.isfile(partial_name) else 0
+        hasher = hashlib.sha256()
+        # The content is streamed to a partial file, so a failed download does not clobber an existing local file
+        with open(partial_name, "wb" if ranged else "a+b") as file:
+            if offset and verify:
+                hash_file(file.fileno(), hasher, self.transfer_buffer, offset)
+            command = f"dl {file_name} {offset} 0" if offset else command_and_arg
+            request_id = self.send_command(client_socket, command, FLAG_ARCHIVE | (FLAG_VERIFY if verify else 0))
+            self.last_transfer = self.busy = None
+            extractors = []
+
+            def target(results):
+                # The server announces the archive of a directory in its first OP_RESULT frame
+                if results and json.loads(results[0]).get("archive") == "tar":
+                    extractors.append(TarExtractor(file_name))
+                    return extractors[0]
+                return HashingWriter(file, hasher)
+            results = self.receive_reply(client_socket, request_id, target)
+        if extractors:
+            os.remove(partial_name)
+            try:
+                extractors[0].close()
+            except (OSError, ValueError) as error:
+                if results is not None:
+                    print("Error: ", error)
+                return False
+        if results is None:
+            # What was received is kept for a resume, unless the server refused the file itself (e.g. it is gone, or
+            # shorter than the partial file) before sending any content
+            refused = self.busy is None and (self.last_transfer is None or not os.path.getsize(partial_name))
+            if (refused or ranged) and not extractors:
+                os.remove(partial_name)
+            return False
+        if self.last_transfer is not None and self.verbose:
+            print("Transfer: ", self.last_transfer)
+        if extractors:
+            return True
+        if verify and hasher.hexdigest() != json.loads(results[0])["sha256"]:
+            os.remove(partial_name)
+            if offset:
+                print("Checksum mismatch, downloading again from the start")
+                return self.issue_dl(f"dl {file_name}", client_socket, eof_token)
+            print("Error: checksum mismatch, the download was discarded")
+            return False
+        os.replace(partial_name, file_name)
+        return True
 
     def issue_info(self, command_and_arg, client_socket, eof_token):
         """
-        Sends the full info command entered by the user to the server. The server reads the file and sends back the size of
-        the file.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Sends the full info command entered by the user to the server. The server reads the file and sends back the size,
+        modification time and sha256 of the file.
+        Use the helper method: receive_reply() to receive the message from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: dict with the size, mtime and sha256 of the file
+        """
+        request_id = self.send_command(client_socket, command_and_arg)
+        results = self.receive_reply(client_socket, request_id)
+        if results:
+            file_info = json.loads(results[0])
+            if self.verbose:
+                print("Size in bytes: ", file_info["size"])
+                print("Modified: ", time.ctime(file_info["mtime"]))
+                print("SHA-256: ", file_info["sha256"])
+            return file_info
+
+    def issue_stats(self, command_and_arg, client_socket, eof_token):
+        """
+        Sends a stats command (server metrics), a profile command (start / stop / dump the sampling profiler of a
+        server started with --profiling) or a limit command (report or change the bandwidth limits: 'limit <bytes per
+        second>' for this session, 'limit global|session <bytes per second>' on a server started with
+        --limit-control) and displays the JSON document the server answers with.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
-        :return: the size of file in string
+        :return: the decoded document, None on error
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        file_size = client_socket.recv(1024)
-        print("Size in bytes: ", file_size.decode())
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, command_and_arg)
+        results = self.receive_reply(client_socket, request_id)
+        if results:
+            document = json.loads(results[0])
+            if self.verbose:
+                print(json.dumps(document, indent=2))
+            return document
+        return None
+
+    def issue_find(self, command_and_arg, client_socket, eof_token):
+        """
+        Sends the full find command entered by the user to the server: 'find <pattern>'. The server searches its index
+        of the tree below the working directory for the names matching the pattern and sends back the matches.
+        Use the helper method: receive_reply() to receive the message from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: list of [relative path, size] pairs, size None for directories
+        """
+        request_id = self.send_command(client_socket, command_and_arg)
+        results = self.receive_reply(client_socket, request_id)
+        if results:
+            found = json.loads(results[0])
+            if self.verbose:
+                for path, size in found["matches"]:
+                    print(path if size is None else f"{path} ({size} bytes)")
+                if found["truncated"]:
+                    print(f"... only the first {len(found['matches'])} matches are listed")
+            return found["matches"]
+
+    def issue_du(self, command_and_arg, client_socket, eof_token):
+        """
+        Sends the full du command entered by the user to the server: 'du [<directory>]'. The server answers from its
+        index of the tree with the disk usage of the directory and of each of its sub directories.
+        Use the helper method: receive_reply() to receive the message from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: dict with the bytes, files, directories and per sub directory usage ("entries")
+        """
+        request_id = self.send_command(client_socket, command_and_arg)
+        results = self.receive_reply(client_socket, request_id)
+        if results:
+            usage = json.loads(results[0])
+            if self.verbose:
+                for name, size in usage["entries"]:
+                    print(f"{size:>15}  {name}/")
+                print(f"{usage['bytes']:>15}  total: {usage['files']} files, {usage['directories']} directories")
+            return usage
 
     def issue_mv(self, command_and_arg, client_socket, eof_token):
         """
         Sends the full mv command entered by the user to the server. The server moves the file to the specified directory and sends back
         the updated. This command can also act as renaming the file in the same directory.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the message from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
         :param eof_token: a token to indicate the end of the message.
         """
-        client_socket.sendall(command_and_arg.encode() + eof_token)
-        self.receive_message_ending_with_token(client_socket, 1024, eof_token)
+        request_id = self.send_command(client_socket, command_and_arg)
+        self.receive_reply(client_socket, request_id)
+
+    def issue_cp(self, command_and_arg, client_socket, eof_token):
+        """
+        Sends the full cp command entered by the user to the server: 'cp [-r] <source> <destination>'. The server copies
+        the file, or the directory tree with -r, on its end, then sends back what was copied and the updated cwd info.
+        Use the helper method: receive_reply() to receive the message from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: dict with the number of files and directories copied and their bytes
+        """
+        request_id = self.send_command(client_socket, command_and_arg)
+        results = self.receive_reply(client_socket, request_id)
+        if results:
+            summary = json.loads(results[0])
+            if self.verbose:
+                print(f"Copied {summary['files']} files, {summary['directories']} directories, "
+                      f"{summary['bytes']} bytes")
+            return summary
+
+    def issue_parallel(self, command_and_arg, client_socket, eof_token):
+        """
+        Handles the pul / pdl commands: uploads or downloads the files matching the given patterns over a pool of
+        stripes sessions, see ParallelTransfer. The pool works in the same remote directory as this session.
+        :param command_and_arg: 'pul <patterns...>' or 'pdl <patterns...>'
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: list of the transferred file names
+        """
+        command, *patterns = command_and_arg.split()
+        remote_directory = self.request("pwd", client_socket)[0].decode()
+        with ParallelTransfer(self.host, self.port, self.stripes, self.stripe_chunk_size, remote_directory) as pool:
+            try:
+                if command == "pul":
+                    names = pool.upload(patterns)
+                else:
+                    names = pool.download(patterns)
+            except (OSError, ServerError) as error:
+                print("Error: ", error)
+                return []
+        print("Transferred: ", " ".join(names))
+        self.request("cd .", client_socket)
+        return names
+
+    def issue_sync(self, command_and_arg, client_socket, eof_token):
+        """
+        Handles the sync commands: 'sync up <local directory> [<remote directory>]' makes the remote tree a copy of the
+        local one, 'sync down <remote directory> [<local directory>]' the other way around. Only the files whose size or
+        mtime differ are transferred, and only their changed blocks. Nothing is deleted.
+        :param command_and_arg: full command (with arguments) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: the summary returned by sync_up() / sync_down(), None on error
+        """
+        arguments = command_and_arg.split(" ")[1:]
+        if len(arguments) not in (2, 3) or arguments[0] not in ("up", "down"):
+            print("Usage: sync up <local directory> [<remote directory>] | sync down <remote directory> "
+                  "[<local directory>]")
+            return None
+        source = arguments[1]
+        destination = arguments[2] if len(arguments) == 3 else os.path.basename(os.path.normpath(source))
+        try:
+            if arguments[0] == "up":
+                summary = self.sync_up(source, destination, client_socket)
+            else:
+                summary = self.sync_down(source, destination, client_socket)
+        except (OSError, ServerError) as error:
+            print("Error: ", error)
+            return None
+        print(f"Synced {summary['transferred']} of {summary['files']} files: {summary['bytes']} bytes of content sent "
+              f"as {summary['wire_bytes']} bytes")
+        return summary
+
+    def sync_up(self, local_directory, remote_directory, client_socket=None):
+        """
+        Sends the changes of a local directory tree to the server: the server lists its tree, then every new or
+        modified file is sent as a delta against the server's version (patch command), created directories first.
+        :param local_directory: the local tree
+        :param remote_directory: the remote tree, relative to the working directory, created if missing
+        :param client_socket: the active client socket object, defaults to the one created by initialize()
+        :return: dict with the number of files, of transferred files, their size and the bytes sent for them
+        """
+        client_socket = client_socket or self.client_socket
+        local_files, local_directories = walk_tree(os.path.abspath(local_directory))
+        listing_mode, self.listing_mode = self.listing_mode, "none"
+        try:
+            try:
+                remote = json.loads(self.request(f"tree {remote_directory}", client_socket)[0])
+            except ServerError:
+                self.request(f"mkdir {remote_directory}", client_socket)
+                remote = {"files": {}, "directories": []}
+            summary = {"files": len(local_files), "transferred": 0, "bytes": 0, "wire_bytes": 0}
+            for directory in sorted(set(local_directories).difference(remote["directories"])):
+                self.request(f"mkdir {posixpath.join(remote_directory, directory)}", client_socket)
+            for name, metadata in sorted(local_files.items()):
+                if remote["files"].get(name) == metadata:
+                    continue
+                remote_name = posixpath.join(remote_directory, name)
+                signatures = None
+                if name in remote["files"]:
+                    signatures = bytes(self.request(f"sigs {remote_name}", client_socket)[0])
+                block_size = SIGNATURE_HEADER.unpack_from(signatures)[0] if signatures else 0
+                with open(os.path.join(local_directory, name), "rb") as file:
+                    size = os.fstat(file.fileno()).st_size
+                    mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+                    request_id = self.send_command(client_socket, f"patch {size} {mtime_ns} {block_size} {remote_name}")
+                    codec = choose_compression(name, file.fileno(), self.compression, self.transfer_buffer)
+                    stats = self.send_delta(client_socket, file.fileno(), signatures, request_id, codec)
+                if self.receive_reply(client_socket, request_id) is None:
+                    raise ServerError(self.last_error)
+                summary["transferred"] += 1
+                summary["bytes"] += stats.raw_bytes
+                summary["wire_bytes"] += stats.wire_bytes
+            return summary
+        finally:
+            self.listing_mode = listing_mode
+
+    def sync_down(self, remote_directory, local_directory, client_socket=None):
+        """
+        Brings a local directory tree up to date with the server: the server lists its tree, then for every new or
+        modified file the client sends the signatures of its version (delta command) and rebuilds the file from the
+        delta the server answers with, in a partial file renamed over the local file once complete.
+        :param remote_directory: the remote tree, relative to the working directory
+        :param local_directory: the local tree, created if missing
+        :param client_socket: the active client socket object, defaults to the one created by initialize()
+        :return: dict with the number of files, of transferred files, their size and the bytes received for them
+        """
+        client_socket = client_socket or self.client_socket
+        listing_mode, self.listing_mode = self.listing_mode, "none"
+        try:
+            remote = json.loads(self.request(f"tree {remote_directory}", client_socket)[0])
+            os.makedirs(local_directory, exist_ok=True)
+            local_files, local_directories = walk_tree(os.path.abspath(local_directory))
+            summary = {"files": len(remote["files"]), "transferred": 0, "bytes": 0, "wire_bytes": 0}
+            for directory in remote["directories"]:
+                os.makedirs(os.path.join(local_directory, directory), exist_ok=True)
+            for name, metadata in sorted(remote["files"].items()):
+                if local_files.get(name) == metadata:
+                    continue
+                path = os.path.join(local_directory, name)
+                base_fd = os.open(path, os.O_RDONLY) if name in local_files else None
+                try:
+                    signatures = file_signatures(base_fd) if base_fd is not None else b""
+                    block_size = SIGNATURE_HEADER.unpack_from(signatures)[0] if signatures else 0
+                    request_id = self.send_command(client_socket, f"delta {posixpath.join(remote_directory, name)}")
+                    for offset in range(0, len(signatures), TRANSFER_CHUNK_SIZE):
+                        self.send_frame(client_socket, OP_DATA, signatures[offset:offset + TRANSFER_CHUNK_SIZE],
+                                        request_id)
+                    self.send_frame(client_socket, OP_END, b"", request_id)
+                    with open(path + ".part", "wb") as file:
+                        writer = DeltaWriter(base_fd, block_size, file)
+                        self.last_transfer = None
+                        try:
+                            results = self.receive_reply(client_socket, request_id, writer)
+                            if results is not None:
+                                writer.close()
+                        except ValueError as error:
+                            # an invalid delta, received in full: the connection is still in sync
+                            results, self.last_error = None, f"delta of {name}: {error}"
+                finally:
+                    if base_fd is not None:
+                        os.close(base_fd)
+                if results is None:
+                    os.remove(path + ".part")
+                    raise ServerError(self.last_error)
+                info = json.loads(results[0])
+                if writer.size != info["size"]:
+                    os.remove(path + ".part")
+                    raise ServerError(f"delta of {name} rebuilt {writer.size} of {info['size']} bytes")
+                os.utime(path + ".part", ns=(info["mtime_ns"], info["mtime_ns"]))
+                os.replace(path + ".part", path)
+                summary["transferred"] += 1
+                summary["bytes"] += writer.size
+                summary["wire_bytes"] += self.last_transfer.wire_bytes if self.last_transfer else 0
+            return summary
+        finally:
+            self.listing_mode = listing_mode
+
+    def issue_batch(self, commands, client_socket, eof_token):
+        """
+        Sends several commands at once instead of waiting for each reply, see batch().
+        :param commands: list of full commands (with arguments) provided by the user.
+        :param client_socket: the active client socket object.
+        :param eof_token: a token to indicate the end of the message.
+        :return: list of the results of each command, None for the commands that failed
+        """
+        with self.batch(client_socket) as batch:
+            for command_and_arg in commands:
+                batch.issue(command_and_arg)
+        return batch.results
+
+    @contextmanager
+    def batch(self, client_socket=None):
+        """
+        Queues the commands issued in the with block and flushes them when the block exits: the queued commands are
+        written together and the server executes them back-to-back, answering each in order under its request id.
+        Usage:
+            with client.batch() as batch:
+                batch.issue("mkdir a")
+                batch.issue("mv b a")
+            print(batch.results)
+        :param client_socket: the active client socket object, defaults to the one created by initialize()
+        """
+        batch = Batch(self, client_socket or self.client_socket)
+        yield batch
+        batch.flush()
 
     def start(self):
         """
@@ -148,23 +976,53 @@ class Client:
         self.client_socket, eof_token = self.initialize(self.host, self.port)
         while True:
             command = input("Enter the command: ")
+            name = command.split(" ")[0]
             if command == "exit":
-                self.client_socket.sendall(command.encode() + eof_token)
+                self.send_command(self.client_socket, command)
                 break
-            elif "cd" in command:
+            elif name == "listing":
+                # local setting: full / delta / none working directory info after each command
+                mode = command.split(" ")[-1]
+                if mode in LISTING_MODES:
+                    self.listing_mode = mode
+                else:
+                    print("Usage: listing full|delta|none")
+            elif ";" in command:
+                # several commands on one line are pipelined
+                self.issue_batch([part.strip() for part in command.split(";") if part.strip()], self.client_socket,
+                                 eof_token)
+            elif name == "sync":
+                self.issue_sync(command, self.client_socket, eof_token)
+            elif name in ("pul", "pdl"):
+                self.issue_parallel(command, self.client_socket, eof_token)
+            elif name == "stripes":
+                # local setting: stripes <sessions> [<chunk size in bytes>]
+                settings = command.split(" ")[1:]
+                self.stripes = int(settings[0])
+                if len(settings) > 1:
+                    self.stripe_chunk_size = int(settings[1])
+            elif name == "cd":
                 self.issue_cd(command, self.client_socket, eof_token)
-            elif "mkdir" in command:
+            elif name == "mkdir":
                 self.issue_mkdir(command, self.client_socket, eof_token)
-            elif "rm" in command:
+            elif name == "rm":
                 self.issue_rm(command, self.client_socket, eof_token)
-            elif "mv" in command:
+            elif name == "mv":
                 self.issue_mv(command, self.client_socket, eof_token)
-            elif "info" in command:
+            elif name == "cp":
+                self.issue_cp(command, self.client_socket, eof_token)
+            elif name == "find":
+                self.issue_find(command, self.client_socket, eof_token)
+            elif name == "du":
+                self.issue_du(command, self.client_socket, eof_token)
+            elif name == "info":
                 self.issue_info(command, self.client_socket, eof_token)
-            elif "dl" in command:
-                self.issue_dl(command, self.client_socket, eof_token)
-            elif "ul" in command:
-                self.issue_ul(command, self.client_socket, eof_token)
+            elif name in ("stats", "profile", "limit"):
+                self.issue_stats(command, self.client_socket, eof_token)
+            elif name == "dl":
+                self.retry_when_busy(self.issue_dl, command, self.client_socket, eof_token)
+            elif name == "ul":
+                self.retry_when_busy(self.issue_ul, command, self.client_socket, eof_token)
         self.client_socket.close()
 
     # get user input
@@ -174,6 +1032,697 @@ class Client:
     print('Exiting the application.')
 
 
+class Batch:
+    """
+    Commands queued by Client.batch(). Only the last command of the batch gets the client's working directory info, the
+    others are answered without one. Transfers (BULK_COMMANDS) cannot be batched.
+    """
+
+    def __init__(self, client: Client, client_socket):
+        self.client = client
+        self.client_socket = client_socket
+        self.frames = []
+        self.request_ids = []
+        self.results = None
+
+    def issue(self, command_and_arg):
+        """
+        Queues a command.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :return: the request id of the command
+        """
+        if command_and_arg.split(" ")[0] in BULK_COMMANDS:
+            raise ValueError("transfers cannot be batched")
+        request_id = next(self.client.request_ids)
+        payload = command_and_arg.encode()
+        self.frames.append([request_id, payload])
+        self.request_ids.append(request_id)
+        return request_id
+
+    def encode(self, index):
+        request_id, payload = self.frames[index]
+        mode = self.client.listing_mode if index == len(self.frames) - 1 else "none"
+        return HEADER.pack(PROTOCOL_MAGIC, self.client.protocol_version, OP_COMMAND, LISTING_MODES[mode], request_id,
+                           len(payload)) + payload
+
+    def flush(self):
+        """
+        Sends the queued commands and collects the replies. At most PIPELINE_WINDOW commands are in flight, the next
+        ones are written, again in a single write, whenever half of the window has been answered.
+        :return: list of the results of each command, None for the commands that failed
+        """
+        self.results = []
+        sent = 0
+        while len(self.results) < len(self.frames):
+            in_flight = sent - len(self.results)
+            if sent < len(self.frames) and in_flight <= PIPELINE_WINDOW // 2:
+                end = min(len(self.frames), sent + PIPELINE_WINDOW - in_flight)
+                self.client_socket.sendall(b"".join(self.encode(index) for index in range(sent, end)))
+                sent = end
+            request_id = self.request_ids[len(self.results)]
+            self.results.append(self.client.receive_reply(self.client_socket, request_id))
+        self.frames, self.request_ids = [], []
+        return self.results
+
+
+class StripedFile:
+    """Progress of one file of a parallel transfer: the last stripe to finish completes the file."""
+
+    def __init__(self, name, size, ranges):
+        self.name = name
+        self.size = size
+        self.remaining = ranges
+        self.upload_id = secrets.token_hex(8)
+        self.fd = None
+        self.lock = Lock()
+
+    def stripe_done(self):
+        """
+        :return: True for the stripe completing the file
+        """
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+
+class ParallelTransfer:
+    """
+    Parallel transfers over a pool of sessions, each opened with Client.initialize(). Files are split in byte ranges of
+    chunk_size bytes that are moved concurrently, one session per range at a time; the ranges of all the files of a
+    multi-file transfer are spread over the same pool. Uploaded ranges are written by the server at their offset in a
+    preallocated partial file that is renamed once complete; downloads are assembled the same way locally.
+    Usage:
+        with ParallelTransfer(host, port, stripes=8) as pool:
+            pool.upload(["*.jpg"])
+    """
+
+    def __init__(self, host, port, stripes=STRIPES, chunk_size=STRIPE_CHUNK_SIZE, remote_directory=None):
+        self.host = host
+        self.port = port
+        self.stripes = stripes
+        self.chunk_size = chunk_size
+        self.remote_directory = remote_directory
+        self.sessions = queue.Queue()
+        self.executor = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """Opens the sessions of the pool."""
+        for _ in range(self.stripes):
+            client = Client(self.host, self.port, verbose=False)
+            client.listing_mode = "none"
+            client_socket, eof_token = client.initialize(self.host, self.port)
+            if self.remote_directory:
+                client.request(f"cd {self.remote_directory}")
+            self.sessions.put(client)
+        self.executor = ThreadPoolExecutor(self.stripes)
+
+    def close(self):
+        """Closes the sessions of the pool."""
+        if self.executor is not None:
+            self.executor.shutdown()
+        while not self.sessions.empty():
+            client = self.sessions.get()
+            client.send_command(client.client_socket, "exit")
+            client.client_socket.close()
+
+    def ranges(self, size):
+        return [(offset, min(self.chunk_size, size - offset)) for offset in range(0, size, self.chunk_size)] or [(0, 0)]
+
+    def run_stripe(self, function, *args):
+        client = self.sessions.get()
+        try:
+            return function(client, *args)
+        finally:
+            self.sessions.put(client)
+
+    def wait(self, futures):
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    def upload(self, patterns):
+        """
+        Uploads the local files matching the given glob patterns to the remote directory.
+        :param patterns: list of local paths or glob patterns
+        :return: list of the uploaded file names
+        """
+        paths = [path for pattern in patterns for path in sorted(glob.glob(pattern)) if os.path.isfile(path)]
+        futures = []
+        for path in paths:
+            size = os.path.getsize(path)
+            ranges = self.ranges(size)
+            striped_file = StripedFile(os.path.basename(path), size, len(ranges))
+            for offset, length in ranges:
+                futures.append(self.executor.submit(self.run_stripe, self.upload_range, path, striped_file, offset,
+                                                    length))
+        self.wait(futures)
+        return [os.path.basename(path) for path in paths]
+
+    def upload_range(self, client, path, striped_file, offset, length):
+        with open(path, "rb") as file:
+            request_id = client.send_command(
+                client.client_socket,
+                f"ulrange {striped_file.upload_id} {offset} {length} {striped_file.size} {striped_file.name}")
+            client.send_file(client.client_socket, file, request_id, offset, length)
+        if client.receive_reply(client.client_socket, request_id) is None:
+            raise ServerError(client.last_error)
+        if striped_file.stripe_done():
+            client.request(f"ulcommit {striped_file.upload_id} {striped_file.size} {striped_file.name}")
+
+    def download(self, patterns):
+        """
+        Downloads the remote files matching the given glob patterns to the local working directory.
+        :param patterns: list of remote file names or glob patterns
+        :return: list of the downloaded file names
+        """
+        matches = []
+        for pattern in patterns:
+            matches.extend(json.loads(self.run_stripe(lambda client: client.request(f"match {pattern}")[0])))
+        futures = []
+        striped_files = []
+        try:
+            for name, size in matches:
+                ranges = self.ranges(size)
+                striped_file = StripedFile(name, size, len(ranges))
+                striped_file.fd = os.open(name + ".part", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                striped_files.append(striped_file)
+                preallocate(striped_file.fd, size)
+                for offset, length in ranges:
+                    futures.append(self.executor.submit(self.run_stripe, self.download_range, striped_file, offset,
+                                                        length))
+            self.wait(futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            for striped_file in striped_files:
+                os.close(striped_file.fd)
+                os.remove(striped_file.name + ".part")
+            raise
+        for striped_file in striped_files:
+            os.close(striped_file.fd)
+            os.replace(striped_file.name + ".part", striped_file.name)
+        return [name for name, size in matches]
+
+    def download_range(self, client, striped_file, offset, length):
+        writer = OffsetWriter(striped_file.fd, offset, offset + length)
+        client.request(f"dl {striped_file.name} {offset} {length}", data_file=writer)
+
+
+class AsyncConnection:
+    """
+    One session of an AsyncClient. Commands are pipelined: each is written as soon as it is issued, and a reader task
+    routes the frames of the answers to the request they belong to by request id. The server executes the commands of
+    a session in order and an upload streams its content right after its command, so every write holds send_lock,
+    an upload from its command to its last frame.
+    """
+
+    def __init__(self, reader, writer, protocol_version, compression):
+        self.reader = reader
+        self.writer = writer
+        self.protocol_version = protocol_version
+        self.compression = compression  # codec negotiated with the server
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> asyncio.Queue of the (opcode, flags, payload) frames answering it
+        self.send_lock = asyncio.Lock()
+        self.error = None  # ConnectionError once the connection is lost
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_frames())
+
+    @classmethod
+    async def open(cls, host, port, compression_codecs):
+        """
+        Connects and negotiates the protocol version and the compression codec.
+        :return: the AsyncConnection
+        :raises ServerBusy: when the server refuses the session
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            hello = {"versions": list(PROTOCOL_VERSIONS), "compression": list(compression_codecs)}
+            payload = json.dumps(hello).encode()
+            writer.write(HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSIONS[-1], OP_HELLO, 0, 0, len(payload)) + payload)
+            magic, version, opcode, flags, request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+            payload = await reader.readexactly(length)
+            if opcode == OP_BUSY:
+                busy = json.loads(payload)
+                raise ServerBusy(busy["reason"], busy["retry_after"])
+            if opcode != OP_HELLO:
+                raise ConnectionError(f"handshake failed: {payload.decode()}")
+        except BaseException:
+            writer.close()
+            raise
+        hello = json.loads(payload)
+        connection = cls(reader, writer, hello["version"], hello.get("compression"))
+        # The working directory info the server sends after the handshake answers request 0
+        await connection.finish(0, connection.expect(0))
+        return connection
+
+    async def read_frames(self):
+        try:
+            while True:
+                magic, version, opcode, flags, request_id, length = HEADER.unpack(
+                    await self.reader.readexactly(HEADER.size))
+                if magic != PROTOCOL_MAGIC:
+                    raise ConnectionError("invalid frame header")
+                payload = await self.reader.readexactly(length) if length else b""
+                queue = self.pending.get(request_id)
+                if queue is not None:
+                    # Blocks while the request's consumer is behind, leaving the rest of the data to TCP flow control.
+                    # Frames of requests no longer pending (their consumer stopped iterating) are dropped.
+                    await queue.put((opcode, flags, payload))
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            self.error = ConnectionError(str(error) or "connection closed by the server")
+        finally:
+            if self.error is None:
+                self.error = ConnectionError("connection closed")
+            for queue in self.pending.values():
+                if not queue.full():
+                    queue.put_nowait(None)
+
+    def expect(self, request_id):
+        queue = asyncio.Queue(ASYNC_FRAME_QUEUE)
+        self.pending[request_id] = queue
+        return queue
+
+    def write_command(self, command, flags=LISTING_MODES["none"]):
+        """
+        Writes a command frame, send_lock held.
+        :return: (request id, queue of the answering frames)
+        """
+        if self.error is not None:
+            raise self.error
+        request_id = next(self.request_ids)
+        queue = self.expect(request_id)
+        self.write_frame(OP_COMMAND, command.encode(), request_id, flags)
+        return request_id, queue
+
+    def write_frame(self, opcode, payload, request_id, flags=0):
+        self.writer.write(HEADER.pack(PROTOCOL_MAGIC, self.protocol_version, opcode, flags, request_id, len(payload)))
+        self.writer.write(payload)
+
+    async def command(self, command, flags=LISTING_MODES["none"]):
+        """
+        Sends a command.
+        :param command: full command (with argument)
+        :param flags: OP_COMMAND flags, the working directory info is not requested by default
+        :return: (request id, queue of the answering frames), see replies()
+        """
+        async with self.send_lock:
+            request_id, queue = self.write_command(command, flags)
+            await self.writer.drain()
+        return request_id, queue
+
+    async def replies(self, request_id, queue):
+        """
+        Async iterator over the frames answering a request, up to its final frame.
+        :return: (opcode, flags, payload) tuples, the final OP_REPLY excluded
+        :raises ServerError: when the request fails, ServerBusy when the server refuses it
+        """
+        try:
+            while True:
+                if queue.empty() and self.error is not None:
+                    raise self.error
+                frame = await queue.get()
+                if frame is None:
+                    raise self.error
+                opcode, flags, payload = frame
+                if opcode == OP_REPLY:
+                    return
+                if opcode == OP_ERROR:
+                    raise ServerError(payload.decode())
+                if opcode == OP_BUSY:
+                    busy = json.loads(payload)
+                    raise ServerBusy(busy["reason"], busy["retry_after"])
+                yield frame
+        finally:
+            self.pending.pop(request_id, None)
+            # A consumer leaving early may leave the reader blocked on the full queue: make room, the frames still to
+            # come for the request are then dropped by the reader
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def finish(self, request_id, queue):
+        """
+        Waits for the answer of a request.
+        :return: (list of the OP_RESULT payloads, list of the OP_LISTING pages)
+        """
+        results, listing = [], []
+        async for opcode, flags, payload in self.replies(request_id, queue):
+            if opcode == OP_RESULT:
+                results.append(payload)
+            elif opcode == OP_LISTING:
+                listing.append(payload.decode())
+        return results, listing
+
+    async def call(self, command, flags=LISTING_MODES["none"]):
+        """
+        Sends a command and waits for its answer.
+        :return: (list of the OP_RESULT payloads, list of the OP_LISTING pages)
+        """
+        return await self.finish(*await self.command(command, flags))
+
+    async def close(self):
+        if self.error is None:
+            async with self.send_lock:
+                self.write_frame(OP_COMMAND, b"exit", 0)
+        self.writer.close()
+        self.reader_task.cancel()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class AsyncClient:
+    """
+    asyncio counterpart of Client for programs driving many transfers, or many servers, from one event loop. Every
+    operation is a coroutine returning structured results instead of printing, and any number of them can run
+    concurrently: they are pipelined on a few sessions (see AsyncConnection), each going to the session with the
+    fewest requests in flight. cd is applied to every session, the operations issued after it completes see the new
+    working directory. Downloads are async iterators over the content.
+    Usage:
+        async with AsyncClient(host, port, connections=2) as client:
+            await asyncio.gather(*(client.ul(name, name) for name in names))
+            async for chunk in client.dl("report.csv"):
+                ...
+    The frames of a session are read in order: awaiting another operation in the middle of a dl iteration can stall
+    once the dl has ASYNC_FRAME_QUEUE frames ahead of it, if both landed on the same session.
+    """
+
+    def __init__(self, host, port, connections=1, verify=True):
+        """
+        :param connections: number of sessions opened with the server
+        :param verify: check full downloads against the sha256 of the file sent by the server
+        """
+        self.host = host
+        self.port = port
+        self.connection_count = connections
+        self.verify = verify
+        self.compression_codecs = COMPRESSION_CODECS  # codecs offered in the handshake, empty to disable compression
+        self.busy_retries = BUSY_RETRIES
+        self.connections = []
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Opens the sessions, waiting and trying again while the server refuses them with OP_BUSY."""
+        self.connections = list(await asyncio.gather(*(self.open_connection() for _ in range(self.connection_count))))
+
+    async def open_connection(self):
+        for attempt in range(self.busy_retries + 1):
+            try:
+                return await AsyncConnection.open(self.host, self.port, self.compression_codecs)
+            except ServerBusy as busy:
+                if attempt == self.busy_retries:
+                    raise
+                await asyncio.sleep(busy.retry_after * random.uniform(1, 1.5))
+
+    async def close(self):
+        await asyncio.gather(*(connection.close() for connection in self.connections))
+        self.connections = []
+
+    def connection(self):
+        if not self.connections:
+            raise ConnectionError("not connected")
+        return min(self.connections, key=lambda connection: len(connection.pending))
+
+    async def call(self, command):
+        """
+        Sends any command and waits for its answer.
+        :param command: full command (with argument)
+        :return: list of the OP_RESULT payloads
+        :raises ServerError: when the server reports an error
+        """
+        results, listing = await self.connection().call(command)
+        return results
+
+    async def cd(self, path):
+        """
+        :param path: directory to change to, relative to the working directory
+        :return: the new working directory
+        """
+        await asyncio.gather(*(connection.call(f"cd {path}") for connection in self.connections))
+        return await self.pwd()
+
+    async def pwd(self):
+        """:return: the working directory"""
+        return (await self.call("pwd"))[0].decode()
+
+    async def listing(self):
+        """:return: the working directory info, as printed by Client"""
+        results, listing = await self.connection().call("pwd", LISTING_MODES["full"])
+        return "\n".join(listing)
+
+    async def mkdir(self, name):
+        await self.call(f"mkdir {name}")
+
+    async def rm(self, name):
+        await self.call(f"rm {name}")
+
+    async def mv(self, name, destination):
+        await self.call(f"mv {name} {destination}")
+
+    async def info(self, name):
+        """:return: dict of the size, mtime and sha256 of the file"""
+        return json.loads((await self.call(f"info {name}"))[0])
+
+    async def stats(self):
+        """:return: the metrics of the server"""
+        return json.loads((await self.call("stats"))[0])
+
+    async def limit(self, rate=None, scope=None):
+        """
+        Reports or changes the bandwidth limits, see Client.issue_stats(). The limit of the client's own sessions
+        applies to each of its connections.
+        :param rate: bytes per second, 0 for unlimited, None to only report the limits
+        :param scope: None for the client's own sessions, 'global' or 'session' for the server's limits
+        :return: dict of the "server" limits and effective rates, and of those of one of the client's "session"s
+        """
+        if rate is None:
+            return json.loads((await self.call("limit"))[0])
+        if scope is not None:
+            return json.loads((await self.call(f"limit {scope} {rate}"))[0])
+        results = await asyncio.gather(*(connection.call(f"limit {rate}") for connection in self.connections))
+        return json.loads(results[0][0][0])
+
+    async def find(self, pattern):
+        """
+        :param pattern: shell style pattern, e.g. '*.jpg'
+        :return: dict of the "matches" below the working directory, [relative path, size] pairs, and whether they were
+            "truncated"
+        """
+        return json.loads((await self.call(f"find {pattern}"))[0])
+
+    async def du(self, name="."):
+        """:return: dict of the disk usage of the directory, see Client.issue_du()"""
+        return json.loads((await self.call(f"du {name}"))[0])
+
+    async def dl(self, name, offset=0, length=0):
+        """
+        Downloads a file.
+        :param name: path of the file on the server
+        :param offset: first byte to download
+        :param length: number of bytes to download, 0 for the rest of the file
+        :return: async iterator over chunks (bytes) of the content, decompressed. With verify, a full download whose
+            sha256 does not match the server's raises ServerError after the last chunk.
+        """
+        verify = self.verify and not offset and not length
+        command = f"dl {name} {offset} {length}" if offset or length else f"dl {name}"
+        flags = LISTING_MODES["none"] | (FLAG_VERIFY if verify else 0)
+        for attempt in range(self.busy_retries + 1):
+            connection = self.connection()
+            hasher = hashlib.sha256() if verify else None
+            expected = None
+            decompressor = None
+            frames = connection.replies(*await connection.command(command, flags))
+            try:
+                async for opcode, flags, payload in frames:
+                    if opcode == OP_RESULT:
+                        expected = json.loads(payload)["sha256"]
+                    elif opcode == OP_DATA:
+                        if flags & FLAG_COMPRESSED:
+                            if decompressor is None:
+                                decompressor = StreamCodec(connection.compression)
+                            payload = decompressor.decompress(payload)
+                        if hasher is not None:
+                            hasher.update(payload)
+                        yield payload
+            except ServerBusy as busy:
+                # Refused before any content was sent
+                if attempt == self.busy_retries:
+                    raise
+                await asyncio.sleep(busy.retry_after * random.uniform(1, 1.5))
+                continue
+            finally:
+                # Frees the request's queue at once when the caller stops iterating early
+                await frames.aclose()
+            if hasher is not None and hasher.hexdigest() != expected:
+                raise ServerError(f"{name}: checksum mismatch")
+            return
+
+    async def download(self, name, path=None):
+        """
+        Downloads a file to a local file, written to a partial file first.
+        :param name: path of the file on the server
+        :param path: local path, defaults to the base name of the file in the working directory
+        :return: number of bytes downloaded
+        """
+        path = path or os.path.basename(name)
+        size = 0
+        with open(path + ".part", "wb") as file:
+            try:
+                async for chunk in self.dl(name):
+                    file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                file.close()
+                os.remove(path + ".part")
+                raise
+        os.replace(path + ".part", path)
+        return size
+
+    async def ul(self, name, source):
+        """
+        Uploads a file. Files and bytes are uploaded like Client.issue_ul() does: resumable, verified and deduplicated
+        by the server. An async iterable is streamed as it is produced.
+        :param name: path of the file on the server
+        :param source: path of a local file, bytes, or async iterable of bytes chunks
+        :return: dict of the 'size' uploaded, the 'offset' the upload resumed from, whether the server already
+            'stored' the content, and the 'transfer' stats
+        """
+        if not isinstance(source, (str, os.PathLike, bytes, bytearray, memoryview)):
+            # A stream cannot be replayed when the server refuses it
+            return await self.upload_stream(name, source)
+        for attempt in range(self.busy_retries + 1):
+            try:
+                if isinstance(source, (str, os.PathLike)):
+                    return await self.upload_file(name, source)
+                return await self.upload_bytes(name, source)
+            except ServerBusy as busy:
+                if attempt == self.busy_retries:
+                    raise
+                await asyncio.sleep(busy.retry_after * random.uniform(1, 1.5))
+
+    async def upload_file(self, name, path):
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            # Hashing and reading run on the default executor, they would stall the other operations
+            digest = await loop.run_in_executor(None, lambda: hash_file(file.fileno(), hashlib.sha256(),
+                                                                        bytearray(RECEIVE_BUFFER_SIZE)).hexdigest())
+
+            def read(connection, offset):
+                codec = choose_compression(name, file.fileno(), connection.compression,
+                                           bytearray(ENTROPY_SAMPLE_SIZE), offset)
+                compressor = StreamCodec(codec) if codec is not None else None
+                chunk_size = RECEIVE_BUFFER_SIZE if codec is not None else TRANSFER_CHUNK_SIZE
+                stats = TransferStats(codec)
+
+                def compress(data):
+                    started = time.thread_time()
+                    payload = compressor.compress(data)
+                    stats.cpu_time += time.thread_time() - started
+                    return payload
+
+                async def chunks():
+                    position = offset
+                    while position < size:
+                        data = await loop.run_in_executor(None, os.pread, file.fileno(),
+                                                          min(chunk_size, size - position), position)
+                        if not data:
+                            raise ValueError("file shrank during the transfer")
+                        position += len(data)
+                        if compressor is not None:
+                            payload = await loop.run_in_executor(None, compress, data)
+                            stats.add(len(data), len(payload))
+                            yield payload, FLAG_COMPRESSED
+                        else:
+                            stats.add(len(data), len(data))
+                            yield data, 0
+                return chunks(), stats
+
+            return await self.upload(name, f"ul {name} {size} {digest}", size, read)
+
+    async def upload_bytes(self, name, data):
+        data = memoryview(data)
+        digest = hashlib.sha256(data).hexdigest()
+
+        def read(connection, offset):
+            stats = TransferStats(None)
+
+            async def chunks():
+                for position in range(offset, len(data), TRANSFER_CHUNK_SIZE):
+                    chunk = data[position:position + TRANSFER_CHUNK_SIZE]
+                    stats.add(len(chunk), len(chunk))
+                    yield chunk, 0
+            return chunks(), stats
+
+        return await self.upload(name, f"ul {name} {len(data)} {digest}", len(data), read)
+
+    async def upload(self, name, command, size, read):
+        """
+        Resumable upload: the server answers the command with the offset to start from, then the content from that
+        offset is streamed, send_lock held all along.
+        :param read: function (connection, offset) returning an async iterator of (payload, flags) and its stats
+        """
+        connection = self.connection()
+        async with connection.send_lock:
+            request_id, queue = connection.write_command(command)
+            await connection.writer.drain()
+            frames = connection.replies(request_id, queue)
+            opcode, flags, payload = await frames.__anext__()
+            upload = json.loads(payload)
+            stats = None
+            if not upload.get("stored"):
+                chunks, stats = read(connection, upload["offset"])
+                async for payload, flags in chunks:
+                    connection.write_frame(OP_DATA, payload, request_id, flags)
+                    await connection.writer.drain()
+                connection.write_frame(OP_END, b"", request_id)
+                await connection.writer.drain()
+        async for frame in frames:
+            pass
+        return {"size": size, "offset": upload["offset"], "stored": bool(upload.get("stored")),
+                "transfer": stats.as_dict() if stats is not None else None}
+
+    async def upload_stream(self, name, chunks):
+        """
+        Upload of content of unknown size: the server accepts the command with an OP_RESULT frame (or refuses it,
+        raising ServerError / ServerBusy here) before the content is streamed, send_lock held all along.
+        """
+        connection = self.connection()
+        stats = TransferStats(None)
+        async with connection.send_lock:
+            request_id, queue = connection.write_command(f"ul {name}")
+            await connection.writer.drain()
+            frames = connection.replies(request_id, queue)
+            await frames.__anext__()
+            async for chunk in chunks:
+                if chunk:
+                    connection.write_frame(OP_DATA, chunk, request_id)
+                    stats.add(len(chunk), len(chunk))
+                    await connection.writer.drain()
+            connection.write_frame(OP_END, b"", request_id)
+            await connection.writer.drain()
+        async for frame in frames:
+            pass
+        return {"size": stats.raw_bytes, "offset": 0, "stored": False, "transfer": stats.as_dict()}
+
+
 def run_client():
     HOST = "127.0.0.1"  # The server's hostname or IP address
     PORT = 65432  # The port used by the server
@@ -1,17 +1,196 @@
+import argparse
+import asyncio
+import bisect
+import errno
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import mmap
 import os
+import queue
+import re
 import secrets
+import selectors
+import signal
 import shutil
 import socket
+import sqlite3
+import stat
+import struct
+import sys
 import time
-from pathlib import Path
-from threading import Thread
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
+from threading import Condition, Event, Lock, Thread, Timer, get_ident
+
+try:
+    import uvloop
+except ImportError:  # optional, the stdlib event loop is used when uvloop is not installed
+    uvloop = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, no reflinks nor file locks there
+    fcntl = None
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+    inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+except (ImportError, OSError, AttributeError):  # not Linux: the tree index only follows the server's own changes
+    inotify_init1 = inotify_add_watch = None
+
+# The code shared with the client is in transfer.py, at the root of the repository, also when this file is run as
+# a script
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.insert(1, REPOSITORY_ROOT)
+from transfer import (ARCHIVE_SENDFILE_MIN, BULK_COMMANDS, COMPRESSION_CODECS, ENTROPY_SAMPLE_SIZE,
+                      TRANSFER_CHUNK_SIZE, DeltaWriter, HashingWriter, OffsetWriter, StreamCodec, TarExtractor,
+                      TransferStats, choose_compression, compute_delta, file_signatures, hash_file, iter_archive,
+                      preallocate, walk_tree)
+
+# Wire protocol: every message is a fixed header followed by `length` payload bytes.
+# magic (2s) | version (B) | opcode (B) | flags (H) | request id (I) | payload length (Q)
+PROTOCOL_MAGIC = b"CS"
+PROTOCOL_VERSIONS = (1,)
+HEADER = struct.Struct("!2sBBHIQ")
+
+OP_HELLO = 1  # handshake, JSON payload
+OP_COMMAND = 2  # client command, e.g. b"mkdir test_dir"
+OP_RESULT = 3  # command specific result, e.g. the size returned by info
+OP_LISTING = 4  # current working directory info
+OP_DATA = 5  # file contents
+OP_END = 6  # end of a stream of OP_DATA frames
+OP_REPLY = 7  # last frame of a successful command
+OP_ERROR = 8  # last frame of a failed command, payload is the error message
+OP_BUSY = 9  # last frame of a refused connection or command, JSON payload: {"reason", "retry_after"} in seconds
+
+FLAG_COMPRESSED = 0x1  # OP_DATA flag: the payload is a chunk compressed with the session's codec
+
+RECEIVE_BUFFER_SIZE = 1 << 18  # size of the reusable buffer file transfers are received into
+BUFFER_POOL_SIZE = 64  # transfer buffers kept for reuse between commands, see BufferPool
+
+# OP_COMMAND flags: which working directory info the client wants after the command
+LISTING_FULL = 0
+LISTING_NONE = 1
+LISTING_DELTA = 2
+LISTING_MASK = 0x3
+LISTING_PAGE_LINES = 4096  # lines of working directory info per OP_LISTING frame
+FLAG_VERIFY = 0x4  # OP_COMMAND flag: dl answers with the size, mtime and sha256 of the file before the content
+FLAG_ARCHIVE = 0x8  # OP_COMMAND flag: dl / ul of a directory, its tree is streamed as a tar archive
+
+FICLONE = 0x40049409  # Linux ioctl creating a copy-on-write clone (reflink) of a file
+COPY_WORKERS = 8  # threads copying the files of a directory tree within the server (cp -r, mv across filesystems)
+
+LISTEN_BACKLOG = 4096  # pending connections, capped by the kernel (net.core.somaxconn)
+WORKER_SHUTDOWN_GRACE = 10  # seconds a stopping worker gives its sessions to end
+WORKER_RESTART_DELAY = 1  # seconds before restarting a worker that died right after starting
+GENERATION_SLOTS = 65536  # directory change stamps shared by the worker processes
+
+# Admission control, per server process, see AdmissionControl
+MAX_SESSIONS = 1024  # sessions served concurrently by the threaded engine, more connections wait for a free slot
+ASYNC_MAX_SESSIONS = 16384  # same for the asyncio engine, whose idle sessions only cost a coroutine and a socket
+MAX_PENDING = 1024  # connections waiting for a slot, more are refused right away
+ADMISSION_TIMEOUT = 5  # seconds a connection waits for a slot before being refused
+MAX_TRANSFERS = 64  # transfers (dl, ul, ulrange, patch, delta) in progress
+MAX_INFLIGHT_BYTES = 1 << 30  # total size of the transfers in progress
+IDLE_TIMEOUT = 600  # seconds without a command after which a session is closed
+BUSY_RETRY_AFTER = 1.0  # seconds a refused client is asked to wait before trying again
+REAPER_INTERVAL = 1  # seconds between two checks for idle sessions and expired connections
+REJECT_TIMEOUT = 0.2  # seconds given to a refused client to send its hello before the connection is closed
+REJECT_BACKLOG = 1024  # refused connections waiting for their hello, more are closed right away
+
+# Hot files served from memory by dl, see FileCache
+FILE_CACHE_BYTES = 256 << 20  # mapped bytes, 0 disables the cache
+FILE_CACHE_MAX_FILE_SIZE = 16 << 20  # larger files are always streamed from disk
+FILE_CACHE_ADMISSION = 2  # requests of a file before it is mapped
+
+# In-memory index of the served tree, see TreeIndex
+INDEX_WORKERS = 8  # threads listing directories in parallel while the tree is scanned
+FIND_MAX_RESULTS = 10000  # matches returned by find
+INOTIFY_EVENT = struct.Struct("iIII")  # watch descriptor, mask, cookie, length of the name following the event
+INOTIFY_BUFFER_SIZE = 64 << 10
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+# Bandwidth shaping, per server process, see TrafficShaper
+SHAPING_QUANTUM = 64 << 10  # bytes a rate limited transfer moves between two checks of the token buckets
+SHAPING_BURST = 0.25  # seconds of its rate a token bucket holds at most
+RATE_WINDOW = 1.0  # seconds over which the effective rates are measured
+INTERACTIVE_WORKERS = 16  # threads of the asyncio engine running interactive commands only
+
+# Upper bounds, in seconds, of the buckets of the command latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+# Commands with their own metrics, anything else is counted as "unknown"
+COMMANDS = frozenset(["cd", "mkdir", "rm", "mv", "cp", "info", "dl", "ul", "ulrange", "ulcommit", "match", "tree",
+                      "sigs", "patch", "delta", "find", "du", "pwd", "stats", "profile", "limit"])
+METRICS_FILE_INTERVAL = 10  # seconds between two writes of the --metrics-file
+PROFILER_INTERVAL = 0.005  # default seconds between two stack samples of the profiler
+
+logger = logging.getLogger("server")
+
+# openat() style calls relative to the session's working directory, where the platform has them
+DIR_FD_SUPPORTED = {os.open, os.stat, os.mkdir, os.unlink, os.rename} <= os.supports_dir_fd
 
 
 class Server:
-    def __init__(self, host, port):
+    default_max_sessions = MAX_SESSIONS  # sessions served at once when the AdmissionControl does not say
+
+    def __init__(self, host, port, root=None, store_directory=None, deduplicate=True, profiling=False,
+                 generations=None, admission=None, file_cache_bytes=FILE_CACHE_BYTES, index=True, shaper=None,
+                 limit_control=False):
         self.host = host
-        self.port = port
+        self.port = port  # 0 picks an ephemeral port, the actual one is stored here once listening
+        self.ready = Event()  # set once the server accepts connections
         self.server_socket = None
+        self.protocol_versions = PROTOCOL_VERSIONS
+        # the directory tree served to the clients, every session starts in it and cannot leave it
+        self.root = os.path.realpath(root or os.getcwd())
+        # content-addressed copies of the uploads, on the same filesystem as the root so they can be hardlinked
+        self.content_store = None
+        self.hidden_paths = frozenset()
+        if deduplicate:
+            self.content_store = ContentStore(os.path.realpath(store_directory or os.path.join(self.root, ".cas")))
+            self.hidden_paths = frozenset([self.content_store.directory])
+        # generations: the GenerationTable shared with the other worker processes, see Supervisor
+        self.listing_cache = ListingCache(self.hidden_paths, generations=generations)
+        self.digest_cache = DigestCache()
+        self.file_cache = FileCache(file_cache_bytes)
+        # index: keep an index of the tree in memory for find / du, otherwise they scan the directory asked about
+        self.tree_index = TreeIndex(self.root, self.hidden_paths, enabled=index)
+        self.metrics = Metrics()
+        self.admission = admission or AdmissionControl()
+        if self.admission.max_sessions is None:
+            self.admission.max_sessions = self.default_max_sessions
+        self.shaper = shaper or TrafficShaper()
+        self.buffer_pool = BufferPool()  # transfer buffers borrowed by the sessions while they run a command
+        # opt-in: the limit command only changes the limits of the client's own session unless allowed
+        self.limit_control = limit_control
+        self.session_pool = None
+        self.copy_pool = ThreadPoolExecutor(COPY_WORKERS, thread_name_prefix="copy")
+        self.rejector = ConnectionRejector(self.reject_connection)
+        # opt-in: the profile command is refused unless the server was started with profiling allowed
+        self.profiler = SamplingProfiler() if profiling else None
 
     def start(self):
         """
@@ -24,24 +203,114 @@ class Server:
         # Bind the socket to the specified address and port
 
         # Listen for incoming connections
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.host, self.port))
-            s.listen()
-            print(f"Server listening on {self.host}:{self.port}")
+        self.serve(create_listening_socket(self.host, self.port))
+
+    def serve(self, listening_socket):
+        """
+        Accepts client connections on a listening socket until shutdown(), serving each one on a ClientThread. The
+        pre-forked workers of a Supervisor call it with the socket they share.
+        :param listening_socket: a bound, listening socket
+        """
+        with listening_socket as s:
+            self.port = s.getsockname()[1]
+            logger.info("Server listening on %s:%s", self.host, self.port)
+            # Sessions run on a bounded pool, the connections beyond it wait in the AdmissionControl queue
+            self.session_pool = ThreadPoolExecutor(self.admission.max_sessions, thread_name_prefix="session")
+            Thread(target=self.reap, name="reaper", daemon=True).start()
+            self.tree_index.start()
+            self.ready.set()
             while True:
                 conn, client_address = s.accept()
-                print(f"Accepted connection from {client_address}")
-                eof_token = self.generate_random_eof_token().encode()
-                conn.sendall(eof_token)
-                client_socket = ClientThread(self, conn, client_address, eof_token.decode())
-                client_socket.start()
-                # Handle the client requests using ClientThread
+                logger.debug("connection accepted address=%s", client_address)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                admitted = self.admission.admit((conn, client_address))
+                if admitted:
+                    self.start_session(conn, client_address)
+                elif admitted is None:
+                    self.refuse(conn, "too many connections")
+
+    def start_session(self, conn, client_address):
+        """
+        Serves a connection holding a session slot on the session pool.
+        :param conn: the accepted socket
+        :param client_address: address of the client
+        """
+        eof_token = self.generate_random_eof_token()
+        # The version handshake happens on the ClientThread so a slow client cannot stall accept()
+        client_socket = ClientThread(self, conn, client_address, eof_token)
+        # Handle the client requests using ClientThread, run on a pool thread
+        self.session_pool.submit(client_socket.run)
+
+    def session_finished(self):
+        """
+        Called by a ClientThread whose session ended: its slot goes to the oldest waiting connection, if any.
+        """
+        connection, expired = self.admission.release()
+        for conn, client_address in expired:
+            self.refuse(conn, "timed out waiting for a session slot")
+        if connection is not None:
+            self.start_session(*connection)
+
+    def refuse(self, conn, reason):
+        """
+        Hands a refused connection to the ConnectionRejector, so that accept() never waits for a refused client.
+        :param conn: the accepted socket
+        :param reason: message of the OP_BUSY frame
+        """
+        self.rejector.refuse(conn, reason)
 
-            # raise NotImplementedError("Your implementation here.")
+    def reject_connection(self, conn, reason):
+        """
+        Answers the hello of a connection refused by the admission control with an OP_BUSY frame, then closes it. Runs
+        on the thread of the ConnectionRejector, once the hello is readable.
+        :param conn: the accepted socket
+        :param reason: message of the OP_BUSY frame
+        """
+        logger.warning("connection refused reason=%r", reason)
+        conn.settimeout(REJECT_TIMEOUT)
+        try:
+            opcode, flags, request_id, payload = self.receive_frame(conn, bytearray(HEADER.size))
+            self.send_frame(conn, OP_BUSY, busy_payload(reason, self.admission.retry_after()), request_id)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            conn.close()
+
+    def reap(self):
+        """
+        Runs on the reaper thread: closes the sessions idle for longer than the idle timeout and refuses the connections
+        that waited too long for a session slot.
+        """
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            now = time.monotonic()
+            for session in list(self.metrics.sessions):
+                if not session.in_command and now - session.last_active > self.admission.idle_timeout:
+                    logger.info("session reaped address=%s idle=%.0fs", session.address, now - session.last_active)
+                    self.admission.reaped += 1
+                    session.service_socket.shutdown()
+            for conn, client_address in self.admission.expire(now):
+                self.refuse(conn, "timed out waiting for a session slot")
+
+    def shutdown(self):
+        """
+        Stops accepting connections. Called from a signal handler, i.e. on the main thread, where it interrupts the
+        accept() of serve(). The sessions in progress go on, on their own threads, see wait_for_sessions().
+        """
+        raise SystemExit(0)
 
-            # while True:
-            # Accept incoming connections
-            # send random eof token
+    def wait_for_sessions(self, timeout):
+        """
+        Waits for the sessions in progress to end, after shutdown().
+        :param timeout: seconds to wait at most
+        :return: True if all the sessions ended
+        """
+        deadline = time.monotonic() + timeout
+        while self.metrics.sessions:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
 
     def get_working_directory_info(self, working_directory):
         """
@@ -49,14 +318,7 @@ class Server:
         :param working_directory: path to the directory
         :return: string of the directory and its contents.
         """
-        dirs = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_dir()]
-        )
-        files = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_file()]
-        )
-        dir_info = f"Current Directory: {working_directory}:\n|{dirs}{files}"
-        return dir_info
+        return "\n".join(self.listing_cache.get(working_directory).lines())
 
     def generate_random_eof_token(self):
         """Helper method to generates a random token that starts with '<' and ends with '>'.
@@ -68,188 +330,3704 @@ class Server:
         eof_token = '<' + ''.join(secrets.choice(charset) for _ in range(8)) + '>'
         return eof_token
 
-    def receive_message_ending_with_token(self, active_socket, buffer_size, eof_token):
+    def handshake(self, session):
+        """
+        Negotiates the protocol version with a freshly connected client. The client sends an OP_HELLO frame listing the
+        versions and compression codecs it speaks, the server answers with the highest common version, the codec
+        transfers may use and the session token.
+        :param session: the Session of the client
+        :return: the negotiated protocol version, or None if there is no common version.
+        """
+        opcode, flags, request_id, payload = self.receive_frame(session.service_socket, session.header_buffer)
+        version, reply_opcode, reply = self.negotiate(session, opcode, payload)
+        self.send_frame(session.service_socket, reply_opcode, reply, request_id,
+                        version=version or PROTOCOL_VERSIONS[-1])
+        return version
+
+    def negotiate(self, session, opcode, payload):
+        """
+        Picks the protocol version and the compression codec of a session from the client's OP_HELLO frame.
+        :param session: the Session of the client
+        :param opcode: opcode of the first frame sent by the client
+        :param payload: payload of the first frame sent by the client
+        :return: (version or None, opcode of the answer, payload of the answer)
+        """
+        if opcode != OP_HELLO:
+            return None, OP_ERROR, b"expected hello"
+        try:
+            hello = json.loads(payload)
+            common = set(hello.get("versions", [])).intersection(self.protocol_versions)
+            offered = [codec for codec in COMPRESSION_CODECS if codec in hello.get("compression", [])]
+        except (ValueError, TypeError, AttributeError):
+            # Not JSON, or not the expected object
+            return None, OP_ERROR, b"malformed hello"
+        if not common:
+            return None, OP_ERROR, b"no common protocol version"
+        version = max(common)
+        session.compression = next(iter(offered), None)
+        hello = {"version": version, "token": session.eof_token, "compression": session.compression}
+        return version, OP_HELLO, json.dumps(hello).encode()
+
+    def send_frame(self, active_socket, opcode, payload=b"", request_id=0, flags=0, version=PROTOCOL_VERSIONS[-1]):
+        """
+        Same implementation as in send_frame() in client.py
+        Sends a single message: the fixed size header followed by the payload.
+        :param active_socket: a socket object that is connected to the peer
+        :param opcode: one of the OP_* constants
+        :param payload: bytes-like message body
+        :param request_id: id of the request this frame belongs to
+        :param flags: opcode specific flags
+        :param version: protocol version to stamp on the header
+        """
+        header = HEADER.pack(PROTOCOL_MAGIC, version, opcode, flags, request_id, len(payload))
+        if len(payload) <= 65536:
+            active_socket.sendall(header + payload)
+        else:
+            # Avoid copying large payloads just to prepend the header
+            active_socket.sendall(header)
+            active_socket.sendall(payload)
+
+    def send_file(self, active_socket, file, request_id=0, offset=0, count=None, codec=None, buffer=None):
+        """
+        Same implementation as in send_file() in client.py
+        Streams an open file as OP_DATA frames of at most TRANSFER_CHUNK_SIZE bytes followed by an OP_END frame. The
+        payloads are handed to the kernel with sendfile(), so the content is never copied into user space. With a
+        codec, the file is instead read chunk by chunk and every chunk is sent compressed, flagged FLAG_COMPRESSED.
+        :param active_socket: a socket object that is connected to the peer
+        :param file: a file object opened in binary mode
+        :param request_id: id of the request this transfer belongs to
+        :param offset: position in the file to start from
+        :param count: number of bytes to send, defaults to the rest of the file
+        :param codec: name of the compression codec to use, None to send the file as is
+        :param buffer: optional reusable bytearray the chunks to compress are read into
+        :return: the TransferStats of the transfer
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        stats = TransferStats(codec)
+        if codec is not None:
+            compressor = StreamCodec(codec)
+            view = memoryview(buffer if buffer is not None else bytearray(RECEIVE_BUFFER_SIZE))
+        sent = 0
+        while sent < count:
+            if codec is None:
+                length = min(TRANSFER_CHUNK_SIZE, count - sent)
+                active_socket.sendall(HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSIONS[-1], OP_DATA, 0, request_id,
+                                                  length))
+                active_socket.sendfile(file, offset + sent, length)
+                stats.add(length, length)
+            else:
+                length = os.preadv(file.fileno(), [view[:min(len(view), count - sent)]], offset + sent)
+                if length == 0:
+                    raise ValueError("file shrank during the transfer")
+                started = time.thread_time()
+                payload = compressor.compress(view[:length])
+                stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, FLAG_COMPRESSED)
+                stats.add(length, len(payload))
+            sent += length
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        return stats
+
+    def send_buffer(self, active_socket, data, request_id=0, offset=0, count=None, codec=None):
+        """
+        Streams a file held in memory as send_file() streams one from disk. The payloads of an uncompressed transfer
+        are slices of the buffer, handed to the socket without being copied.
+        :param active_socket: a socket object that is connected to the peer
+        :param data: memoryview of the content of the file
+        :param request_id: id of the request this transfer belongs to
+        :param offset: position in the file to start from
+        :param count: number of bytes to send, defaults to the rest of the file
+        :param codec: name of the compression codec to use, None to send the file as is
+        :return: the TransferStats of the transfer
+        """
+        if count is None:
+            count = len(data) - offset
+        stats = TransferStats(codec)
+        compressor = StreamCodec(codec) if codec is not None else None
+        # Compressed chunks are as large as those send_file() reads, so both compress alike
+        chunk_size = TRANSFER_CHUNK_SIZE if codec is None else RECEIVE_BUFFER_SIZE
+        sent = 0
+        while sent < count:
+            length = min(chunk_size, count - sent)
+            chunk = data[offset + sent:offset + sent + length]
+            if compressor is None:
+                self.send_frame(active_socket, OP_DATA, chunk, request_id)
+                stats.add(length, length)
+            else:
+                started = time.thread_time()
+                payload = compressor.compress(chunk)
+                stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, FLAG_COMPRESSED)
+                stats.add(length, len(payload))
+            sent += length
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        return stats
+
+    def send_archive(self, active_socket, root, request_id=0, codec=None, buffer=None, hidden_paths=frozenset()):
+        """
+        Same implementation as in send_archive() in client.py
+        Streams a directory tree as a tar archive generated on the fly (see iter_archive()) in OP_DATA frames followed
+        by an OP_END frame. The headers and the small files are gathered in frames of up to TRANSFER_CHUNK_SIZE bytes,
+        compressed with the codec if any. Files of ARCHIVE_SENDFILE_MIN bytes or more get frames of their own: handed
+        to the kernel with sendfile() as send_file() does, or compressed chunk by chunk when choose_compression()
+        finds them worth it.
+        :param active_socket: a socket object that is connected to the peer
+        :param root: absolute path of the directory
+        :param request_id: id of the request this transfer belongs to
+        :param codec: name of the compression codec negotiated with the peer, None to send the archive as is
+        :param buffer: optional reusable bytearray the files are sampled into by choose_compression()
+        :param hidden_paths: absolute paths left out of the archive
+        :return: the TransferStats of the transfer
+        """
+        stats = TransferStats(codec)
+        compressor = StreamCodec(codec) if codec is not None else None
+        chunk_size = TRANSFER_CHUNK_SIZE if codec is None else RECEIVE_BUFFER_SIZE
+        buffer = buffer if buffer is not None else bytearray(RECEIVE_BUFFER_SIZE)
+        pending = bytearray()
+
+        def send(data, compress):
+            if compress:
+                started = time.thread_time()
+                payload = compressor.compress(data)
+                stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, FLAG_COMPRESSED)
+                stats.add(len(data), len(payload))
+            else:
+                self.send_frame(active_socket, OP_DATA, data, request_id)
+                stats.add(len(data), len(data))
+
+        for item in iter_archive(root, hidden_paths):
+            if not isinstance(item, tuple):
+                pending += item
+            else:
+                name, file, size = item
+                sent = 0
+                if size >= ARCHIVE_SENDFILE_MIN:
+                    if pending:
+                        send(pending, compressor is not None)
+                        pending.clear()
+                    file_codec = choose_compression(name, file.fileno(), codec, buffer)
+                    while sent < size:
+                        length = min(chunk_size if file_codec else TRANSFER_CHUNK_SIZE, size - sent)
+                        if file_codec is None:
+                            active_socket.sendall(HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSIONS[-1], OP_DATA, 0,
+                                                              request_id, length))
+                            active_socket.sendfile(file, sent, length)
+                            stats.add(length, length)
+                        else:
+                            data = os.pread(file.fileno(), length, sent)
+                            if len(data) != length:
+                                raise ValueError("file shrank during the transfer")
+                            send(data, True)
+                        sent += length
+                    continue
+                while sent < size:
+                    data = os.pread(file.fileno(), min(chunk_size - len(pending), size - sent), sent)
+                    if not data:
+                        raise ValueError("file shrank during the transfer")
+                    pending += data
+                    sent += len(data)
+                    if len(pending) >= chunk_size:
+                        send(pending, compressor is not None)
+                        pending.clear()
+            if len(pending) >= chunk_size:
+                send(pending, compressor is not None)
+                pending.clear()
+        if pending:
+            send(pending, compressor is not None)
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        return stats
+
+    def send_delta(self, active_socket, fd, signatures=None, request_id=0, codec=None):
         """
-        Same implementation as in receive_message_ending_with_token() in client.py
-        A helper method to receives a bytearray message of arbitrary size sent on the socket.
-        This method returns the message WITHOUT the eof_token at the end of the last packet.
-        :param active_socket: a socket object that is connected to the server
-        :param buffer_size: the buffer size of each recv() call
-        :param eof_token: a token that denotes the end of the message.
-        :return: a bytearray message with the eof_token stripped from the end.
+        Same implementation as in send_delta() in client.py
+        Streams the delta records rebuilding a file from the base file described by `signatures`, packed in OP_DATA
+        frames of at most TRANSFER_CHUNK_SIZE bytes (compressed with the codec, if any) followed by an OP_END frame.
+        :param active_socket: a socket object that is connected to the peer
+        :param fd: descriptor of the file to send
+        :param signatures: signatures of the peer's version of the file, None if it has none
+        :param request_id: id of the request this transfer belongs to
+        :param codec: name of the compression codec to use, None to send the records as is
+        :return: the TransferStats of the transfer, raw_bytes being the size of the file
         """
-        data = active_socket.recv(buffer_size)
-        return data.decode('utf-8').strip().split(eof_token)[0].strip().encode("utf-8")
+        stats = TransferStats(codec)
+        compressor = StreamCodec(codec) if codec is not None else None
+        frame = bytearray()
+        for record in itertools.chain(compute_delta(fd, signatures), [None]):
+            if record is not None and len(frame) + len(record) <= TRANSFER_CHUNK_SIZE:
+                frame += record
+                continue
+            if frame:
+                payload, flags = frame, 0
+                if compressor is not None:
+                    started = time.thread_time()
+                    payload, flags = compressor.compress(frame), FLAG_COMPRESSED
+                    stats.cpu_time += time.thread_time() - started
+                self.send_frame(active_socket, OP_DATA, payload, request_id, flags)
+                stats.add(0, len(payload))
+            frame = bytearray(record or b"")
+        self.send_frame(active_socket, OP_END, b"", request_id)
+        stats.raw_bytes = os.fstat(fd).st_size
+        return stats
 
-    def handle_cd(self, current_working_directory, new_working_directory):
+    def receive_exactly(self, active_socket, buffer):
         """
-        Handles the client cd commands. Reads the client command and changes the current_working_directory variable
-        accordingly. Returns the absolute path of the new current working directory.
-        :param current_working_directory: string of current working directory
+        Same implementation as in receive_exactly() in client.py
+        Fills the whole of the given preallocated buffer from the socket.
+        :param active_socket: a socket object that is connected to the peer
+        :param buffer: a writable bytes-like object (bytearray / memoryview) of the expected size
+        :return: the filled buffer
+        """
+        view = memoryview(buffer)
+        received = 0
+        while received < len(view):
+            count = active_socket.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionError("connection closed by peer")
+            received += count
+        return buffer
+
+    def receive_header(self, active_socket, header_buffer=None):
+        """
+        Same implementation as in receive_header() in client.py
+        Receives and validates a frame header, leaving the payload on the socket.
+        :param active_socket: a socket object that is connected to the peer
+        :param header_buffer: optional reusable bytearray of HEADER.size bytes
+        :return: (opcode, flags, request_id, length)
+        """
+        if header_buffer is None:
+            header_buffer = bytearray(HEADER.size)
+        self.receive_exactly(active_socket, header_buffer)
+        magic, version, opcode, flags, request_id, length = HEADER.unpack(header_buffer)
+        if magic != PROTOCOL_MAGIC:
+            raise ConnectionError("invalid frame header")
+        if version not in self.protocol_versions:
+            raise ConnectionError(f"unsupported protocol version {version}")
+        return opcode, flags, request_id, length
+
+    def receive_frame(self, active_socket, header_buffer=None):
+        """
+        Same implementation as in receive_frame() in client.py
+        Receives a single message. Exactly HEADER.size bytes are read for the header, then exactly `length` bytes are read
+        into a buffer preallocated for the payload.
+        :param active_socket: a socket object that is connected to the peer
+        :param header_buffer: optional reusable bytearray of HEADER.size bytes
+        :return: (opcode, flags, request_id, payload) where payload is a bytearray
+        """
+        opcode, flags, request_id, length = self.receive_header(active_socket, header_buffer)
+        payload = bytearray(length)
+        if length:
+            self.receive_exactly(active_socket, payload)
+        return opcode, flags, request_id, payload
+
+    def receive_stream(self, active_socket, file, header_buffer=None, buffer=None, codec=None):
+        """
+        Same implementation as in receive_stream() in client.py
+        Receives OP_DATA frames up to the terminating OP_END frame, writing the payloads straight to the given file
+        through a reusable buffer, so memory use does not depend on the size of the transfer. Frames flagged
+        FLAG_COMPRESSED are decompressed with the given codec first. When the content cannot be written (e.g. a
+        DeltaWriter finding an invalid record, a full disk), the rest of the stream is still read and dropped so the
+        frames of the next requests stay in sync, and the error is raised once the OP_END frame is received.
+        :param active_socket: a socket object that is connected to the peer
+        :param file: a file object opened for binary writing, or None to discard the content
+        :param header_buffer: optional reusable bytearray of HEADER.size bytes
+        :param buffer: optional reusable bytearray the payloads are received into
+        :param codec: name of the compression codec negotiated with the peer
+        :return: the TransferStats of the transfer
+        """
+        view = memoryview(buffer if buffer is not None else bytearray(RECEIVE_BUFFER_SIZE))
+        stats = TransferStats(None)
+        decompressor = None
+        error = None
+        while True:
+            opcode, flags, request_id, length = self.receive_header(active_socket, header_buffer)
+            if opcode == OP_END:
+                if error is not None:
+                    raise error
+                return stats
+            if opcode != OP_DATA:
+                raise ConnectionError("unexpected frame during transfer")
+            if flags & FLAG_COMPRESSED:
+                if codec is None:
+                    raise ConnectionError("compressed data without a negotiated codec")
+                if decompressor is None:
+                    decompressor = StreamCodec(codec)
+                    stats.codec = codec
+                payload = self.receive_exactly(active_socket, bytearray(length))
+                if error is not None:
+                    continue
+                try:
+                    started = time.thread_time()
+                    data = decompressor.decompress(payload)
+                    stats.cpu_time += time.thread_time() - started
+                    if file is not None:
+                        file.write(data)
+                except ConnectionError:
+                    raise
+                except (OSError, ValueError) as exception:
+                    error = exception
+                    continue
+                stats.add(len(data), length)
+                continue
+            while length:
+                chunk = view[:min(length, len(view))]
+                self.receive_exactly(active_socket, chunk)
+                length -= len(chunk)
+                if error is not None:
+                    continue
+                try:
+                    if file is not None:
+                        file.write(chunk)
+                except ConnectionError:
+                    raise
+                except (OSError, ValueError) as exception:
+                    error = exception
+                    continue
+                stats.add(len(chunk), len(chunk))
+
+    def discard_stream(self, active_socket, header_buffer=None, buffer=None, codec=None):
+        """
+        Reads and drops OP_DATA frames up to and including the terminating OP_END frame.
+        :param active_socket: a socket object that is connected to the peer
+        :param header_buffer: optional reusable bytearray of HEADER.size bytes
+        :param buffer: optional reusable bytearray the payloads are received into
+        :param codec: name of the compression codec negotiated with the peer
+        """
+        self.receive_stream(active_socket, None, header_buffer, buffer, codec)
+
+    @contextmanager
+    def admit_stream(self, session, service_socket, size):
+        """
+        admission.transfer() of an upload the client streams without waiting for an answer: a refused upload is read
+        to its end and dropped before the OP_BUSY answer, to keep the session in sync.
+        :param session: the Session the upload was received on
+        :param service_socket: active socket with the client to read the content from.
+        :param size: number of bytes the transfer moves, 0 when unknown
+        :raises ServerBusy: when the limits are reached
+        """
+        admitted = False
+        try:
+            with self.admission.transfer(size):
+                admitted = True
+                yield
+        except ServerBusy:
+            if not admitted:
+                self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                    session.compression)
+            raise
+
+    def locate(self, session, name):
+        """
+        Resolves a client supplied path against the session's working directory. Paths escaping the session root are
+        rejected, either by name or through a symbolic link.
+        :param session: the Session the path was received on
+        :param name: relative (or absolute, inside the root) path of a file or directory
+        :return: (path, dir_fd) to pass to the os functions: the name relative to the session's open working directory
+        descriptor where the platform supports dir_fd, the absolute path otherwise.
+        """
+        absolute = os.path.normpath(os.path.join(session.working_directory, name))
+        # The links are resolved as well, the components that do not exist yet are kept as they are
+        resolved = os.path.realpath(absolute)
+        for path in (absolute, resolved):
+            if os.path.commonpath([path, session.root]) != session.root:
+                raise PermissionError(f"{name}: outside of the served directory")
+            if any(os.path.commonpath([path, hidden]) == hidden for hidden in self.hidden_paths):
+                raise PermissionError(f"{name}: reserved by the server")
+        if session.dir_fd is None:
+            return absolute, None
+        return name, session.dir_fd
+
+    def absolute_path(self, session, name):
+        """
+        Same checks as locate(), for the operations that need a plain path.
+        :param session: the Session the path was received on
+        :param name: relative (or absolute, inside the root) path of a file or directory
+        :return: the normalized absolute path
+        """
+        self.locate(session, name)
+        return os.path.normpath(os.path.join(session.working_directory, name))
+
+    def listing_changed(self, session, *names):
+        """
+        Drops the cached listings of the directories holding the given paths, and the cached content of the paths,
+        after the server modified them, and brings their entries of the tree index up to date.
+        :param session: the Session the paths were received on
+        :param names: paths of the created / removed / renamed objects
+        """
+        for name in names:
+            path = self.absolute_path(session, name)
+            self.listing_cache.invalidate(os.path.dirname(path))
+            self.file_cache.invalidate(path)
+            self.tree_index.refresh(path)
+
+    def handle_cd(self, session, new_working_directory):
+        """
+        Handles the client cd commands. Reads the client command and changes the working directory of the session
+        accordingly. Only the session is affected, the process working directory is left alone.
+        :param session: the Session, holding the current working directory
         :param new_working_directory: name of the sub directory or '..' for parent
         :return: absolute path of new current working directory
         """
-        if new_working_directory == "..":
-            new_working_directory = os.path.join(current_working_directory, os.path.pardir)
-        os.chdir(new_working_directory)
-        curr_working_dir = os.getcwd()
-        return curr_working_dir
+        path = self.absolute_path(session, new_working_directory)
+        session.change_directory(path)
+        return session.working_directory
 
-    def handle_mkdir(self, current_working_directory, directory_name):
+    def handle_mkdir(self, session, directory_name):
         """
         Handles the client mkdir commands. Creates a new sub directory with the given name in the current working directory.
-        :param current_working_directory: string of current working directory
+        :param session: the Session, holding the current working directory
         :param directory_name: name of new sub directory
         """
-        path = os.path.join(current_working_directory, directory_name)
-        os.mkdir(path)
-        curr_working_dir = os.getcwd()
-        return curr_working_dir
+        path, dir_fd = self.locate(session, directory_name)
+        os.mkdir(path, dir_fd=dir_fd)
+        self.listing_changed(session, directory_name)
 
-    def handle_rm(self, current_working_directory, object_name):
+    def handle_rm(self, session, object_name):
         """
         Handles the client rm commands. Removes the given file or sub directory. Uses the appropriate removal method
         based on the object type (directory/file).
-        :param current_working_directory: string of current working directory
+        :param session: the Session, holding the current working directory
         :param object_name: name of sub directory or file to remove
         """
-        file_name = current_working_directory + "\\" + object_name
-        if os.path.isfile(file_name):
-            os.remove(file_name)
-        elif os.path.isdir(file_name):
-            shutil.rmtree(file_name)
+        path, dir_fd = self.locate(session, object_name)
+        if stat.S_ISDIR(os.stat(path, dir_fd=dir_fd, follow_symlinks=False).st_mode):
+            absolute = self.absolute_path(session, object_name)
+            if absolute == session.root:
+                raise PermissionError(f"{object_name}: cannot remove the served directory")
+            try:
+                shutil.rmtree(absolute)
+            finally:
+                self.listing_cache.invalidate(absolute, recursive=True)
+                self.file_cache.invalidate(absolute, recursive=True)
         else:
-            print("File not found..!")
+            os.unlink(path, dir_fd=dir_fd)
+        self.listing_changed(session, object_name)
 
-    def handle_ul(
-            self, current_working_directory, file_name, service_socket, eof_token
-    ):
+    def handle_ul(self, session, file_name, service_socket, eof_token, request_id=0, size=None, digest=None,
+                  archive=False):
         """
         Handles the client ul commands. First, it reads the payload, i.e. file content from the client, then creates the
         file in the current working directory.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the client.
-        :param current_working_directory: string of current working directory
+        The content arrives as OP_DATA frames terminated by an OP_END frame and is written to disk chunk by chunk, once
+        the server accepted the upload with an OP_RESULT frame ({"offset": 0}): a refused upload is only answered
+        with the OP_ERROR frame and the client sends no content. When the client announces the size (and optionally the sha256) of the file, the upload is resumable: it is
+        assembled in a partial file, the server first answers with an OP_RESULT frame giving the offset to continue
+        from, i.e. the size of the partial file left by an interrupted attempt, and the file only replaces its final
+        name once complete and verified. When the content store already holds a file with the announced sha256, the
+        OP_RESULT frame says so ("stored") and the file is linked from the store: the client sends no content.
+        A directory arrives as a tar archive, see receive_archive_upload().
+        :param session: the Session, holding the current working directory
         :param file_name: name of the file to be created.
         :param service_socket: active socket with the client to read the payload/contents from.
         :param eof_token: a token to indicate the end of the message.
+        :param request_id: id of the ul request
+        :param size: size of the file announced by the client
+        :param digest: hex sha256 of the file announced by the client
+        :param archive: the content is a tar archive of a directory (FLAG_ARCHIVE)
+        """
+        if archive:
+            self.receive_archive_upload(session, file_name, service_socket)
+            return
+        if size is not None:
+            self.receive_resumable_upload(session, file_name, service_socket, request_id, size, digest)
+            return
+        path, dir_fd = self.locate(session, file_name)
+        # The size of the content is unknown before it is received, the transfer only takes a slot
+        with self.admission.transfer(0):
+            # Write a new inode rather than truncating: the old file may be hardlinked into the content store
+            try:
+                os.unlink(path, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass
+            file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666, dir_fd=dir_fd), "wb")
+            self.send_frame(service_socket, OP_RESULT, json.dumps({"offset": 0}).encode(), request_id)
+            with file:
+                try:
+                    session.last_transfer = self.receive_stream(service_socket, file, session.header_buffer,
+                                                                 session.transfer_buffer, session.compression)
+                finally:
+                    self.listing_changed(session, file_name)
+
+    def receive_archive_upload(self, session, directory_name, service_socket):
+        """
+        Archive half of handle_ul(): the tar archive of a directory tree is extracted as it arrives (see TarExtractor)
+        into the directory, created if needed. Nothing is staged on disk, each file is written at its final path.
+        :param session: the Session, holding the current working directory
+        :param directory_name: name of the directory to extract the archive into.
+        :param service_socket: active socket with the client to read the archive from.
+        """
+        # The size of the tree is unknown before it is received, the transfer only takes a slot
+        with self.admit_stream(session, service_socket, 0):
+            try:
+                path = self.absolute_path(session, directory_name)
+                extractor = TarExtractor(path, self.hidden_paths)
+            except (OSError, ValueError):
+                # The client streams the archive regardless, keep the connection in sync
+                self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                    session.compression)
+                raise
+            try:
+                session.last_transfer = self.receive_stream(service_socket, extractor, session.header_buffer,
+                                                             session.transfer_buffer, session.compression)
+            except BaseException:
+                extractor.discard()
+                raise
+            else:
+                # Errors met while extracting are raised once the archive was read to its end
+                extractor.close()
+            finally:
+                self.listing_cache.invalidate(path, recursive=True)
+                self.file_cache.invalidate(path, recursive=True)
+                self.listing_changed(session, directory_name)
+
+    def receive_resumable_upload(self, session, file_name, service_socket, request_id, size, digest):
+        """
+        Resumable half of handle_ul().
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file to be created.
+        :param service_socket: active socket with the client to read the payload/contents from.
+        :param request_id: id of the ul request
+        :param size: size of the file announced by the client
+        :param digest: hex sha256 of the file announced by the client, or None
         """
-        file_data = service_socket.recv(409600)
-        curr = os.path.join(current_working_directory, file_name)
-        with open(curr, "wb") as file:
-            file.write(file_data)
-        return os.getcwd()
+        if digest is not None and not re.fullmatch(r"[0-9a-f]{64}", digest):
+            raise ValueError(f"invalid sha256: {digest}")
+        if digest is not None and self.content_store is not None:
+            stored_path = self.content_store.lookup(digest, size)
+            if stored_path is not None:
+                self.content_store.materialize(stored_path, self.absolute_path(session, file_name))
+                self.send_frame(service_socket, OP_RESULT, json.dumps({"offset": size, "stored": True}).encode(),
+                                request_id)
+                self.listing_changed(session, file_name)
+                return
+        partial_name = self.partial_upload_path(session, file_name, digest[:16] if digest else str(size))
+        partial_path, dir_fd = self.locate(session, partial_name)
+        with os.fdopen(os.open(partial_path, os.O_RDWR | os.O_CREAT, 0o666, dir_fd=dir_fd), "r+b") as file:
+            lock_upload(file.fileno(), file_name)
+            offset = os.fstat(file.fileno()).st_size
+            if offset > size:
+                file.truncate(0)
+                offset = 0
+            hasher = hashlib.sha256()
+            with self.admission.transfer(size - offset):
+                if digest is not None and offset:
+                    hash_file(file.fileno(), hasher, session.transfer_buffer, offset)
+                file.seek(offset)
+                self.send_frame(service_socket, OP_RESULT, json.dumps({"offset": offset}).encode(), request_id)
+                writer = HashingWriter(file, hasher if digest is not None else None)
+                try:
+                    session.last_transfer = self.receive_stream(service_socket, writer, session.header_buffer,
+                                                                 session.transfer_buffer, session.compression)
+                finally:
+                    file.flush()
+                    self.listing_changed(session, partial_name)
+            received = file.tell()
+            if received != size:
+                raise ValueError(f"incomplete upload: {received} of {size} bytes, ul again to resume")
+            if digest is not None and hasher.hexdigest() != digest:
+                os.unlink(partial_path, dir_fd=dir_fd)
+                raise ValueError("sha256 mismatch, the upload was discarded")
+            if digest is not None:
+                self.digest_cache.remember(os.fstat(file.fileno()), digest)
+        path, dir_fd = self.locate(session, file_name)
+        os.replace(partial_path, path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        self.listing_changed(session, file_name)
+        if digest is not None and self.content_store is not None:
+            self.content_store.add(self.absolute_path(session, file_name), digest)
 
-    def handle_dl(
-            self, current_working_directory, file_name, service_socket, eof_token
-    ):
+    def handle_dl(self, session, file_name, service_socket, eof_token, request_id=0, offset=0, length=None,
+                  verify=False, archive=False):
         """
         Handles the client dl commands. First, it loads the given file as binary, then sends it to the client via the
-        given socket.
-        :param current_working_directory: string of current working directory
+        given socket with send_file(), i.e. without reading it into memory. A directory is sent as a tar archive when
+        the client accepts one, see send_directory().
+        :param session: the Session, holding the current working directory
         :param file_name: name of the file to be sent to client
         :param service_socket: active service socket with the client
         :param eof_token: a token to indicate the end of the message.
+        :param request_id: id of the dl request
+        :param offset: first byte to send, for ranged downloads and resumes
+        :param length: number of bytes to send, None or 0 for the rest of the file
+        :param verify: first send an OP_RESULT frame with the size, mtime and sha256 of the whole file
+        :param archive: the client accepts a directory as a tar archive (FLAG_ARCHIVE)
+        """
+        path, dir_fd = self.locate(session, file_name)
+        cached = self.file_cache.get(self.absolute_path(session, file_name), path, dir_fd)
+        if cached is not None:
+            self.send_cached_file(session, file_name, cached, service_socket, request_id, offset, length, verify)
+            return
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        file_stats = os.fstat(fd)
+        if stat.S_ISDIR(file_stats.st_mode):
+            os.close(fd)
+            if not archive:
+                raise IsADirectoryError(f"{file_name}: is a directory")
+            if offset or length:
+                raise ValueError(f"{file_name}: a directory cannot be downloaded by range")
+            self.send_directory(session, file_name, service_socket, request_id)
+            return
+        with os.fdopen(fd, 'rb') as file:
+            size = file_stats.st_size
+            if offset > size:
+                raise ValueError(f"offset {offset} is past the end of {file_name}")
+            count = min(length, size - offset) if length else size - offset
+            with self.admission.transfer(count):
+                if verify:
+                    digest = self.digest_cache.digest(file.fileno(), session.transfer_buffer)
+                    info = {"size": size, "mtime": file_stats.st_mtime, "sha256": digest}
+                    self.send_frame(service_socket, OP_RESULT, json.dumps(info).encode(), request_id)
+                codec = choose_compression(file_name, file.fileno(), session.compression, session.transfer_buffer,
+                                           offset)
+                session.last_transfer = self.send_file(service_socket, file, request_id, offset, count, codec,
+                                                       session.transfer_buffer)
+
+    def send_cached_file(self, session, file_name, cached, service_socket, request_id, offset, length, verify):
+        """
+        handle_dl() of a file held by the FileCache: the content is sent from memory.
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file to be sent to client
+        :param cached: the CachedFile
+        :param service_socket: active service socket with the client
+        :param request_id: id of the dl request
+        :param offset: first byte to send
+        :param length: number of bytes to send, None or 0 for the rest of the file
+        :param verify: first send an OP_RESULT frame with the size, mtime and sha256 of the whole file
+        """
+        size = cached.stats.st_size
+        if offset > size:
+            raise ValueError(f"offset {offset} is past the end of {file_name}")
+        count = min(length, size - offset) if length else size - offset
+        with self.admission.transfer(count):
+            if verify:
+                digest = self.digest_cache.digest_in_memory(cached.stats, cached.data)
+                info = {"size": size, "mtime": cached.stats.st_mtime, "sha256": digest}
+                self.send_frame(service_socket, OP_RESULT, json.dumps(info).encode(), request_id)
+            codec = choose_compression(file_name, None, session.compression, None, offset,
+                                       cached.data[offset:offset + ENTROPY_SAMPLE_SIZE])
+            session.last_transfer = self.send_buffer(service_socket, cached.data, request_id, offset, count, codec)
+
+    def send_directory(self, session, directory_name, service_socket, request_id):
+        """
+        handle_dl() of a directory: an OP_RESULT frame tells the client an archive follows, then the tree is sent as a
+        tar archive generated as it is sent (see send_archive()), nothing is staged on disk.
+        :param session: the Session, holding the current working directory
+        :param directory_name: name of the directory to be sent to client
+        :param service_socket: active service socket with the client
+        :param request_id: id of the dl request
+        """
+        path = self.absolute_path(session, directory_name)
+        # The size of the tree is unknown before it is walked, the transfer only takes a slot
+        with self.admission.transfer(0):
+            self.send_frame(service_socket, OP_RESULT, json.dumps({"archive": "tar"}).encode(), request_id)
+            session.last_transfer = self.send_archive(service_socket, path, request_id, session.compression,
+                                                      session.transfer_buffer, self.hidden_paths)
+
+    def partial_upload_path(self, session, file_name, upload_id):
+        """
+        Name of the hidden file a striped upload is assembled in, next to its final location so the final rename is
+        atomic.
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file being uploaded
+        :param upload_id: identifier chosen by the client, shared by all the stripes of the upload
+        :return: path relative to the working directory
+        """
+        if not upload_id.isalnum():
+            raise ValueError(f"invalid upload id: {upload_id}")
+        directory, name = os.path.split(file_name)
+        return os.path.join(directory, f".{name}.{upload_id}.part")
+
+    def handle_ul_range(self, session, upload_id, offset, length, total_size, file_name, service_socket):
+        """
+        Handles the client ulrange commands, one stripe of a parallel upload. The partial file is created at its final
+        size on first use, then the received content is written at the given offset with pwrite(), so the stripes can
+        arrive concurrently on several sessions.
+        :param session: the Session, holding the current working directory
+        :param upload_id: identifier shared by all the stripes of the upload
+        :param offset: position of the stripe in the file
+        :param length: size of the stripe
+        :param total_size: size of the complete file
+        :param file_name: name of the file being uploaded
+        :param service_socket: active socket with the client to read the stripe from.
+        """
+        try:
+            if offset < 0 or length < 0 or offset + length > total_size:
+                raise ValueError(f"range {offset}+{length} outside of a {total_size} bytes file")
+        except ValueError:
+            self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                session.compression)
+            raise
+        with self.admit_stream(session, service_socket, length):
+            try:
+                path, dir_fd = self.locate(session, self.partial_upload_path(session, file_name, upload_id))
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666, dir_fd=dir_fd)
+            except (OSError, ValueError):
+                self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                    session.compression)
+                raise
+            try:
+                try:
+                    preallocate(fd, total_size)
+                except OSError:
+                    self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                        session.compression)
+                    raise
+                writer = OffsetWriter(fd, offset, offset + length)
+                session.last_transfer = self.receive_stream(service_socket, writer, session.header_buffer,
+                                                             session.transfer_buffer, session.compression)
+            finally:
+                os.close(fd)
+
+    def handle_ul_commit(self, session, upload_id, total_size, file_name):
+        """
+        Handles the client ulcommit commands: once all the stripes are written, the partial file is renamed to its final
+        name.
+        :param session: the Session, holding the current working directory
+        :param upload_id: identifier shared by all the stripes of the upload
+        :param total_size: size of the complete file
+        :param file_name: name of the uploaded file
+        """
+        partial_path, dir_fd = self.locate(session, self.partial_upload_path(session, file_name, upload_id))
+        size = os.stat(partial_path, dir_fd=dir_fd).st_size
+        if size != total_size:
+            raise ValueError(f"incomplete upload: {size} of {total_size} bytes")
+        path, dir_fd = self.locate(session, file_name)
+        os.replace(partial_path, path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        self.listing_changed(session, file_name)
+
+    def handle_match(self, session, pattern):
+        """
+        Handles the client match commands. Lists the files of the current working directory matching a glob pattern.
+        :param session: the Session, holding the current working directory
+        :param pattern: shell style pattern, e.g. '*.jpg'
+        :return: list of [name, size] pairs
+        """
+        matches = []
+        with os.scandir(session.working_directory) as entries:
+            for entry in entries:
+                if entry.is_file() and fnmatch.fnmatchcase(entry.name, pattern):
+                    matches.append([entry.name, entry.stat().st_size])
+        return sorted(matches)
+
+    def handle_find(self, session, pattern):
+        """
+        Handles the client find commands: searches the tree below the working directory for the files and directories
+        whose name matches a glob pattern, from the TreeIndex.
+        :param session: the Session, holding the current working directory
+        :param pattern: shell style pattern, e.g. '*.jpg'
+        :return: {"matches": sorted [relative path, size] pairs, size None for directories (their path ends with '/'),
+            "truncated": whether more than FIND_MAX_RESULTS matched}
+        """
+        matches, truncated = self.tree_index.find(session.working_directory, pattern)
+        return {"matches": matches, "truncated": truncated}
+
+    def handle_du(self, session, directory_name):
+        """
+        Handles the client du commands: disk usage of a directory tree, from the TreeIndex.
+        :param session: the Session, holding the current working directory
+        :param directory_name: the directory, relative to the working directory
+        :return: output of TreeIndex.du()
+        """
+        return self.tree_index.du(self.absolute_path(session, directory_name))
+
+    def handle_tree(self, session, directory_name):
+        """
+        Handles the client tree commands, the first step of a sync: lists the files of a directory tree.
+        :param session: the Session, holding the current working directory
+        :param directory_name: the directory, relative to the working directory
+        :return: {"files": {relative path: [size, mtime_ns]}, "directories": [relative path, ...]}
+        """
+        path = self.absolute_path(session, directory_name)
+        if not os.path.isdir(path):
+            raise NotADirectoryError(f"{directory_name}: not a directory")
+        files, directories = walk_tree(path, self.hidden_paths)
+        return {"files": files, "directories": directories}
+
+    def handle_sigs(self, session, file_name):
+        """
+        Handles the client sigs commands: the block signatures of a file the client is about to patch.
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file
+        :return: the output of file_signatures()
+        """
+        path, dir_fd = self.locate(session, file_name)
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            return file_signatures(fd)
+        finally:
+            os.close(fd)
+
+    def handle_patch(self, session, file_name, size, mtime_ns, block_size, service_socket):
+        """
+        Handles the client patch commands, the upload half of a sync. The client streams delta records against the
+        signatures sent by handle_sigs() (block_size 0 when the server has no version of the file). The new version is
+        rebuilt in a partial file next to the file, given the client's mtime so an unchanged file is skipped by the
+        next sync, and renamed over the file. Missing parent directories are created.
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file
+        :param size: size of the new version
+        :param mtime_ns: modification time of the new version, in nanoseconds
+        :param block_size: block size of the signatures the delta refers to, 0 for none
+        :param service_socket: active socket with the client to read the delta from.
         """
-        file = open(os.path.join(current_working_directory, file_name), 'rb')
-        service_socket.sendall(file.read() + eof_token.encode())
+        with self.admit_stream(session, service_socket, size):
+            base_fd = None
+            try:
+                path, dir_fd = self.locate(session, file_name)
+                os.makedirs(os.path.dirname(self.absolute_path(session, file_name)), exist_ok=True)
+                partial_path, _ = self.locate(session, self.partial_upload_path(session, file_name, "sync"))
+                if block_size:
+                    base_fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+                fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT, 0o666, dir_fd=dir_fd)
+                try:
+                    lock_upload(fd, file_name)
+                    os.ftruncate(fd, 0)
+                except OSError:
+                    os.close(fd)
+                    raise
+                file = os.fdopen(fd, "wb")
+            except OSError:
+                if base_fd is not None:
+                    os.close(base_fd)
+                self.discard_stream(service_socket, session.header_buffer, session.transfer_buffer,
+                                    session.compression)
+                raise
+            try:
+                with file:
+                    writer = DeltaWriter(base_fd, block_size, file)
+                    session.last_transfer = self.receive_stream(service_socket, writer, session.header_buffer,
+                                                                 session.transfer_buffer, session.compression)
+                    writer.close()
+                if writer.size != size:
+                    raise ValueError(f"patch of {file_name} rebuilt {writer.size} of {size} bytes")
+                os.utime(partial_path, ns=(mtime_ns, mtime_ns), dir_fd=dir_fd)
+                os.replace(partial_path, path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            except (OSError, ValueError):
+                try:
+                    os.unlink(partial_path, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+                raise
+            finally:
+                if base_fd is not None:
+                    os.close(base_fd)
+                self.listing_changed(session, file_name)
 
-    def handle_info(self, current_working_directory, file_name):
+    def handle_delta(self, session, file_name, service_socket, request_id):
         """
-        Handles the client info commands. Reads the size of a given file.
-        :param current_working_directory: string of current working directory
+        Handles the client delta commands, the download half of a sync. The client streams the signatures of its
+        version of the file (see file_signatures()), the server answers with an OP_RESULT frame giving the size and
+        mtime of the file, then the delta records rebuilding it.
+        :param session: the Session, holding the current working directory
+        :param file_name: name of the file
+        :param service_socket: active service socket with the client
+        :param request_id: id of the delta request
+        """
+        signatures = io.BytesIO()
+        self.receive_stream(service_socket, signatures, session.header_buffer, session.transfer_buffer,
+                            session.compression)
+        path, dir_fd = self.locate(session, file_name)
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            file_stats = os.fstat(fd)
+            with self.admission.transfer(file_stats.st_size):
+                info = {"size": file_stats.st_size, "mtime_ns": file_stats.st_mtime_ns}
+                self.send_frame(service_socket, OP_RESULT, json.dumps(info).encode(), request_id)
+                codec = choose_compression(file_name, fd, session.compression, session.transfer_buffer)
+                session.last_transfer = self.send_delta(service_socket, fd, signatures.getvalue(), request_id,
+                                                        codec)
+        finally:
+            os.close(fd)
+
+    def handle_info(self, session, file_name):
+        """
+        Handles the client info commands. Reads the size, modification time and sha256 of a given file. The sha256 is
+        computed in chunks and cached, so asking again about an unchanged file does not read it again.
+        :param session: the Session, holding the current working directory
         :param file_name: name of sub directory or file to remove
+        :return: dict with the size in bytes, the mtime and the hex sha256 (None for directories)
         """
-        path = os.path.join(current_working_directory, file_name)
-        file_stats = os.stat(path)
+        path, dir_fd = self.locate(session, file_name)
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            file_stats = os.fstat(fd)
+            digest = None
+            if stat.S_ISREG(file_stats.st_mode):
+                digest = self.digest_cache.digest(fd, session.transfer_buffer)
+        finally:
+            os.close(fd)
 
-        return os.getcwd(), file_stats.st_size
+        return {"size": file_stats.st_size, "mtime": file_stats.st_mtime, "sha256": digest}
 
-    def handle_mv(self, current_working_directory, file_name, destination_name):
+    def handle_mv(self, session, file_name, destination_name):
         """
         Handles the client mv commands. First, it looks for the file in the current directory, then it moves or renames
-        to the destination file depending on the nature of the request.
-        :param current_working_directory: string of current working directory
+        to the destination file depending on the nature of the request. Files and directories can be moved to any
+        directory of the tree; when the destination is on another filesystem (a mount point below the served
+        directory), the object is copied as cp does, then removed.
+        :param session: the Session, holding the current working directory
         :param file_name: name of the file tp be moved / renamed
         :param destination_name: destination directory or new filename
         """
-        source_path = os.path.join(current_working_directory, file_name)
-        destination_path = os.path.join(current_working_directory + "\\" + destination_name + "\\", file_name)
-        if os.path.isdir(destination_name):
-            os.rename(source_path, destination_path)
-        elif os.path.isfile(file_name):
-            destination_path = os.path.join(current_working_directory, destination_name)
-            os.rename(source_path, destination_path)
-        return os.getcwd()
+        source_path, source_dir_fd = self.locate(session, file_name)
+        destination_path, destination_dir_fd = self.locate(session, destination_name)
+        try:
+            is_directory = stat.S_ISDIR(os.stat(destination_path, dir_fd=destination_dir_fd).st_mode)
+        except FileNotFoundError:
+            is_directory = False
+        if is_directory:
+            destination_name = os.path.join(destination_name, os.path.basename(os.path.normpath(file_name)))
+            destination_path, destination_dir_fd = self.locate(session, destination_name)
+        source = self.absolute_path(session, file_name)
+        try:
+            os.rename(source_path, destination_path, src_dir_fd=source_dir_fd, dst_dir_fd=destination_dir_fd)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            self.copy_tree(source, self.absolute_path(session, destination_name))
+            if os.path.isdir(source):
+                shutil.rmtree(source)
+            else:
+                os.unlink(source)
+        finally:
+            self.listing_cache.invalidate(source, recursive=True)
+            self.file_cache.invalidate(source, recursive=True)
+            self.listing_changed(session, file_name, destination_name)
 
+    def handle_cp(self, session, source_name, destination_name, recursive=False):
+        """
+        Handles the client cp commands: copies a file, or a directory tree with -r, within the server, no content
+        crossing the wire. The copy is assembled under a hidden name next to its destination and renamed into place
+        once complete, so a failed copy leaves nothing behind; see copy_tree().
+        :param session: the Session, holding the current working directory
+        :param source_name: name of the file or directory to copy
+        :param destination_name: destination directory or name of the copy
+        :param recursive: copy directories (cp -r)
+        :return: dict with the number of "files" and "directories" copied and their "bytes"
+        """
+        source = self.absolute_path(session, source_name)
+        destination = self.absolute_path(session, destination_name)
+        if os.path.isdir(destination):
+            destination_name = os.path.join(destination_name, os.path.basename(source))
+            destination = self.absolute_path(session, destination_name)
+        if os.path.isdir(source):
+            if not recursive:
+                raise IsADirectoryError(f"{source_name}: is a directory, use cp -r")
+            if os.path.commonpath([source, destination]) == source:
+                raise ValueError(f"cannot copy {source_name} into itself")
+        try:
+            return self.copy_tree(source, destination)
+        finally:
+            self.listing_cache.invalidate(destination, recursive=True)
+            self.file_cache.invalidate(destination, recursive=True)
+            self.listing_changed(session, destination_name)
 
-class ClientThread(Thread):
-    def __init__(self, server: Server, service_socket: socket.socket, address: str, eof_token: str):
-        Thread.__init__(self)
-        self.server_obj = server
-        self.service_socket = service_socket
-        self.address = address
-        self.eof_token = eof_token
+    def copy_tree(self, source, destination):
+        """
+        Copies a file or a directory tree to a new path: into a hidden temporary path next to the destination, renamed
+        over the destination once complete. The files are copied with copy_file(), those of a tree in parallel on the
+        copy pool. Partial transfers (*.part) and the hidden paths are left out, symbolic links are copied as links;
+        a link pointing outside of the served directory fails the copy.
+        :param source: absolute path of the file or directory
+        :param destination: absolute path of the copy; an existing file is replaced, a directory must be empty
+        :return: dict with the number of "files" and "directories" copied and their "bytes"
+        """
+        directory, name = os.path.split(destination)
+        temporary = os.path.join(directory, f".{name}.{secrets.token_hex(8)}.part")
+        summary = Counter(files=0, directories=0, bytes=0)
+        try:
+            if os.path.isdir(source):
+                self.copy_directory(source, temporary, summary)
+            else:
+                summary["bytes"] += copy_path(source, temporary)
+                summary["files"] += 1
+            os.replace(temporary, destination)
+        except BaseException:
+            if os.path.isdir(temporary) and not os.path.islink(temporary):
+                shutil.rmtree(temporary, ignore_errors=True)
+            elif os.path.lexists(temporary):
+                os.unlink(temporary)
+            raise
+        return dict(summary)
 
-    def run(self):
-        print("Connection from : ", self.address)
-        curr_working_dir = os.getcwd()
-        formatted_working_dir = self.server_obj.get_working_directory_info(curr_working_dir)
-        self.service_socket.sendall(str.encode(formatted_working_dir) + self.eof_token.encode())
-        while True:
-            client_command = self.server_obj.receive_message_ending_with_token(self.service_socket, 1024,
-                                                                               self.eof_token)
-            print("Command: ", client_command)
-            if client_command.decode() == "exit":
-                break
-            elif "cd" in client_command.decode():
-                new_working_dir = client_command.decode().split("cd")[1].strip()
-                curr_working_dir = self.server_obj.handle_cd(curr_working_dir, new_working_dir)
-            elif "mkdir" in client_command.decode():
-                new_working_dir = client_command.decode().split("mkdir")[1].strip()
-                curr_working_dir = self.server_obj.handle_mkdir(curr_working_dir, new_working_dir)
-            elif "rm" in client_command.decode():
-                object_name = client_command.decode().split("rm")[1].strip()
-                self.server_obj.handle_rm(curr_working_dir, object_name)
-            elif "mv" in client_command.decode():
-                arguments = client_command.decode().split("mv")[1].split(" ")
-                curr_working_dir = self.server_obj.handle_mv(curr_working_dir, arguments[1], arguments[2])
-            elif "info" in client_command.decode():
-                arguments = client_command.decode().split("info")[1].strip()
-                curr_working_dir, file_size = self.server_obj.handle_info(curr_working_dir, arguments)
-                self.service_socket.sendall(str.encode(str(file_size)))
-            elif "dl" in client_command.decode():
-                arguments = client_command.decode().split("dl")[1].strip()
-                self.server_obj.handle_dl(curr_working_dir, arguments, self.service_socket, self.eof_token)
-            elif "ul" in client_command.decode():
-                arguments = client_command.decode().split("ul")[1].strip()
-                curr_working_dir = self.server_obj.handle_ul(curr_working_dir, arguments, self.service_socket,
-                                                             self.eof_token)
-
-            time.sleep(1)
-            formatted_working_dir = self.server_obj.get_working_directory_info(os.getcwd())
-            self.service_socket.sendall(str.encode(formatted_working_dir) + self.eof_token.encode())
-        # establish working directory
-
-        # send the current dir info
-
-        # while True:
-        # get the command and arguments and call the corresponding method
-
-        # sleep for 1 second
-
-        # send current dir info
-
-        print('Connection closed from:', self.address)
-        self.service_socket.close()
-
-
-def run_server():
+    def copy_directory(self, source, destination, summary):
+        """
+        copy_tree() of a directory: the tree is walked and recreated while its files are copied in parallel.
+        :param source: absolute path of the directory
+        :param destination: absolute path of the copy, it must not exist
+        :param summary: Counter of the "files", "directories" and "bytes" copied
+        """
+        futures = []
+        try:
+            for current, subdirectories, file_names in os.walk(source):
+                # os.walk() lists the links to directories with the directories, without following them
+                links = [name for name in subdirectories if os.path.islink(os.path.join(current, name))]
+                subdirectories[:] = [name for name in subdirectories if name not in links
+                                     and os.path.join(current, name) not in self.hidden_paths]
+                target = os.path.normpath(os.path.join(destination, os.path.relpath(current, source)))
+                os.mkdir(target, stat.S_IMODE(os.stat(current).st_mode) | stat.S_IRWXU)
+                summary["directories"] += 1
+                for name in file_names + links:
+                    path = os.path.join(current, name)
+                    file_stats = os.lstat(path)
+                    if stat.S_ISLNK(file_stats.st_mode):
+                        link = os.readlink(path)
+                        # Where the copied link points to, relative links being resolved from the copy
+                        resolved = os.path.realpath(os.path.join(target, link))
+                        if os.path.commonpath([resolved, self.root]) != self.root:
+                            raise PermissionError(f"{os.path.relpath(path, self.root)}: links outside of the served "
+                                                  f"directory")
+                        os.symlink(link, os.path.join(target, name))
+                    elif stat.S_ISREG(file_stats.st_mode) and not name.endswith(".part"):
+                        futures.append(self.copy_pool.submit(copy_path, path, os.path.join(target, name)))
+            for future in futures:
+                summary["bytes"] += future.result()
+                summary["files"] += 1
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            raise
+
+    def handle_profile(self, action="dump", argument=None):
+        """
+        Handles the client profile commands, switching the sampling profiler on and off at runtime.
+        :param action: 'start', 'stop' or 'dump'
+        :param argument: sampling interval in ms for start, number of stacks for dump
+        :return: the profiler report, see SamplingProfiler.report()
+        """
+        if self.profiler is None:
+            raise ValueError("profiling is disabled, start the server with --profiling")
+        if action == "start":
+            self.profiler.start(float(argument) / 1000 if argument else PROFILER_INTERVAL)
+        elif action == "stop":
+            self.profiler.stop()
+        elif action != "dump":
+            raise ValueError(f"unknown profile action: {action}")
+        return self.profiler.report(int(argument) if action == "dump" and argument else 20)
+
+    def handle_limit(self, session, scope=None, rate=None):
+        """
+        Handles the client limit commands, reporting or changing the bandwidth limits at runtime:
+        'limit' reports them, 'limit <rate>' limits the client's own session (never above the server's session rate)
+        and, on a server started with --limit-control, 'limit global <rate>' / 'limit session <rate>' change the rate of
+        the whole server / of every session. Rates are in bytes per second, 0 is unlimited.
+        :param session: the Session the command was received on
+        :param scope: 'global', 'session' or the rate of the client's own session
+        :param rate: the new rate of the scope
+        :return: {"server": TrafficShaper.snapshot(), "session": SessionTraffic.snapshot() of the client's session}
+        """
+        if rate is None and scope is not None:
+            if scope in ("global", "session"):
+                raise ValueError(f"usage: limit {scope} <bytes per second>")
+            scope, rate = None, scope
+        if rate is not None:
+            rate = int(rate)
+            if rate < 0:
+                raise ValueError(f"invalid rate: {rate}")
+            if scope is None:
+                self.shaper.limit_session(session.traffic, rate)
+            elif not self.limit_control:
+                raise ValueError("changing the server limits is disabled, start the server with --limit-control")
+            elif scope == "global":
+                self.shaper.limit_server(rate)
+            elif scope == "session":
+                self.shaper.limit_sessions(rate, self.session_traffics())
+            else:
+                raise ValueError(f"unknown limit scope: {scope}")
+            logger.info("rate limit changed address=%s scope=%s rate=%s", session.address, scope or "own", rate)
+        return {"server": self.shaper.snapshot(self.session_traffics()),
+                "session": session.traffic.snapshot(time.monotonic())}
+
+    def queue_depths(self):
+        """
+        :return: the number of items waiting in the server's queues, by name
+        """
+        return {"log": sum(handler.queue.qsize() for handler in logger.handlers if isinstance(handler, QueueHandler)),
+                "admission": len(self.admission.waiting)}
+
+    def stats(self):
+        """
+        Handles the client stats commands.
+        :return: the metrics snapshot, see Metrics.snapshot()
+        """
+        figures = self.metrics.snapshot(self.queue_depths())
+        figures["pid"] = os.getpid()  # tells the worker processes apart, see Supervisor
+        figures["admission"] = self.admission.snapshot()
+        figures["file_cache"] = self.file_cache.snapshot()
+        figures["index"] = self.tree_index.snapshot()
+        figures["shaping"] = self.shaper.snapshot(self.session_traffics())
+        return figures
+
+    def session_traffics(self):
+        """
+        :return: the SessionTraffic of the active sessions
+        """
+        with self.metrics.lock:
+            return [session.traffic for session in self.metrics.sessions]
+
+    def metrics_text(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        return (self.metrics.prometheus_text(self.queue_depths()) + self.admission.prometheus_text()
+                + self.file_cache.prometheus_text() + self.shaper.prometheus_text(self.session_traffics()))
+
+    def execute_command(self, session, opcode, flags, request_id, payload):
+        """
+        Executes one command frame received on a session and sends the response frames.
+        :param session: the Session the command was received on
+        :param opcode: opcode of the received frame
+        :param flags: flags of the received frame
+        :param request_id: id of the request
+        :param payload: the command, e.g. b"mkdir test_dir"
+        :return: False once the client asked to exit, True otherwise
+        """
+        service_socket = session.service_socket
+        if opcode != OP_COMMAND:
+            self.send_frame(service_socket, OP_ERROR, b"expected a command", request_id)
+            return True
+        try:
+            client_command = payload.decode()
+        except UnicodeDecodeError:
+            self.send_frame(service_socket, OP_ERROR, b"command is not valid UTF-8", request_id)
+            return True
+        logger.debug("command address=%s request=%s command=%r", session.address, request_id, client_command)
+        command, _, arguments = client_command.partition(" ")
+        arguments = arguments.strip()
+        if command == "exit":
+            return False
+        session.last_transfer = None
+        session.commands += 1
+        session.in_command = True
+        session.traffic.bulk = command in BULK_COMMANDS
+        self.metrics.command_started()
+        started = time.perf_counter()
+        try:
+            try:
+                self.dispatch(session, command, arguments, flags, request_id)
+            except ServerBusy as busy:
+                self.send_frame(service_socket, OP_BUSY, busy_payload(str(busy), busy.retry_after), request_id)
+                self.metrics.observe(command, time.perf_counter() - started, True)
+                return True
+            except ConnectionError:
+                # The frames of the session are out of sync (or the client is gone), the session ends
+                self.metrics.observe(command if command in COMMANDS else "unknown", time.perf_counter() - started,
+                                     True)
+                raise
+            except (OSError, ValueError, IndexError) as error:
+                self.send_frame(service_socket, OP_ERROR, str(error).encode(), request_id)
+                self.metrics.observe(command if command in COMMANDS else "unknown", time.perf_counter() - started,
+                                     True)
+                return True
+            if session.last_transfer is not None:
+                logger.info("transfer address=%s command=%s %s", session.address, command, session.last_transfer)
+
+            # send current dir info
+            self.send_listing(session, request_id, session.working_directory, flags & LISTING_MASK)
+            self.metrics.observe(command, time.perf_counter() - started)
+        finally:
+            self.metrics.command_finished()
+            session.release_buffer()
+            session.traffic.bulk = False
+            session.in_command = False
+            session.last_active = time.monotonic()
+        return True
+
+    def dispatch(self, session, command, arguments, flags, request_id):
+        """
+        Runs the handle_* method of a command and sends its OP_RESULT / OP_DATA frames, leaving the final frames to
+        execute_command().
+        :param session: the Session the command was received on
+        :param command: the command name, e.g. 'mkdir'
+        :param arguments: the rest of the command line
+        :param flags: the OP_COMMAND flags
+        :param request_id: id of the request
+        """
+        service_socket = session.service_socket
+        if command == "cd":
+            self.handle_cd(session, arguments)
+        elif command == "mkdir":
+            self.handle_mkdir(session, arguments)
+        elif command == "rm":
+            self.handle_rm(session, arguments)
+        elif command == "mv":
+            arguments = arguments.split(" ")
+            self.handle_mv(session, arguments[0], arguments[1])
+        elif command == "cp":
+            # cp [-r] <source> <destination>
+            arguments = arguments.split(" ")
+            recursive = arguments[0] == "-r"
+            if recursive:
+                arguments = arguments[1:]
+            summary = self.handle_cp(session, arguments[0], arguments[1], recursive)
+            self.send_frame(service_socket, OP_RESULT, json.dumps(summary).encode(), request_id)
+        elif command == "info":
+            file_info = self.handle_info(session, arguments)
+            self.send_frame(service_socket, OP_RESULT, json.dumps(file_info).encode(), request_id)
+        elif command == "dl":
+            # dl <name> [<offset> <length>]
+            verify = bool(flags & FLAG_VERIFY)
+            archive = bool(flags & FLAG_ARCHIVE)
+            parts = arguments.rsplit(" ", 2)
+            if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                self.handle_dl(session, parts[0], service_socket, session.eof_token, request_id, int(parts[1]),
+                               int(parts[2]), verify, archive)
+            else:
+                self.handle_dl(session, arguments, service_socket, session.eof_token, request_id, verify=verify,
+                               archive=archive)
+        elif command == "ul":
+            # ul <name> [<size> [<sha256>]], or ul <name> with FLAG_ARCHIVE for a directory
+            parts = arguments.rsplit(" ", 2)
+            if flags & FLAG_ARCHIVE:
+                self.handle_ul(session, arguments, service_socket, session.eof_token, request_id, archive=True)
+            elif len(parts) == 3 and parts[1].isdigit() and len(parts[2]) == 64:
+                self.handle_ul(session, parts[0], service_socket, session.eof_token, request_id, int(parts[1]),
+                               parts[2])
+            elif len(parts) >= 2 and parts[-1].isdigit():
+                self.handle_ul(session, arguments.rsplit(" ", 1)[0], service_socket, session.eof_token,
+                               request_id, int(parts[-1]))
+            else:
+                self.handle_ul(session, arguments, service_socket, session.eof_token, request_id)
+        elif command == "ulrange":
+            # ulrange <upload id> <offset> <length> <total size> <name>
+            upload_id, offset, length, total_size, file_name = arguments.split(" ", 4)
+            self.handle_ul_range(session, upload_id, int(offset), int(length), int(total_size), file_name,
+                                 service_socket)
+        elif command == "ulcommit":
+            # ulcommit <upload id> <total size> <name>
+            upload_id, total_size, file_name = arguments.split(" ", 2)
+            self.handle_ul_commit(session, upload_id, int(total_size), file_name)
+        elif command == "match":
+            matches = self.handle_match(session, arguments or "*")
+            self.send_frame(service_socket, OP_RESULT, json.dumps(matches).encode(), request_id)
+        elif command == "tree":
+            tree = self.handle_tree(session, arguments or ".")
+            self.send_frame(service_socket, OP_RESULT, json.dumps(tree).encode(), request_id)
+        elif command == "find":
+            found = self.handle_find(session, arguments or "*")
+            self.send_frame(service_socket, OP_RESULT, json.dumps(found).encode(), request_id)
+        elif command == "du":
+            usage = self.handle_du(session, arguments or ".")
+            self.send_frame(service_socket, OP_RESULT, json.dumps(usage).encode(), request_id)
+        elif command == "sigs":
+            self.send_frame(service_socket, OP_RESULT, self.handle_sigs(session, arguments), request_id)
+        elif command == "patch":
+            # patch <size> <mtime_ns> <block size> <name>
+            size, mtime_ns, block_size, file_name = arguments.split(" ", 3)
+            self.handle_patch(session, file_name, int(size), int(mtime_ns), int(block_size), service_socket)
+        elif command == "delta":
+            self.handle_delta(session, arguments, service_socket, request_id)
+        elif command == "pwd":
+            self.send_frame(service_socket, OP_RESULT, session.working_directory.encode(), request_id)
+        elif command == "stats":
+            self.send_frame(service_socket, OP_RESULT, json.dumps(self.stats()).encode(), request_id)
+        elif command == "profile":
+            # profile start [<interval ms>] | profile stop | profile dump [<stacks>]
+            report = self.handle_profile(*arguments.split())
+            self.send_frame(service_socket, OP_RESULT, json.dumps(report).encode(), request_id)
+        elif command == "limit":
+            # limit [[global|session] <bytes per second>]
+            limits = self.handle_limit(session, *arguments.split()[:2])
+            self.send_frame(service_socket, OP_RESULT, json.dumps(limits).encode(), request_id)
+        else:
+            raise ValueError(f"unknown command: {command}")
+
+    def send_listing(self, session, request_id, working_directory, mode=LISTING_FULL):
+        """
+        Sends the working directory info followed by the OP_REPLY frame that completes the request. The info is sent in
+        pages of LISTING_PAGE_LINES lines, one OP_LISTING frame each.
+        :param session: the Session to answer on
+        :param request_id: id of the request being answered
+        :param working_directory: path to the directory
+        :param mode: LISTING_FULL, LISTING_NONE or LISTING_DELTA (changes since the last info sent on the session)
+        """
+        if mode != LISTING_NONE:
+            listing = self.listing_cache.get(working_directory)
+            if mode == LISTING_DELTA:
+                pages = listing.delta_pages(session.last_listing)
+            else:
+                pages = listing.pages()
+            for page in pages:
+                self.send_frame(session.service_socket, OP_LISTING, page, request_id)
+            session.last_listing = listing
+        self.send_frame(session.service_socket, OP_REPLY, b"", request_id)
+
+
+class DigestCache:
+    """
+    sha256 of files keyed by (device, inode, mtime, size): repeated info / verified dl requests on an unchanged file
+    do not read it again. The least recently used digests are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def key(file_stats):
+        return file_stats.st_dev, file_stats.st_ino, file_stats.st_mtime_ns, file_stats.st_size
+
+    def digest(self, fd, buffer):
+        """
+        :param fd: descriptor of an open regular file
+        :param buffer: reusable bytearray the file is read into on a cache miss
+        :return: the hex sha256 of the file
+        """
+        key = self.key(os.fstat(fd))
+        digest = self.lookup(key)
+        if digest is None:
+            digest = hash_file(fd, hashlib.sha256(), buffer, key[3]).hexdigest()
+            self.remember(key, digest)
+        return digest
+
+    def digest_in_memory(self, file_stats, data):
+        """
+        Same as digest(), for a file whose content is in memory, e.g. mapped by the FileCache.
+        :param file_stats: os.stat_result of the file
+        :param data: the content of the file
+        :return: the hex sha256 of the file
+        """
+        key = self.key(file_stats)
+        digest = self.lookup(key)
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+            self.remember(key, digest)
+        return digest
+
+    def lookup(self, key):
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None:
+                self.entries.move_to_end(key)
+            return digest
+
+    def remember(self, file_stats, digest):
+        """
+        Records a digest known without reading the file, e.g. the verified sha256 of an upload.
+        :param file_stats: os.stat_result of the file, or a key()
+        :param digest: hex sha256 of the file
+        """
+        key = file_stats if isinstance(file_stats, tuple) else self.key(file_stats)
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CachedFile:
+    """A file mapped by the FileCache: its os.stat_result and a memoryview of its content."""
+
+    __slots__ = ("stats", "data")
+
+    def __init__(self, file_stats, data):
+        self.stats = file_stats
+        self.data = data
+
+
+class FileCache:
+    """
+    Hot files mapped in memory, shared by the sessions: downloads of a cached file skip opening it, and are sent from
+    the mapping (see send_buffer()). Entries are keyed by absolute path and checked on every request against the
+    device, inode, size and mtime of the path, so a file replaced by an upload, another worker process or another
+    program is never served stale; the handlers modifying files also drop their entries (see listing_changed()).
+
+    A file is only mapped on its FILE_CACHE_ADMISSION-th request (recent request counts are kept in a bounded table)
+    and when it is at most max_file_size bytes, so one-off and large downloads do not evict the hot set. The least
+    recently used files are dropped beyond max_bytes. A dropped mapping is unmapped once no transfer uses it anymore.
+    The mappings share the page cache, several worker processes caching the same file do not hold it twice.
+
+    The server replaces files by renaming new inodes over them, which leaves the mappings intact; a cached file
+    truncated in place by another program would fault on access.
+    """
+
+    def __init__(self, max_bytes=FILE_CACHE_BYTES, max_file_size=FILE_CACHE_MAX_FILE_SIZE, max_requests=65536):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.max_requests = max_requests
+        self.entries = OrderedDict()  # path -> CachedFile
+        self.requests = OrderedDict()  # path -> number of requests, of the files not mapped yet
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def same_file(first, second):
+        return (first.st_dev, first.st_ino, first.st_size, first.st_mtime_ns) == (
+            second.st_dev, second.st_ino, second.st_size, second.st_mtime_ns)
+
+    def get(self, key, path, dir_fd=None):
+        """
+        :param key: absolute path of the file
+        :param path: path of the file to stat / open, relative to dir_fd
+        :param dir_fd: directory descriptor path is relative to, or None
+        :return: the up-to-date CachedFile of the file, or None when it is not cached: stream it from disk
+        """
+        if self.max_bytes <= 0:
+            return None
+        file_stats = os.stat(path, dir_fd=dir_fd)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                if self.same_file(cached.stats, file_stats):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return cached
+                self.drop(key)
+            self.misses += 1
+            requests = self.requests.pop(key, 0) + 1
+            if (requests < FILE_CACHE_ADMISSION or not stat.S_ISREG(file_stats.st_mode) or file_stats.st_size == 0
+                    or file_stats.st_size > min(self.max_file_size, self.max_bytes)):
+                self.requests[key] = requests
+                while len(self.requests) > self.max_requests:
+                    self.requests.popitem(last=False)
+                return None
+        cached = self.map(path, dir_fd, file_stats)
+        if cached is None:
+            return None
+        with self.lock:
+            if key in self.entries:  # mapped concurrently by another session
+                self.drop(key)
+            self.entries[key] = cached
+            self.bytes += file_stats.st_size
+            while self.bytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+        return cached
+
+    def map(self, path, dir_fd, file_stats):
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+        try:
+            if not self.same_file(os.fstat(fd), file_stats):
+                return None  # replaced since the stat, serve it from disk this time
+            return CachedFile(file_stats, memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ)))
+        finally:
+            os.close(fd)
+
+    def drop(self, key):
+        # Called with the lock held
+        self.bytes -= self.entries.pop(key).stats.st_size
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops the cached content of a file.
+        :param path: absolute path of the file
+        :param recursive: also drop the files below it, for a directory
+        """
+        with self.lock:
+            if path in self.entries:
+                self.drop(path)
+            self.requests.pop(path, None)
+            if recursive:
+                prefix = path.rstrip(os.sep) + os.sep
+                for cached in [cached for cached in self.entries if cached.startswith(prefix)]:
+                    self.drop(cached)
+
+    def snapshot(self):
+        """
+        :return: JSON serializable dict of the cache figures
+        """
+        with self.lock:
+            return {"files": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def prometheus_text(self):
+        """
+        :return: the cache figures in the Prometheus text exposition format
+        """
+        figures = self.snapshot()
+        return "\n".join([
+            "# TYPE fileserver_file_cache_bytes gauge", f"fileserver_file_cache_bytes {figures['bytes']}",
+            "# TYPE fileserver_file_cache_hits_total counter", f"fileserver_file_cache_hits_total {figures['hits']}",
+            "# TYPE fileserver_file_cache_misses_total counter",
+            f"fileserver_file_cache_misses_total {figures['misses']}",
+            "# TYPE fileserver_file_cache_evictions_total counter",
+            f"fileserver_file_cache_evictions_total {figures['evictions']}",
+        ]) + "\n"
+
+
+def clone_file(source, destination):
+    """
+    Creates `destination` as a copy-on-write clone (reflink) of `source` where the filesystem supports it, or as a
+    hardlink to it otherwise. Either way no data is copied.
+    :param source: path of an existing file
+    :param destination: path of the file to create, it must not exist
+    """
+    if fcntl is not None:
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                fcntl.ioctl(destination_fd, FICLONE, source_fd)
+                return
+            except OSError:
+                os.unlink(destination)  # no reflink support, fall back to a hardlink
+            finally:
+                os.close(destination_fd)
+        finally:
+            os.close(source_fd)
+    os.link(source, destination)
+
+
+def copy_file(source_fd, destination_fd):
+    """
+    Copies the content of a file within the server without passing it through user space: as a copy-on-write clone
+    (reflink) where the filesystem supports it, else with copy_file_range(), which lets the kernel (or the storage)
+    copy the data, else with sendfile().
+    :param source_fd: descriptor of the file to copy, opened for reading
+    :param destination_fd: descriptor of an empty file opened for writing
+    :return: number of bytes copied
+    """
+    size = os.fstat(source_fd).st_size
+    if fcntl is not None and size:
+        try:
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            return size
+        except OSError:
+            pass  # no reflink support, or another filesystem
+    copy_file_range = getattr(os, "copy_file_range", None)
+    copied = 0
+    while copied < size:
+        try:
+            if copy_file_range is not None:
+                count = copy_file_range(source_fd, destination_fd, size - copied, copied, copied)
+            else:
+                count = os.sendfile(destination_fd, source_fd, copied, size - copied)
+        except OSError as error:
+            if copy_file_range is None or error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                                               errno.EOPNOTSUPP):
+                raise
+            # Not supported between these files (older kernels, some filesystems): sendfile() writes at the position
+            copy_file_range = None
+            os.lseek(destination_fd, copied, os.SEEK_SET)
+            continue
+        if count == 0:
+            raise ValueError("file shrank during the copy")
+        copied += count
+    return copied
+
+
+def copy_path(source, destination):
+    """
+    Copies a regular file to a new path with copy_file(), keeping its mode and mtime.
+    :param source: path of the file
+    :param destination: path of the copy, it must not exist
+    :return: number of bytes copied
+    """
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        file_stats = os.fstat(source_fd)
+        destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IMODE(file_stats.st_mode))
+        try:
+            copied = copy_file(source_fd, destination_fd)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+    os.utime(destination, ns=(file_stats.st_atime_ns, file_stats.st_mtime_ns))
+    return copied
+
+
+class ContentStore:
+    """
+    Content-addressed store of the uploaded files. Every verified upload is cloned (reflink, or hardlink) to
+    objects/<sha256[:2]>/<sha256> and recorded in a persistent SQLite index mapping the digest to the object, so an
+    upload of content the server already holds becomes a clone of the object: no bytes cross the wire and no space is
+    used. The index survives restarts; an object whose size or mtime changed behind the server's back is forgotten.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self.connection = None
+        self.pid = None
+
+    def index(self):
+        """
+        :return: the SQLite connection of the index, opened lazily (and again after a fork)
+        """
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.join(self.directory, "objects"), exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), check_same_thread=False,
+                                              isolation_level=None, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                                    "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def lookup(self, digest, size):
+        """
+        :param digest: hex sha256 of the wanted content
+        :param size: size of the wanted content
+        :return: path of an intact stored object with that content, or None
+        """
+        with self.lock:
+            row = self.index().execute("SELECT path, size, mtime_ns FROM objects WHERE digest = ?",
+                                       (digest,)).fetchone()
+            if row is None:
+                return None
+            path, stored_size, mtime_ns = row
+            try:
+                object_stats = os.stat(path)
+            except FileNotFoundError:
+                object_stats = None
+            if object_stats is None or (object_stats.st_size, object_stats.st_mtime_ns) != (stored_size, mtime_ns) \
+                    or stored_size != size:
+                self.index().execute("DELETE FROM objects WHERE digest = ?", (digest,))
+                return None
+            return path
+
+    def add(self, path, digest):
+        """
+        Records a file whose sha256 was verified.
+        :param path: absolute path of the file
+        :param digest: hex sha256 of the file
+        """
+        object_path = self.object_path(digest)
+        # Other worker processes may add the same object concurrently
+        with self.lock, locked_file(os.path.join(self.directory, "lock")):
+            self.index()
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.unlink(object_path)  # a stale object, the index entry was dropped or is about to be replaced
+            except FileNotFoundError:
+                pass
+            try:
+                clone_file(path, object_path)
+            except OSError:
+                return  # e.g. the store is on another filesystem
+            object_stats = os.stat(object_path)
+            self.index().execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                                 (digest, object_path, object_stats.st_size, object_stats.st_mtime_ns))
+
+    def materialize(self, object_path, path):
+        """
+        Creates (or replaces) a file with the content of a stored object.
+        :param object_path: path returned by lookup()
+        :param path: absolute path of the file to create
+        """
+        directory, name = os.path.split(path)
+        temporary_path = os.path.join(directory, f".{name}.{secrets.token_hex(8)}.link")
+        clone_file(object_path, temporary_path)
+        try:
+            os.replace(temporary_path, path)
+        except OSError:
+            os.unlink(temporary_path)
+            raise
+
+
+class DirectoryListing:
+    """Snapshot of the contents of one directory, built with a single os.scandir() pass."""
+
+    __slots__ = ("path", "mtime_ns", "directories", "files", "_pages", "_names")
+
+    def __init__(self, path, mtime_ns, hidden_paths=frozenset()):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.directories = []
+        self.files = []
+        self._pages = None
+        self._names = None
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if hidden_paths and entry.path in hidden_paths:
+                    continue
+                if entry.is_dir():
+                    self.directories.append(entry.name)
+                elif entry.is_file():
+                    self.files.append(entry.name)
+
+    def lines(self):
+        """
+        :return: the lines of the working directory info, see Server.get_working_directory_info()
+        """
+        lines = [f"Current Directory: {self.path}:", "|"]
+        lines.extend("-- " + name for name in self.directories or [""])
+        lines.extend("-- " + name for name in self.files or [""])
+        return lines
+
+    def pages(self):
+        """
+        :return: the encoded working directory info split in pages of LISTING_PAGE_LINES lines, built once per snapshot
+        """
+        if self._pages is None:
+            self._pages = paginate(self.lines())
+        return self._pages
+
+    def names(self):
+        """
+        :return: set of the entries, directories with a trailing '/'
+        """
+        if self._names is None:
+            self._names = frozenset([name + "/" for name in self.directories] + self.files)
+        return self._names
+
+    def delta_pages(self, previous):
+        """
+        Lists the entries added ('+') and removed ('-') since an earlier snapshot of the same directory. A full listing
+        is returned when there is no usable earlier snapshot.
+        :param previous: the DirectoryListing last sent to the client, or None
+        :return: the encoded pages
+        """
+        if previous is None or previous.path != self.path:
+            return self.pages()
+        if previous is self:
+            return paginate([f"Current Directory: {self.path}: (unchanged)"])
+        current, before = self.names(), previous.names()
+        lines = [f"Current Directory: {self.path}: (changes)", "|"]
+        lines.extend("+ " + name for name in current - before)
+        lines.extend("- " + name for name in before - current)
+        return paginate(lines)
+
+
+def paginate(lines):
+    """
+    Joins lines into encoded pages of at most LISTING_PAGE_LINES lines.
+    :param lines: list of strings
+    :return: list of bytes
+    """
+    return ["\n".join(lines[start:start + LISTING_PAGE_LINES]).encode()
+            for start in range(0, len(lines), LISTING_PAGE_LINES)]
+
+
+class ListingCache:
+    """
+    Directory listings shared by all sessions, keyed by directory. A listing is reused as long as the directory's mtime
+    is unchanged and the server did not modify the directory itself, so the directory is not rescanned after every
+    command. The least recently used listings are dropped beyond max_entries.
+    """
+
+    def __init__(self, hidden_paths=frozenset(), max_entries=1024, generations=None):
+        self.hidden_paths = hidden_paths  # left out of the listings, e.g. the content store
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # path -> (DirectoryListing, generation stamp it was built with)
+        self.lock = Lock()
+        # GenerationTable shared with the other worker processes, which invalidate through it
+        self.generations = generations
+
+    def get(self, path):
+        """
+        :param path: absolute path of a directory
+        :return: an up-to-date DirectoryListing of the directory
+        """
+        # The stamp is read before scanning, so a change made during the scan is noticed by the next get()
+        stamp = self.generations.get(path) if self.generations is not None else 0
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            listing, listing_stamp = self.entries.get(path, (None, None))
+            if listing is not None and listing.mtime_ns == mtime_ns and listing_stamp == stamp:
+                self.entries.move_to_end(path)
+                return listing
+        # Scan outside of the lock, a concurrent scan of the same directory is harmless
+        listing = DirectoryListing(path, mtime_ns, self.hidden_paths)
+        with self.lock:
+            self.entries[path] = (listing, stamp)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return listing
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops the listing of a directory.
+        :param path: absolute path of the directory
+        :param recursive: also drop the listings of the directories below it
+        """
+        if self.generations is not None:
+            self.generations.bump(path)
+        with self.lock:
+            self.entries.pop(path, None)
+            if recursive:
+                prefix = path.rstrip(os.sep) + os.sep
+                for cached in [cached for cached in self.entries if cached.startswith(prefix)]:
+                    del self.entries[cached]
+
+
+class GenerationTable:
+    """
+    Change stamps of the directories in memory shared by the worker processes of a Supervisor (an anonymous mapping
+    inherited through fork()). A worker modifying a directory writes a new random stamp in the slot its path hashes to;
+    the listing caches of all the workers only reuse a listing while the stamp it was built with is unchanged. Every
+    write is a fresh value, so concurrent writers cannot bring a slot back to a value a cache still holds. Directories
+    sharing a slot merely cost an extra rescan.
+    """
+
+    def __init__(self, slots=GENERATION_SLOTS):
+        self.memory = mmap.mmap(-1, slots * 8)
+        self.stamps = memoryview(self.memory).cast("Q")
+        self.slots = slots
+
+    def slot(self, path):
+        return zlib.crc32(path.encode(errors="surrogateescape")) % self.slots
+
+    def get(self, path):
+        return self.stamps[self.slot(path)]
+
+    def bump(self, path):
+        self.stamps[self.slot(path)] = secrets.randbits(64)
+
+
+class IndexedDirectory:
+    """
+    A directory of the TreeIndex, stored compactly: the names of its files in one string, each preceded and followed
+    by a NUL (which no file name contains), their sizes in a parallel array, and its sub directories by name.
+    """
+
+    __slots__ = ("names", "sizes", "size", "directories")
+
+    def __init__(self, names=(), sizes=()):
+        self.names = "\0" + "".join(name + "\0" for name in names)
+        self.sizes = array("q", sizes)
+        self.size = sum(self.sizes)  # bytes of the files, sub directories excluded
+        self.directories = {}  # name -> IndexedDirectory
+
+    def set_file(self, name, size):
+        start = self.names.find("\0" + name + "\0")
+        if start < 0:
+            self.names += name + "\0"
+            self.sizes.append(size)
+        else:
+            index = self.names.count("\0", 0, start)
+            self.size -= self.sizes[index]
+            self.sizes[index] = size
+        self.size += size
+
+    def remove_file(self, name):
+        start = self.names.find("\0" + name + "\0")
+        if start >= 0:
+            self.size -= self.sizes.pop(self.names.count("\0", 0, start))
+            self.names = self.names[:start] + self.names[start + len(name) + 1:]
+
+    def walk(self, prefix=""):
+        """
+        :param prefix: relative path of this directory, ending with '/' unless empty
+        :return: iterator over the (relative path, IndexedDirectory) of this directory and every directory below it
+        """
+        stack = [(prefix, self)]
+        while stack:
+            prefix, directory = stack.pop()
+            yield prefix, directory
+            stack.extend((prefix + name + "/", child) for name, child in directory.directories.items())
+
+
+class TreeIndex:
+    """
+    In-memory index of the names and sizes of the served tree, answering find and du without touching the disk. It is
+    built in the background by a parallel walk (scandir() of many directories at once on a thread pool), then kept
+    current by refresh(): the handlers modifying the tree call it through listing_changed(), and a DirectoryWatcher
+    calls it for the changes made by other processes (other workers, other programs) where inotify is available.
+    Like walk_tree(), it leaves out links, special files, partial transfers (*.part) and the hidden paths.
+    A directory outside of the index (reached through a link, or with the index disabled) is scanned on demand.
+    """
+
+    def __init__(self, root, hidden_paths=frozenset(), enabled=True, workers=INDEX_WORKERS):
+        self.root = root
+        self.hidden_paths = hidden_paths
+        self.enabled = enabled
+        self.tree = None  # IndexedDirectory of the root, once built
+        self.lock = Lock()
+        self.ready = Event()  # set once the tree is built
+        self.backlog = []  # paths changed while the tree was being built
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="index")
+        self.watcher = None
+        self.scans = 0
+        self.refreshes = 0
+
+    def start(self):
+        """Builds the index on a background thread, and starts watching the tree where inotify is available."""
+        if not self.enabled or self.tree is not None:
+            return
+        if inotify_init1 is not None:
+            try:
+                self.watcher = DirectoryWatcher(self)
+            except OSError as error:
+                logger.warning("tree index not watching the tree: %s", error)
+        Thread(target=self.build, name="index", daemon=True).start()
+
+    def build(self):
+        started = time.perf_counter()
+        tree = self.scan(self.root)
+        with self.lock:
+            self.tree = tree
+            backlog, self.backlog = self.backlog, None
+        self.ready.set()
+        for path in backlog:
+            self.refresh(path)
+        snapshot = self.snapshot()
+        logger.info("tree index built directories=%s files=%s seconds=%.2f", snapshot["directories"],
+                    snapshot["files"], time.perf_counter() - started)
+        if self.watcher is not None:
+            self.watcher.start()
+
+    def excluded(self, path):
+        name = os.path.basename(path)
+        return name.endswith(".part") or any(os.path.commonpath([path, hidden]) == hidden
+                                             for hidden in self.hidden_paths)
+
+    def scan(self, path, watch=True):
+        """
+        Parallel walk of a directory tree.
+        :param path: absolute path of the directory
+        :param watch: watch each directory before listing it
+        :return: its IndexedDirectory, None if it is not a directory
+        """
+        self.scans += 1
+        futures = {self.pool.submit(self.scan_directory, path, watch): None}
+        tree = None
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent = futures.pop(future)
+                scanned = future.result()
+                if scanned is None:
+                    continue
+                directory_path, name, directory, subdirectories = scanned
+                if parent is None:
+                    tree = directory
+                else:
+                    parent.directories[name] = directory
+                for subdirectory in subdirectories:
+                    futures[self.pool.submit(self.scan_directory, os.path.join(directory_path, subdirectory),
+                                             watch)] = directory
+        return tree
+
+    def scan_directory(self, path, watch=True):
+        """
+        :return: (path, name, IndexedDirectory of the files, names of the sub directories), None if it is not a
+            directory (anymore)
+        """
+        if watch and self.watcher is not None:
+            self.watcher.watch(path)
+        names, sizes, subdirectories = [], [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.excluded(entry.path):
+                                subdirectories.append(entry.name)
+                        elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part"):
+                            sizes.append(entry.stat(follow_symlinks=False).st_size)
+                            names.append(entry.name)
+                    except OSError:
+                        continue  # removed while listed
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return path, os.path.basename(path), IndexedDirectory(names, sizes), subdirectories
+
+    def locate(self, path):
+        """
+        Called with the lock held.
+        :param path: absolute path of a directory
+        :return: its IndexedDirectory, or None when it is not in the index
+        """
+        if self.tree is None:
+            return None
+        relative = os.path.relpath(path, self.root)
+        if relative.startswith(".."):
+            return None
+        directory = self.tree
+        for name in relative.split(os.sep) if relative != "." else ():
+            directory = directory.directories.get(name)
+            if directory is None:
+                return None
+        return directory
+
+    def refresh(self, path):
+        """
+        Brings the entry of a path up to date after it was created, modified, removed or replaced: a file is stat'ed
+        again, a directory scanned again.
+        :param path: absolute path of the file or directory
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.backlog is not None:
+                self.backlog.append(path)
+                return
+        if path == self.root:
+            tree = self.scan(self.root)
+            with self.lock:
+                self.tree = tree
+            return
+        parent_path, name = os.path.split(path)
+        if os.path.commonpath([path, self.root]) != self.root or self.excluded(parent_path):
+            return
+        self.refreshes += 1
+        try:
+            file_stats = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            file_stats = None
+        excluded = self.excluded(path)
+        subtree = None
+        if file_stats is not None and stat.S_ISDIR(file_stats.st_mode) and not excluded:
+            subtree = self.scan(path)
+        with self.lock:
+            parent = self.locate(parent_path)
+            if parent is not None:
+                parent.directories.pop(name, None)
+                parent.remove_file(name)
+                if subtree is not None:
+                    parent.directories[name] = subtree
+                elif file_stats is not None and stat.S_ISREG(file_stats.st_mode) and not excluded:
+                    parent.set_file(name, file_stats.st_size)
+        if parent is None:
+            # A new directory holding the path, e.g. created by makedirs()
+            self.refresh(parent_path)
+
+    def lookup(self, path):
+        """
+        Waits for the index to be built.
+        :param path: absolute path of a directory
+        :return: the IndexedDirectory of the directory, scanned on the spot if it is not in the index
+        """
+        if self.enabled:
+            self.ready.wait()
+            with self.lock:
+                directory = self.locate(path)
+            if directory is not None:
+                return directory
+        if not os.path.isdir(path):
+            raise NotADirectoryError(f"{path}: not a directory")
+        return self.scan(path, watch=False)
+
+    def find(self, path, pattern, limit=FIND_MAX_RESULTS):
+        """
+        :param path: absolute path of the directory to search
+        :param pattern: shell style pattern matched against the names of the files and directories, e.g. '*.jpg'
+        :param limit: number of matches returned at most
+        :return: (sorted list of [relative path, size] pairs, size None for directories, True if truncated)
+        """
+        regex = re.compile("\0(" + glob_regex(pattern) + ")(?=\0)")
+        name_regex = re.compile(glob_regex(pattern))
+        matches = []
+        tree = self.lookup(path)
+        with self.lock:
+            for prefix, directory in tree.walk():
+                names = directory.names
+                index = position = 0
+                for match in regex.finditer(names):
+                    index += names.count("\0", position, match.start())
+                    position = match.start()
+                    matches.append([prefix + match.group(1), directory.sizes[index]])
+                for name in directory.directories:
+                    if name_regex.fullmatch(name):
+                        matches.append([prefix + name + "/", None])
+                if len(matches) > limit:
+                    break
+        return sorted(matches[:limit]), len(matches) > limit
+
+    def du(self, path):
+        """
+        :param path: absolute path of the directory
+        :return: dict of the "bytes", "files" and "directories" below the directory, and its sub directories as
+            [name, bytes] pairs ("entries"), largest first
+        """
+        directory = self.lookup(path)
+        with self.lock:
+            usage = {"bytes": directory.size, "files": len(directory.sizes), "directories": 0, "entries": []}
+            for name, child in directory.directories.items():
+                size = 0
+                for prefix, subdirectory in child.walk():
+                    size += subdirectory.size
+                    usage["files"] += len(subdirectory.sizes)
+                    usage["directories"] += 1
+                usage["entries"].append([name, size])
+                usage["bytes"] += size
+        usage["entries"].sort(key=lambda entry: (-entry[1], entry[0]))
+        return usage
+
+    def snapshot(self):
+        """
+        :return: JSON serializable dict of the index figures
+        """
+        figures = {"ready": self.ready.is_set(), "directories": 0, "files": 0, "scans": self.scans,
+                   "refreshes": self.refreshes}
+        with self.lock:
+            for prefix, directory in self.tree.walk() if self.tree is not None else ():
+                figures["directories"] += 1
+                figures["files"] += len(directory.sizes)
+        if self.watcher is not None:
+            figures.update(self.watcher.snapshot())
+        return figures
+
+
+class DirectoryWatcher:
+    """
+    Follows the changes made to the tree of a TreeIndex by other processes with inotify: every directory scanned by the
+    index is watched, and each event refreshes the path it names. When the kernel queue overflows, the whole tree is
+    scanned again. Watches are a per user resource (fs.inotify.max_user_watches): once exhausted, the rest of the tree
+    is only kept current by the server's own changes.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.fd = inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.paths = {}  # watch descriptor -> absolute path of the directory
+        self.lock = Lock()
+        self.exhausted = False
+        self.events = 0
+        self.overflows = 0
+
+    def watch(self, path):
+        if self.exhausted:
+            return
+        descriptor = inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self.exhausted = True
+                logger.warning("tree index out of inotify watches, see fs.inotify.max_user_watches")
+            return
+        with self.lock:
+            # A directory renamed and scanned again keeps its descriptor
+            self.paths[descriptor] = path
+
+    def start(self):
+        Thread(target=self.run, name="inotify", daemon=True).start()
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+            changed = {}
+            position = 0
+            while position < len(data):
+                descriptor, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, position)
+                name = data[position + INOTIFY_EVENT.size:position + INOTIFY_EVENT.size + length].rstrip(b"\0")
+                position += INOTIFY_EVENT.size + length
+                self.events += 1
+                if mask & IN_Q_OVERFLOW:
+                    self.overflows += 1
+                    changed[self.index.root] = None
+                    continue
+                with self.lock:
+                    directory = self.paths.pop(descriptor, None) if mask & IN_IGNORED else \
+                        self.paths.get(descriptor)
+                if directory is not None and name:
+                    changed[os.path.join(directory, os.fsdecode(name))] = None
+            # Events come in bursts, each path is refreshed once per burst
+            for path in changed:
+                try:
+                    self.index.refresh(path)
+                except OSError as error:
+                    logger.debug("tree index refresh failed path=%s error=%s", path, error)
+
+    def snapshot(self):
+        with self.lock:
+            return {"watches": len(self.paths), "events": self.events, "overflows": self.overflows,
+                    "watches_exhausted": self.exhausted}
+
+
+def glob_regex(pattern):
+    """
+    Translates a shell style pattern (*, ?, [seq], [!seq]) into a regular expression matching a single name, i.e. never
+    matching a NUL or a '/'. Matching is case sensitive, as fnmatchcase().
+    :param pattern: the pattern
+    :return: the regular expression, as a string
+    """
+    parts = []
+    position = 0
+    while position < len(pattern):
+        character = pattern[position]
+        position += 1
+        if character == "*":
+            parts.append("[^\0/]*")
+        elif character == "?":
+            parts.append("[^\0/]")
+        elif character == "[":
+            end = position
+            if pattern[end:end + 1] == "!":
+                end += 1
+            if pattern[end:end + 1] == "]":
+                end += 1
+            end = pattern.find("]", end)
+            if end < 0:
+                parts.append(re.escape(character))
+                continue
+            # a ']' leading the class would end it, a '[' or a doubled '&', '~' or '|' would read as a nested set or
+            # a set operation
+            members = re.sub(r"([\]\[&~|])", r"\\\1", pattern[position:end].replace("\\", "\\\\"))
+            position = end + 1
+            if members.startswith("!"):
+                parts.append("[^\0/" + members[1:] + "]")
+            else:
+                parts.append("[" + members.replace("^", "\\^") + "]")
+        else:
+            parts.append(re.escape(character))
+    return "".join(parts)
+
+
+def lock_upload(fd, file_name):
+    """
+    Takes an exclusive flock() on the partial file of an upload, so a concurrent upload of the same file, by another
+    session of this or another worker process, is refused instead of interleaving its writes. The lock is released
+    with the descriptor. Nothing is locked where fcntl is not available.
+    :param fd: descriptor of the partial file
+    :param file_name: name of the uploaded file, for the error message
+    """
+    if fcntl is None:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise BlockingIOError(errno.EWOULDBLOCK, f"{file_name}: another upload of this file is in progress") from None
+
+
+@contextmanager
+def locked_file(path):
+    """
+    Holds an exclusive flock() on the given file, created if needed, serializing a critical section between
+    processes. A no-op where fcntl is not available.
+    :param path: the lock file
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def create_listening_socket(host, port, reuse_port=False, listen=True):
+    """
+    Creates the TCP socket the server accepts connections on. SO_REUSEADDR lets a restarted server bind again while
+    connections of the previous one are in TIME_WAIT.
+    :param host: address to bind
+    :param port: port to bind, 0 for an ephemeral port
+    :param reuse_port: set SO_REUSEPORT, so several processes can bind the port and the kernel spreads the connections
+    :param listen: start listening; a socket only bound reserves the port
+    :return: the socket
+    """
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if os.name != "nt":  # on Windows SO_REUSEADDR would let another process steal the port
+            listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listening_socket.bind((host, port))
+        if listen:
+            listening_socket.listen(LISTEN_BACKLOG)
+    except BaseException:
+        listening_socket.close()
+        raise
+    return listening_socket
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets (LATENCY_BUCKETS), cheap enough to update on every command: a bisect and a few
+    additions under a lock of its own.
+    """
+
+    __slots__ = ("counts", "total", "errors", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # the last bucket is +Inf
+        self.total = 0.0
+        self.errors = 0
+        self.lock = Lock()
+
+    def observe(self, seconds, error=False):
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            if error:
+                self.errors += 1
+
+    def quantile(self, counts, fraction):
+        """
+        Upper bound of the bucket holding the given quantile.
+        :param counts: a copy of the bucket counts
+        :param fraction: e.g. 0.95
+        :return: seconds, None if nothing was observed
+        """
+        count = sum(counts)
+        if not count:
+            return None
+        rank = fraction * count
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + (math.inf,), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound if bound != math.inf else LATENCY_BUCKETS[-1]
+        return LATENCY_BUCKETS[-1]
+
+    def snapshot(self):
+        with self.lock:
+            counts, total, errors = list(self.counts), self.total, self.errors
+        return {"count": sum(counts), "errors": errors, "total_seconds": total, "buckets": counts,
+                "p50": self.quantile(counts, 0.5), "p95": self.quantile(counts, 0.95),
+                "p99": self.quantile(counts, 0.99)}
+
+
+class ServerBusy(Exception):
+    """Raised by a handler refusing a command for lack of capacity, answered with an OP_BUSY frame."""
+
+    def __init__(self, reason, retry_after=BUSY_RETRY_AFTER):
+        Exception.__init__(self, reason)
+        self.retry_after = retry_after
+
+
+def busy_payload(reason, retry_after):
+    """
+    :param reason: why the connection or command is refused
+    :param retry_after: seconds the client should wait before trying again
+    :return: payload of an OP_BUSY frame
+    """
+    return json.dumps({"reason": reason, "retry_after": retry_after}).encode()
+
+
+class ConnectionRejector:
+    """
+    Answers the connections refused by the admission control on a thread of its own, so that the accept loop never
+    waits for a refused client. The refused connections wait together in a selector for their hello, at most
+    REJECT_TIMEOUT seconds each, and whichever sends it first is answered first. Beyond REJECT_BACKLOG waiting
+    connections, more are closed without an answer.
+    """
+
+    def __init__(self, answer):
+        """
+        :param answer: called with (connection, reason) once the hello of a refused connection is readable
+        """
+        self.answer = answer
+        self.incoming = queue.SimpleQueue()
+        self.waiting = 0
+        self.lock = Lock()
+        self.thread = None
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_sender.setblocking(False)
+
+    def refuse(self, conn, reason):
+        """
+        :param conn: the accepted socket
+        :param reason: message of the OP_BUSY frame
+        """
+        with self.lock:
+            if self.waiting >= REJECT_BACKLOG:
+                conn.close()
+                return
+            self.waiting += 1
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="rejector", daemon=True)
+                self.thread.start()
+        self.incoming.put((conn, reason, time.monotonic() + REJECT_TIMEOUT))
+        try:
+            self.wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            pass  # the rejector has wakeups pending already
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        deadlines = deque()  # (deadline, connection), oldest first: every connection waits for the same timeout
+        while True:
+            timeout = max(0, deadlines[0][0] - time.monotonic()) if deadlines else None
+            for key, events in selector.select(timeout):
+                if key.fileobj is self.wakeup_receiver:
+                    self.wakeup_receiver.recv(4096)
+                    while not self.incoming.empty():
+                        conn, reason, deadline = self.incoming.get()
+                        selector.register(conn, selectors.EVENT_READ, reason)
+                        deadlines.append((deadline, conn))
+                else:
+                    selector.unregister(key.fileobj)
+                    self.finished()
+                    self.answer(key.fileobj, key.data)
+            now = time.monotonic()
+            while deadlines and (deadlines[0][0] <= now or deadlines[0][1].fileno() == -1):
+                deadline, conn = deadlines.popleft()
+                if conn.fileno() != -1:
+                    # No hello in time, closed without an answer
+                    selector.unregister(conn)
+                    self.finished()
+                    conn.close()
+
+    def finished(self):
+        with self.lock:
+            self.waiting -= 1
+
+
+class AdmissionControl:
+    """
+    Bounds the load a server process takes on, so that a burst of clients is turned away with OP_BUSY replies rather
+    than degrading everyone's service. A fixed number of sessions are served concurrently; further connections wait
+    in a FIFO queue for a slot, at most queue_timeout seconds, and are refused once the queue is full. Downloads and
+    uploads are admitted while fewer than max_transfers are in progress and the bytes they still have to move fit in
+    max_inflight_bytes (a transfer is always admitted when none is in progress, however large). Sessions without a
+    command for idle_timeout seconds are closed. max_sessions defaults to the limit of the engine, see
+    Server.default_max_sessions.
+    """
+
+    def __init__(self, max_sessions=None, max_pending=MAX_PENDING, queue_timeout=ADMISSION_TIMEOUT,
+                 max_transfers=MAX_TRANSFERS, max_inflight_bytes=MAX_INFLIGHT_BYTES, idle_timeout=IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.max_transfers = max_transfers
+        self.max_inflight_bytes = max_inflight_bytes
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.sessions = 0
+        self.waiting = deque()  # (connection, deadline), oldest first
+        self.transfers = 0
+        self.inflight_bytes = 0
+        self.refused = Counter()  # reason -> count
+        self.reaped = 0
+
+    def retry_after(self):
+        """:return: seconds a refused client should wait before trying again"""
+        return BUSY_RETRY_AFTER
+
+    def admit(self, connection):
+        """
+        Takes a session slot for a new connection, or queues it.
+        :param connection: opaque connection object, handed back by release() or expire()
+        :return: True if it got a slot, False if it was queued, None if it is refused
+        """
+        with self.lock:
+            if self.sessions < self.max_sessions:
+                self.sessions += 1
+                return True
+            if len(self.waiting) < self.max_pending:
+                self.waiting.append((connection, time.monotonic() + self.queue_timeout))
+                return False
+            self.refused["sessions"] += 1
+            return None
+
+    def release(self):
+        """
+        Frees the slot of an ended session, unless a waiting connection takes it over.
+        :return: (connection taking the slot or None, list of the waiting connections that timed out)
+        """
+        with self.lock:
+            expired = self._expire(time.monotonic())
+            if self.waiting:
+                return self.waiting.popleft()[0], expired
+            self.sessions -= 1
+            return None, expired
+
+    def expire(self, now):
+        """
+        :param now: time.monotonic()
+        :return: the waiting connections that timed out, removed from the queue
+        """
+        with self.lock:
+            return self._expire(now)
+
+    def _expire(self, now):
+        expired = []
+        # Every connection waits for the same timeout, the deadlines are in the order of the queue
+        while self.waiting and self.waiting[0][1] <= now:
+            expired.append(self.waiting.popleft()[0])
+        self.refused["queue_timeout"] += len(expired)
+        return expired
+
+    @contextmanager
+    def transfer(self, size):
+        """
+        Holds a transfer slot and `size` in-flight bytes for the duration of a transfer.
+        :param size: number of bytes the transfer moves
+        :raises ServerBusy: when the limits are reached
+        """
+        with self.lock:
+            if self.transfers >= self.max_transfers or (
+                    self.transfers and self.inflight_bytes + size > self.max_inflight_bytes):
+                self.refused["transfers"] += 1
+                raise ServerBusy("too many transfers in progress", self.retry_after())
+            self.transfers += 1
+            self.inflight_bytes += size
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.transfers -= 1
+                self.inflight_bytes -= size
+
+    def snapshot(self):
+        """
+        :return: JSON serializable dict of the admission figures
+        """
+        with self.lock:
+            return {"waiting": len(self.waiting), "transfers": self.transfers, "inflight_bytes": self.inflight_bytes,
+                    "refused": dict(self.refused), "reaped": self.reaped}
+
+    def prometheus_text(self):
+        """
+        :return: the admission figures in the Prometheus text exposition format
+        """
+        figures = self.snapshot()
+        lines = [
+            "# TYPE fileserver_transfers_active gauge", f"fileserver_transfers_active {figures['transfers']}",
+            "# TYPE fileserver_inflight_bytes gauge", f"fileserver_inflight_bytes {figures['inflight_bytes']}",
+            "# TYPE fileserver_sessions_reaped_total counter", f"fileserver_sessions_reaped_total {figures['reaped']}",
+            "# TYPE fileserver_refused_total counter",
+        ]
+        lines.extend(f'fileserver_refused_total{{reason="{reason}"}} {count}'
+                     for reason, count in sorted(figures["refused"].items()))
+        return "\n".join(lines) + "\n"
+
+
+class TokenBucket:
+    """
+    Token bucket of a bandwidth limit: tokens (bytes) accumulate at `rate` bytes per second, up to SHAPING_BURST
+    seconds worth of them. Taking more tokens than the bucket holds leaves it in debt, which delays the next taker
+    rather than the current one, so no chunk is ever too large to go through. A rate of None is unlimited.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate=None):
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate or None
+        self.burst = max(rate * SHAPING_BURST, SHAPING_QUANTUM) if rate else 0
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        :param now: time.monotonic()
+        :return: seconds until the bucket is out of debt, 0 if it is not in debt
+        """
+        self.refill(now)
+        if self.rate is None or self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, nbytes):
+        if self.rate is not None:
+            self.refill(time.monotonic())
+            self.tokens -= nbytes
+
+
+class RateMeter:
+    """
+    Measures the bytes per second moved in one direction over a sliding window of RATE_WINDOW seconds, approximated
+    from the bytes of the current fixed window and the rate of the previous one.
+    """
+
+    __slots__ = ("window_start", "window_bytes", "last_rate")
+
+    def __init__(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_rate = 0.0  # rate of the previous window
+
+    def add(self, nbytes):
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            self.last_rate = self.window_bytes / elapsed
+            self.window_start = now
+            self.window_bytes = 0
+        self.window_bytes += nbytes
+
+    def rate(self, now):
+        """
+        :param now: time.monotonic()
+        :return: bytes per second, decaying towards 0 once nothing is moved anymore
+        """
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            return self.window_bytes / elapsed
+        return self.last_rate * (1 - elapsed / RATE_WINDOW) + self.window_bytes / RATE_WINDOW
+
+
+class SessionTraffic:
+    """
+    Bandwidth shaping of one session, applied by its socket wrapper (MeteredSocket, AsyncSocketBridge) to every byte
+    the session sends or receives. While the session executes a bulk command (BULK_COMMANDS), its bytes wait for the
+    session's own token bucket and then for the server-wide one of the TrafficShaper, SHAPING_QUANTUM bytes at a time.
+    The bytes of the interactive commands are never delayed, they are only charged to the buckets, so that the
+    transfers make room for them.
+    """
+
+    __slots__ = ("shaper", "bucket", "requested_rate", "wakeup", "sent", "received", "bulk", "throttled_seconds")
+
+    def __init__(self, shaper):
+        self.shaper = shaper
+        self.bucket = TokenBucket(shaper.session_rate)
+        self.requested_rate = None  # limit the client set on its own session, see TrafficShaper.limit_session()
+        self.wakeup = Event()  # interrupts a wait for the session bucket when its rate changes
+        self.sent = RateMeter()
+        self.received = RateMeter()
+        self.bulk = False  # True while the session executes a bulk command
+        self.throttled_seconds = 0.0
+
+    def shaped(self):
+        return self.bulk and (self.bucket.rate is not None or self.shaper.bucket.rate is not None)
+
+    def apply_rate(self):
+        """Applies the lower of the server's session rate and the rate the client asked for."""
+        rates = [rate for rate in (self.shaper.session_rate, self.requested_rate) if rate]
+        self.bucket.set_rate(min(rates) if rates else None)
+        self.wakeup.set()
+
+    def throttle(self, nbytes):
+        """
+        Waits until the session and the server may move `nbytes` more bytes of a bulk transfer, and takes them.
+        """
+        started = time.monotonic()
+        delay = self.bucket.delay(started)
+        while delay > 0:
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            delay = self.bucket.delay(time.monotonic())
+        self.bucket.take(nbytes)
+        self.shaper.throttle(nbytes)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.throttled_seconds += waited
+            self.shaper.add_throttled(waited)
+
+    def charge(self, meter, nbytes):
+        """Accounts for bytes moved without waiting, those of interactive commands or of unlimited transfers."""
+        meter.add(nbytes)
+        self.bucket.take(nbytes)
+        if self.shaper.bucket.rate is not None:
+            self.shaper.charge(nbytes)
+
+    def sendall(self, send, data):
+        """
+        :param send: the sendall() of the underlying socket or stream
+        :param data: bytes-like data to send, in quanta when shaped
+        """
+        if not self.shaped():
+            send(data)
+            self.charge(self.sent, len(data))
+            return
+        view = memoryview(data).cast("B")
+        for start in range(0, len(view), SHAPING_QUANTUM):
+            chunk = view[start:start + SHAPING_QUANTUM]
+            self.throttle(len(chunk))
+            send(chunk)
+            self.sent.add(len(chunk))
+
+    def sendfile(self, sendfile, file, offset=0, count=None):
+        """
+        :param sendfile: the sendfile() of the underlying socket or event loop
+        :return: number of bytes sent
+        """
+        if not self.shaped():
+            sent = sendfile(file, offset, count)
+            self.charge(self.sent, sent)
+            return sent
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            length = min(SHAPING_QUANTUM, count - sent)
+            self.throttle(length)
+            length = sendfile(file, offset + sent, length)
+            if not length:
+                break
+            self.sent.add(length)
+            sent += length
+        return sent
+
+    def receive_size(self, nbytes):
+        """:return: bytes a recv_into() of at most nbytes may ask for, a quantum when shaped"""
+        return min(nbytes, SHAPING_QUANTUM) if self.shaped() else nbytes
+
+    def received_bytes(self, count):
+        # Received bytes are charged after the fact, throttling delays the next read and TCP slows the sender down
+        if self.shaped():
+            self.throttle(count)
+            self.received.add(count)
+        else:
+            self.charge(self.received, count)
+
+    def snapshot(self, now):
+        """
+        :param now: time.monotonic()
+        :return: JSON serializable dict of the session's rate limit and effective rates, in bytes per second
+        """
+        return {"rate_limit": self.bucket.rate, "send_rate": round(self.sent.rate(now)),
+                "receive_rate": round(self.received.rate(now)), "throttled_seconds": round(self.throttled_seconds, 3)}
+
+
+class TrafficShaper:
+    """
+    Shares the bandwidth of a server process between its sessions, so that bulk transfers cannot starve the
+    interactive commands. Every session has a token bucket of session_rate bytes per second (see SessionTraffic) and
+    all of them draw from a server-wide bucket of global_rate bytes per second. When the server-wide bucket runs dry,
+    the transfers queue for it: each one is granted a single quantum per turn then queues again behind the others, so
+    concurrent transfers are interleaved round robin whatever their size. The interactive commands skip the queue and
+    only put the bucket in debt. The rates (None is unlimited) can be changed while the server runs.
+    """
+
+    def __init__(self, global_rate=None, session_rate=None):
+        self.bucket = TokenBucket(global_rate)
+        self.session_rate = session_rate or None
+        self.condition = Condition()
+        self.turns = deque()  # Events of the transfers waiting for the bucket, the first one is served next
+        self.throttled_seconds = 0.0
+
+    def session(self):
+        """:return: the SessionTraffic of a new session"""
+        return SessionTraffic(self)
+
+    def charge(self, nbytes):
+        with self.condition:
+            self.bucket.take(nbytes)
+
+    def add_throttled(self, seconds):
+        with self.condition:
+            self.throttled_seconds += seconds
+
+    def throttle(self, nbytes):
+        """
+        Waits for the turn of the calling transfer and for the server-wide bucket to be out of debt, then takes
+        `nbytes` from it.
+        """
+        if self.bucket.rate is None:
+            return
+        with self.condition:
+            if not self.turns and self.bucket.delay(time.monotonic()) <= 0:
+                self.bucket.take(nbytes)
+                return
+            turn = Event()
+            self.turns.append(turn)
+            if len(self.turns) == 1:
+                turn.set()
+        turn.wait()
+        with self.condition:
+            delay = self.bucket.delay(time.monotonic())
+            while delay > 0:
+                self.condition.wait(delay)
+                delay = self.bucket.delay(time.monotonic())
+            self.bucket.take(nbytes)
+            self.turns.popleft()
+            if self.turns:
+                self.turns[0].set()
+
+    def limit_server(self, global_rate):
+        """
+        :param global_rate: bytes per second of all the sessions together, None or 0 for unlimited
+        """
+        with self.condition:
+            self.bucket.set_rate(global_rate)
+            self.condition.notify_all()
+
+    def limit_sessions(self, session_rate, traffics):
+        """
+        :param session_rate: bytes per second of every session, None or 0 for unlimited
+        :param traffics: the SessionTraffic of the active sessions
+        """
+        self.session_rate = session_rate or None
+        for traffic in traffics:
+            traffic.apply_rate()
+
+    @staticmethod
+    def limit_session(traffic, rate):
+        """
+        Limits a single session, at most to the server's session rate.
+        :param traffic: the SessionTraffic of the session
+        :param rate: bytes per second, None or 0 to only apply the server's session rate
+        """
+        traffic.requested_rate = rate or None
+        traffic.apply_rate()
+
+    def snapshot(self, traffics=()):
+        """
+        :param traffics: the SessionTraffic of the active sessions
+        :return: JSON serializable dict of the rate limits and of the effective rates, in bytes per second
+        """
+        now = time.monotonic()
+        with self.condition:
+            figures = {"global_rate": self.bucket.rate, "session_rate": self.session_rate, "waiting": len(self.turns),
+                       "throttled_seconds": round(self.throttled_seconds, 3)}
+        figures["send_rate"] = round(sum(traffic.sent.rate(now) for traffic in traffics))
+        figures["receive_rate"] = round(sum(traffic.received.rate(now) for traffic in traffics))
+        return figures
+
+    def prometheus_text(self, traffics=()):
+        """
+        :param traffics: the SessionTraffic of the active sessions
+        :return: the shaping figures in the Prometheus text exposition format
+        """
+        figures = self.snapshot(traffics)
+        lines = ["# TYPE fileserver_rate_limit_bytes gauge"]
+        lines.extend(f'fileserver_rate_limit_bytes{{scope="{scope}"}} {figures[scope + "_rate"] or 0}'
+                     for scope in ("global", "session"))
+        lines += [
+            "# TYPE fileserver_send_rate_bytes gauge", f"fileserver_send_rate_bytes {figures['send_rate']}",
+            "# TYPE fileserver_receive_rate_bytes gauge", f"fileserver_receive_rate_bytes {figures['receive_rate']}",
+            "# TYPE fileserver_shaping_waiting gauge", f"fileserver_shaping_waiting {figures['waiting']}",
+            "# TYPE fileserver_throttled_seconds_total counter",
+            f"fileserver_throttled_seconds_total {figures['throttled_seconds']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Counters of a server: a latency histogram per command, the commands in flight, the sessions and the bytes they
+    sent and received. Sessions count their bytes themselves (see MeteredSocket), the totals are summed when read.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.commands = {}  # command name -> Histogram
+        self.in_flight = 0
+        self.sessions = set()
+        self.sessions_total = 0
+        self.closed_bytes_in = 0
+        self.closed_bytes_out = 0
+
+    def observe(self, command, seconds, error=False):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            with self.lock:
+                histogram = self.commands.setdefault(command, Histogram())
+        histogram.observe(seconds, error)
+
+    def command_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def command_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def session_opened(self, session):
+        with self.lock:
+            self.sessions.add(session)
+            self.sessions_total += 1
+
+    def session_closed(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+                self.closed_bytes_in += session.service_socket.bytes_in
+                self.closed_bytes_out += session.service_socket.bytes_out
+
+    def snapshot(self, queues=None):
+        """
+        :param queues: current depth of the server's queues, by name
+        :return: JSON serializable dict of all the metrics
+        """
+        with self.lock:
+            sessions = list(self.sessions)
+            figures = {"sessions_active": len(sessions), "sessions_total": self.sessions_total,
+                       "commands_in_flight": self.in_flight}
+            bytes_in, bytes_out = self.closed_bytes_in, self.closed_bytes_out
+            commands = dict(self.commands)
+        figures["sessions"] = []
+        now = time.monotonic()
+        for session in sessions:
+            bytes_in += session.service_socket.bytes_in
+            bytes_out += session.service_socket.bytes_out
+            figures["sessions"].append({"address": str(session.address), "commands": session.commands,
+                                        "bytes_in": session.service_socket.bytes_in,
+                                        "bytes_out": session.service_socket.bytes_out,
+                                        **session.traffic.snapshot(now)})
+        figures["bytes_in"] = bytes_in
+        figures["bytes_out"] = bytes_out
+        figures["queues"] = queues or {}
+        figures["commands"] = {name: histogram.snapshot() for name, histogram in sorted(commands.items())}
+        return figures
+
+    def prometheus_text(self, queues=None):
+        """
+        :param queues: current depth of the server's queues, by name
+        :return: the metrics in the Prometheus text exposition format
+        """
+        figures = self.snapshot(queues)
+        lines = [
+            "# TYPE fileserver_sessions_active gauge", f"fileserver_sessions_active {figures['sessions_active']}",
+            "# TYPE fileserver_sessions_total counter", f"fileserver_sessions_total {figures['sessions_total']}",
+            "# TYPE fileserver_commands_in_flight gauge",
+            f"fileserver_commands_in_flight {figures['commands_in_flight']}",
+            "# TYPE fileserver_received_bytes_total counter", f"fileserver_received_bytes_total {figures['bytes_in']}",
+            "# TYPE fileserver_sent_bytes_total counter", f"fileserver_sent_bytes_total {figures['bytes_out']}",
+            "# TYPE fileserver_queue_depth gauge",
+        ]
+        lines.extend(f'fileserver_queue_depth{{queue="{name}"}} {depth}' for name, depth in figures["queues"].items())
+        lines.append("# TYPE fileserver_command_duration_seconds histogram")
+        for name, histogram in figures["commands"].items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (math.inf,), histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f'fileserver_command_duration_seconds_bucket{{command="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'fileserver_command_duration_seconds_sum{{command="{name}"}} {histogram["total_seconds"]}')
+            lines.append(f'fileserver_command_duration_seconds_count{{command="{name}"}} {histogram["count"]}')
+        lines.append("# TYPE fileserver_command_errors_total counter")
+        lines.extend(f'fileserver_command_errors_total{{command="{name}"}} {histogram["errors"]}'
+                     for name, histogram in figures["commands"].items())
+        return "\n".join(lines) + "\n"
+
+
+class MeteredSocket:
+    """
+    Socket wrapper counting the bytes a session sends and receives, for the metrics, and shaping them through the
+    session's SessionTraffic.
+    """
+
+    __slots__ = ("socket", "traffic", "bytes_in", "bytes_out")
+
+    def __init__(self, wrapped_socket, traffic):
+        self.socket = wrapped_socket
+        self.traffic = traffic
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def sendall(self, data):
+        self.traffic.sendall(self.socket.sendall, data)
+        self.bytes_out += len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        count = self.socket.recv_into(buffer, self.traffic.receive_size(nbytes or len(buffer)))
+        self.traffic.received_bytes(count)
+        self.bytes_in += count
+        return count
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = self.traffic.sendfile(self.socket.sendfile, file, offset, count)
+        self.bytes_out += sent
+        return sent
+
+    def shutdown(self):
+        # Wakes up the session thread blocked in recv_into(), which then ends the session
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that can be switched on and off while the server runs. A daemon thread samples the stacks of
+    all the other threads at a fixed interval and counts them in the collapsed format of flame graphs
+    ('file:function;file:function;...'). It costs nothing while stopped.
+    """
+
+    def __init__(self):
+        self.samples = Counter()
+        self.sample_count = 0
+        self.thread = None
+        self.stopping = Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=PROFILER_INTERVAL):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = Thread(target=self.run, args=(interval,), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self, interval):
+        own_ident = get_ident()
+        while not self.stopping.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def report(self, count=20):
+        """
+        :param count: number of stacks to return
+        :return: dict with the state of the profiler and the most sampled stacks
+        """
+        return {"running": self.running, "samples": self.sample_count,
+                "stacks": self.samples.most_common(count)}
+
+
+class BufferPool:
+    """
+    Transfer buffers shared by the sessions of a server. A session borrows one for the duration of a command that
+    moves file content and gives it back at the end of the command, so idle sessions hold no buffer at all.
+    """
+
+    def __init__(self, size=RECEIVE_BUFFER_SIZE, max_free=BUFFER_POOL_SIZE):
+        self.size = size
+        self.max_free = max_free
+        self.lock = Lock()
+        self.free = []
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+
+class Session:
+    """
+    State of one client connection, shared by the threaded and the asyncio server engines. Every session has its own
+    working directory, kept open as a descriptor so the handle_* methods can use dir_fd relative calls. Idle sessions
+    are kept cheap: the buffer of the file transfers is only borrowed from the BufferPool while a command runs.
+    """
+
+    def __init__(self, service_socket, address, eof_token, root, buffer_pool=None):
+        self.service_socket = service_socket
+        self.address = address
+        self.eof_token = eof_token
+        self.root = os.path.realpath(root)
+        self.working_directory = None
+        self.dir_fd = None
+        self.last_listing = None  # DirectoryListing last sent, the base of LISTING_DELTA replies
+        self.compression = None  # codec negotiated in the handshake
+        self.last_transfer = None  # TransferStats of the last file transfer
+        self.commands = 0
+        self.in_command = False
+        self.last_active = time.monotonic()  # end of the last command, for the idle timeout
+        self.traffic = service_socket.traffic  # SessionTraffic shaping the bandwidth of the session
+        self.header_buffer = bytearray(HEADER.size)
+        self.buffer_pool = buffer_pool or BufferPool()
+        self.borrowed_buffer = None
+        self.change_directory(self.root)
+
+    @property
+    def transfer_buffer(self):
+        """The buffer file transfers are received into, borrowed until release_buffer()"""
+        if self.borrowed_buffer is None:
+            self.borrowed_buffer = self.buffer_pool.acquire()
+        return self.borrowed_buffer
+
+    def release_buffer(self):
+        if self.borrowed_buffer is not None:
+            self.buffer_pool.release(self.borrowed_buffer)
+            self.borrowed_buffer = None
+
+    def change_directory(self, path):
+        """
+        Makes the given directory the session's working directory.
+        :param path: normalized absolute path of the directory
+        """
+        if DIR_FD_SUPPORTED:
+            dir_fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+            if self.dir_fd is not None:
+                os.close(self.dir_fd)
+            self.dir_fd = dir_fd
+        elif not os.path.isdir(path):
+            raise NotADirectoryError(f"{path}: not a directory")
+        self.working_directory = path
+
+    def close(self):
+        if self.dir_fd is not None:
+            os.close(self.dir_fd)
+            self.dir_fd = None
+
+
+class ClientThread(Thread):
+    def __init__(self, server: Server, service_socket: socket.socket, address: str, eof_token: str):
+        Thread.__init__(self)
+        self.server_obj = server
+        self.service_socket = MeteredSocket(service_socket, server.shaper.session())
+        self.address = address
+        self.eof_token = eof_token
+        self.session = Session(self.service_socket, address, eof_token, server.root, server.buffer_pool)
+
+    def run(self):
+        logger.info("session opened address=%s", self.address)
+        self.server_obj.metrics.session_opened(self.session)
+        try:
+            if self.server_obj.handshake(self.session) is None:
+                return
+            # send the current dir info
+            self.server_obj.send_listing(self.session, 0, self.session.working_directory)
+            while True:
+                # get the command and arguments and call the corresponding method
+                frame = self.server_obj.receive_frame(self.service_socket, self.session.header_buffer)
+                if not self.server_obj.execute_command(self.session, *frame):
+                    break
+        except ConnectionError as error:
+            logger.warning("connection lost address=%s error=%r", self.address, str(error))
+        finally:
+            self.server_obj.metrics.session_closed(self.session)
+            logger.info("session closed address=%s bytes_in=%s bytes_out=%s", self.address,
+                        self.service_socket.bytes_in, self.service_socket.bytes_out)
+            self.session.close()
+            self.service_socket.close()
+            self.server_obj.session_finished()
+
+
+class AsyncSocketBridge:
+    """
+    Blocking socket facade over a pair of asyncio streams. The handle_* methods run on executor threads and talk to
+    the client through this object exactly like they do through a socket in the threaded engine.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, loop, traffic):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.traffic = traffic  # the session's SessionTraffic
+        self.bytes_in = 0  # counted like MeteredSocket does, including the frames read by the event loop
+        self.bytes_out = 0
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def _sendall(self, data):
+        # The transport may keep a reference to the data, so reusable buffers are copied
+        self._run(self._write(bytes(data)))
+
+    def sendall(self, data):
+        self.traffic.sendall(self._sendall, data)
+        self.bytes_out += len(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        data = self._run(self.reader.read(self.traffic.receive_size(nbytes or len(view))))
+        view[:len(data)] = data
+        self.traffic.received_bytes(len(data))
+        self.bytes_in += len(data)
+        return len(data)
+
+    def _sendfile(self, file, offset, count):
+        return self._run(self.loop.sendfile(self.writer.transport, file, offset, count))
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = self.traffic.sendfile(self._sendfile, file, offset, count)
+        self.bytes_out += sent
+        return sent
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncServer(Server):
+    """
+    Server engine built on asyncio streams. Idle sessions only cost a coroutine waiting for the next frame; every
+    command is executed by the regular handle_* methods on a bounded thread pool, so blocking filesystem calls never
+    stall the event loop. uvloop is used when it is installed. The interactive commands have a small pool of their
+    own, so that they are not queued behind transfers holding every thread of the main one.
+    """
+
+    default_max_sessions = ASYNC_MAX_SESSIONS
+
+    def __init__(self, host, port, root=None, max_workers=64, **options):
+        Server.__init__(self, host, port, root, **options)
+        self.max_workers = max_workers
+        self.executor = None
+        self.interactive_executor = None  # runs the commands that are not in BULK_COMMANDS
+        self.loop = None
+        self.asyncio_server = None
+        self.draining = None  # task of drain(), once shutdown() was called
+        self.session_slots = None  # asyncio.Semaphore of AdmissionControl.max_sessions
+        self.waiting_connections = 0
+
+    def start(self):
+        """
+        1) Create the listening socket.
+        2) Serve client connections until interrupted.
+        """
+        self.serve(create_listening_socket(self.host, self.port))
+
+    def serve(self, listening_socket):
+        """
+        Creates the event loop (uvloop when available) and the executor, then serves the connections of a listening
+        socket until shutdown().
+        :param listening_socket: a bound, listening socket
+        """
+        raise_open_file_limit()
+        self.loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="fs")
+        self.interactive_executor = ThreadPoolExecutor(INTERACTIVE_WORKERS, thread_name_prefix="interactive")
+        try:
+            self.loop.run_until_complete(self.serve_forever(listening_socket))
+        finally:
+            self.executor.shutdown(wait=False)
+            self.interactive_executor.shutdown(wait=False)
+            self.loop.close()
+
+    async def serve_forever(self, listening_socket):
+        self.session_slots = asyncio.Semaphore(self.admission.max_sessions)
+        Thread(target=self.reap, name="reaper", daemon=True).start()
+        self.tree_index.start()
+        self.asyncio_server = await asyncio.start_server(self.handle_connection, sock=listening_socket,
+                                                         backlog=LISTEN_BACKLOG)
+        self.port = listening_socket.getsockname()[1]
+        logger.info("Server listening on %s:%s (asyncio%s)", self.host, self.port, ", uvloop" if uvloop else "")
+        self.ready.set()
+        try:
+            async with self.asyncio_server:
+                await self.asyncio_server.serve_forever()
+        except asyncio.CancelledError:
+            # close() cancels serve_forever(), wait for the sessions in progress when draining
+            if self.draining is None:
+                raise
+            await self.draining
+
+    def shutdown(self):
+        """
+        Stops accepting connections and lets the sessions in progress end, within WORKER_SHUTDOWN_GRACE seconds, before
+        serve() returns. Safe to call from a signal handler.
+        """
+        self.loop.call_soon_threadsafe(self.start_draining)
+
+    def start_draining(self):
+        if self.draining is None:
+            self.draining = self.loop.create_task(self.drain(WORKER_SHUTDOWN_GRACE))
+
+    async def drain(self, timeout):
+        self.asyncio_server.close()
+        deadline = self.loop.time() + timeout
+        while self.metrics.sessions and self.loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        for session in list(self.metrics.sessions):
+            session.service_socket.writer.close()
+
+    def wait_for_sessions(self, timeout):
+        # serve() only returns once drain() is done
+        return not self.metrics.sessions
+
+    async def receive_frame_async(self, reader):
+        """
+        Receives a single message from an asyncio stream.
+        :param reader: the StreamReader of the connection
+        :return: (opcode, flags, request_id, payload)
+        """
+        magic, version, opcode, flags, request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if magic != PROTOCOL_MAGIC:
+            raise ConnectionError("invalid frame header")
+        if version not in self.protocol_versions:
+            raise ConnectionError(f"unsupported protocol version {version}")
+        payload = await reader.readexactly(length) if length else b""
+        return opcode, flags, request_id, payload
+
+    async def admit_connection(self):
+        """
+        Waits for a session slot, at most the queue timeout of the admission control.
+        :return: None once the connection holds a slot, else the reason it is refused
+        """
+        if self.session_slots.locked():
+            if self.waiting_connections >= self.admission.max_pending:
+                with self.admission.lock:
+                    self.admission.refused["sessions"] += 1
+                return "too many connections"
+            self.waiting_connections += 1
+            try:
+                await asyncio.wait_for(self.session_slots.acquire(), self.admission.queue_timeout)
+            except asyncio.TimeoutError:
+                with self.admission.lock:
+                    self.admission.refused["queue_timeout"] += 1
+                return "timed out waiting for a session slot"
+            finally:
+                self.waiting_connections -= 1
+        else:
+            await self.session_slots.acquire()
+        return None
+
+    async def refuse_connection(self, reader, writer, reason):
+        """
+        Answers the hello of a connection refused by the admission control with an OP_BUSY frame, then closes it.
+        """
+        logger.warning("connection refused reason=%r", reason)
+        try:
+            opcode, flags, request_id, payload = await asyncio.wait_for(self.receive_frame_async(reader),
+                                                                        REJECT_TIMEOUT)
+            reply = busy_payload(reason, self.admission.retry_after())
+            writer.write(HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSIONS[-1], OP_BUSY, 0, request_id, len(reply)) + reply)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        refused = await self.admit_connection()
+        if refused is not None:
+            await self.refuse_connection(reader, writer, refused)
+            return
+        eof_token = self.generate_random_eof_token()
+        bridge = AsyncSocketBridge(reader, writer, self.loop, self.shaper.session())
+        session = Session(bridge, client_address, eof_token, self.root, self.buffer_pool)
+        logger.info("session opened address=%s", client_address)
+        self.metrics.session_opened(session)
+        try:
+            opcode, flags, request_id, payload = await self.receive_frame_async(reader)
+            bridge.bytes_in += HEADER.size + len(payload)
+            bridge.traffic.received.add(HEADER.size + len(payload))
+            version, reply_opcode, reply = self.negotiate(session, opcode, payload)
+            writer.write(HEADER.pack(PROTOCOL_MAGIC, version or PROTOCOL_VERSIONS[-1], reply_opcode, 0, request_id,
+                                     len(reply)) + reply)
+            bridge.bytes_out += HEADER.size + len(reply)
+            if version is None:
+                return
+            await self.loop.run_in_executor(self.interactive_executor, self.send_listing, session, 0,
+                                            session.working_directory)
+            while True:
+                # Waiting for the next command does not hold an executor thread
+                frame = await self.receive_frame_async(reader)
+                bridge.bytes_in += HEADER.size + len(frame[3])
+                bridge.traffic.received.add(HEADER.size + len(frame[3]))
+                command = frame[3].partition(b" ")[0].decode(errors="replace")
+                executor = self.executor if command in BULK_COMMANDS else self.interactive_executor
+                if not await self.loop.run_in_executor(executor, self.execute_command, session, *frame):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            logger.warning("connection lost address=%s error=%r", client_address, str(error))
+        finally:
+            self.metrics.session_closed(session)
+            logger.info("session closed address=%s bytes_in=%s bytes_out=%s", client_address, bridge.bytes_in,
+                        bridge.bytes_out)
+            session.close()
+            writer.close()
+            self.session_slots.release()
+
+    def queue_depths(self):
+        depths = Server.queue_depths(self)
+        depths["admission"] = self.waiting_connections
+        if self.executor is not None:
+            # commands waiting for a free executor thread
+            depths["executor"] = self.executor._work_queue.qsize()
+            depths["interactive"] = self.interactive_executor._work_queue.qsize()
+        return depths
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler leaving the formatting of the records to the QueueListener thread: logging a message on the request
+    path only costs creating the record and putting it in the queue.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level="INFO", queued=True):
+    """
+    Sends the records of the server logger through a queue to a listener thread writing them to stdout, as
+    'time level thread message' lines whose message holds key=value fields.
+    :param level: name of the minimum level, e.g. 'DEBUG' to log every command
+    :param queued: False to write the records from the threads logging them instead, for a process that forks: a fork
+        copies the locks of the listener thread, possibly held, into the child
+    :return: the started QueueListener, None when not queued
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+    logger.setLevel(level)
+    logger.propagate = False
+    if not queued:
+        logger.addHandler(handler)
+        return None
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def serve_metrics(server, port):
+    """
+    Serves the Prometheus text of a server's metrics over HTTP, on a daemon thread.
+    :param server: the Server
+    :param port: local port to listen on
+    :return: the ThreadingHTTPServer
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = server.metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request %s", format % args)
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    Thread(target=http_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("metrics served on http://127.0.0.1:%s/metrics", http_server.server_address[1])
+    return http_server
+
+
+def write_metrics_periodically(server, path, interval=METRICS_FILE_INTERVAL):
+    """
+    Rewrites the Prometheus text of a server's metrics to a file every `interval` seconds, on a daemon thread. The file
+    is replaced atomically, e.g. for the textfile collector of the node exporter.
+    :param server: the Server
+    :param path: the file to write
+    :param interval: seconds between two writes
+    """
+    def run():
+        while True:
+            with open(path + ".tmp", "w") as file:
+                file.write(server.metrics_text())
+            os.replace(path + ".tmp", path)
+            time.sleep(interval)
+
+    Thread(target=run, name="metrics-file", daemon=True).start()
+
+
+def raise_open_file_limit():
+    """Raises the soft limit on open files to the hard limit, every session holds a socket."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+ENGINES = {"threaded": Server, "async": AsyncServer}
+
+
+class Supervisor:
+    """
+    Scales a server over several cores with pre-forked worker processes, each running its own engine (threads or an
+    event loop) and accepting connections on the listening socket created before forking. With reuse_port, every
+    worker binds its own socket with SO_REUSEPORT instead and the kernel spreads the connections evenly, rather than
+    waking whichever worker is idle. The supervisor restarts the workers that die and, on SIGTERM or SIGINT, stops
+    them gracefully: they stop accepting and get WORKER_SHUTDOWN_GRACE seconds to finish their sessions.
+
+    The workers share the served tree: their listing caches see the changes made by the others through a
+    GenerationTable in shared memory, concurrent uploads of the same file are refused through flock() (see
+    lock_upload()) and the content store serializes its updates through a lock file.
+    """
+
+    def __init__(self, engine, host, port, workers, reuse_port=False, log_level="INFO", metrics_port=None,
+                 metrics_file=None, **options):
+        """
+        :param engine: name of the engine of the workers, see ENGINES
+        :param workers: number of worker processes
+        :param reuse_port: give every worker its own SO_REUSEPORT socket
+        :param metrics_port: worker i serves its metrics on metrics_port + i
+        :param metrics_file: worker i writes its metrics to metrics_file.i
+        :param options: keyword arguments of the engine
+        """
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.log_level = log_level
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.options = options
+        self.listening_socket = None
+        self.children = {}  # pid -> (worker index, start time)
+        self.stopping = False
+
+    def start(self):
+        """
+        1) Create the listening socket, generations table and signal handlers.
+        2) Fork the workers.
+        3) Restart the workers that die until stopped, then wait for all of them to exit.
+        """
+        if not hasattr(os, "fork"):
+            raise RuntimeError("worker processes need os.fork(), run a single worker on this platform")
+        self.options["generations"] = GenerationTable()
+        # With reuse_port the socket is only bound: it reserves the port, an ephemeral one included, for the workers
+        self.listening_socket = create_listening_socket(self.host, self.port, self.reuse_port,
+                                                        listen=not self.reuse_port)
+        self.port = self.listening_socket.getsockname()[1]
+        logger.info("Server listening on %s:%s (%s workers)", self.host, self.port, self.workers)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            logger.warning("worker exited pid=%s index=%s status=%s, restarting", pid, index, status)
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)  # do not spin on a worker failing at startup
+            if not self.stopping:
+                self.spawn(index)
+        self.listening_socket.close()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Asks the workers to stop (SIGTERM), and kills the ones still running after the grace period.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("stopping workers=%s", len(self.children))
+        for pid in list(self.children):
+            self.signal_child(pid, signal.SIGTERM)
+        killer = Timer(WORKER_SHUTDOWN_GRACE + 5, self.kill)
+        killer.daemon = True
+        killer.start()
+
+    def kill(self):
+        for pid in list(self.children):
+            self.signal_child(pid, signal.SIGKILL)
+
+    @staticmethod
+    def signal_child(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.run_worker(index)
+                status = 0
+            except BaseException:
+                logger.exception("worker failed index=%s", index)
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self.children[pid] = (index, time.monotonic())
+        logger.info("worker started pid=%s index=%s", pid, index)
+
+    def run_worker(self, index):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole process group, the supervisor decides
+        # The supervisor logs without a listener thread (it forks), the worker starts its own
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        listener = configure_logging(self.log_level)
+        server = ENGINES[self.engine](self.host, self.port, **self.options)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        if self.metrics_port is not None:
+            serve_metrics(server, self.metrics_port + index)
+        if self.metrics_file is not None:
+            write_metrics_periodically(server, f"{self.metrics_file}.{index}")
+        listening_socket = self.listening_socket
+        if self.reuse_port:
+            listening_socket.close()
+            listening_socket = create_listening_socket(self.host, self.port, reuse_port=True)
+        try:
+            try:
+                server.serve(listening_socket)
+            except SystemExit:
+                pass
+            logger.info("worker stopping pid=%s sessions=%s", os.getpid(), len(server.metrics.sessions))
+            server.wait_for_sessions(WORKER_SHUTDOWN_GRACE)
+        finally:
+            listener.stop()
+
+
+def run_server(engine="threaded", root=None, store_directory=None, deduplicate=True, port=65432, log_level="INFO",
+               metrics_port=None, metrics_file=None, profiling=False, workers=1, reuse_port=False, admission=None,
+               file_cache_bytes=FILE_CACHE_BYTES, index=True, shaper=None, limit_control=False):
     HOST = "127.0.0.1"
-    PORT = 65432
+    PORT = port
 
-    server = Server(HOST, PORT)
-    server.start()
+    if workers > 1:
+        # The supervisor forks its workers all along (restarts included), it keeps no thread
+        configure_logging(log_level, queued=False)
+        Supervisor(engine, HOST, PORT, workers, reuse_port, log_level, metrics_port, metrics_file, root=root,
+                   store_directory=store_directory, deduplicate=deduplicate, profiling=profiling,
+                   admission=admission, file_cache_bytes=file_cache_bytes, index=index, shaper=shaper,
+                   limit_control=limit_control).start()
+        return
+    listener = configure_logging(log_level)
+    try:
+        server = ENGINES[engine](HOST, PORT, root, store_directory=store_directory, deduplicate=deduplicate,
+                                 profiling=profiling, admission=admission, file_cache_bytes=file_cache_bytes,
+                                 index=index, shaper=shaper, limit_control=limit_control)
+        if metrics_port is not None:
+            serve_metrics(server, metrics_port)
+        if metrics_file is not None:
+            write_metrics_periodically(server, metrics_file)
+        server.start()
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
-    run_server()
+    parser = argparse.ArgumentParser(description="File server")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threaded",
+                        help="pool of session threads or asyncio event loop")
+    parser.add_argument("--root", help="directory served to the clients, defaults to the working directory")
+    parser.add_argument("--store", help="content store directory, defaults to .cas in the served directory")
+    parser.add_argument("--no-dedup", action="store_true", help="do not keep a content store of the uploads")
+    parser.add_argument("--port", type=int, default=65432, help="port to listen on, 0 for an ephemeral port")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG logs every command")
+    parser.add_argument("--metrics-port", type=int, help="serve the metrics in the Prometheus text format on this port")
+    parser.add_argument("--metrics-file", help="write the metrics in the Prometheus text format to this file")
+    parser.add_argument("--profiling", action="store_true", help="allow the profile command")
+    parser.add_argument("--workers", type=int, default=1, help="number of pre-forked worker processes")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="give every worker its own SO_REUSEPORT socket, the kernel balances the connections")
+    parser.add_argument("--max-sessions", type=int,
+                        help="sessions served at once by each worker, more connections wait for a free slot "
+                             f"(default: {MAX_SESSIONS} threaded, {ASYNC_MAX_SESSIONS} asyncio)")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING,
+                        help="connections waiting for a slot, more are refused right away")
+    parser.add_argument("--queue-timeout", type=float, default=ADMISSION_TIMEOUT,
+                        help="seconds a connection waits for a slot before being refused")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS,
+                        help="downloads and uploads in progress in each worker, more are refused")
+    parser.add_argument("--max-inflight-bytes", type=int, default=MAX_INFLIGHT_BYTES,
+                        help="total size of the downloads and uploads in progress in each worker")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds without a command after which a session is closed")
+    parser.add_argument("--file-cache-bytes", type=int, default=FILE_CACHE_BYTES,
+                        help="memory mapped for the most downloaded files, 0 to always read them from disk")
+    parser.add_argument("--no-index", action="store_true",
+                        help="do not keep an index of the tree in memory, find and du then scan the disk")
+    parser.add_argument("--global-rate", type=int, default=0,
+                        help="bytes per second sent or received by all the sessions of each worker, 0 for unlimited")
+    parser.add_argument("--session-rate", type=int, default=0,
+                        help="bytes per second sent or received by each session, 0 for unlimited")
+    parser.add_argument("--limit-control", action="store_true",
+                        help="allow the limit command to change the global and session rates")
+    args = parser.parse_args()
+    admission = AdmissionControl(args.max_sessions, args.max_pending, args.queue_timeout, args.max_transfers,
+                                 args.max_inflight_bytes, args.idle_timeout)
+    run_server(args.engine, args.root, args.store, not args.no_dedup, args.port, args.log_level, args.metrics_port,
+               args.metrics_file, args.profiling, args.workers, args.reuse_port, admission, args.file_cache_bytes,
+               not args.no_index, TrafficShaper(args.global_rate, args.session_rate), args.limit_control)
@@ -1,24 +1,814 @@
-from client.client import Client
+from client.client import AsyncClient, Client, ParallelTransfer, ServerBusy, ServerError, StreamCodec
+from client.client import COMPRESSION_CODECS, TRANSFER_CHUNK_SIZE
 from server.server import run_server as Server_main
+from server.server import ENGINES, AdmissionControl, FileCache, ListingCache, FILE_CACHE_ADMISSION
+from server.server import ServerBusy as ServerSideBusy
+from transfer import DELTA_COPY, DELTA_DATA, SIGNATURE_HEADER, DeltaWriter, compute_delta, file_signatures
+from server.server import StreamCodec as ServerStreamCodec
+from server.server import TarExtractor, TreeIndex, glob_regex, iter_archive, walk_tree
+from server.server import SHAPING_BURST, SHAPING_QUANTUM, TokenBucket, TrafficShaper
+import argparse
+import asyncio
+import contextlib
+import fnmatch
+import hashlib
+import io
 import multiprocessing
+import socket
+import tarfile
+import tempfile
+import threading
 import time
+import warnings
 import shutil
 import os
+import random
+import re
+
+import bench
 
 
 
 
 # exit_flag = threading.Event()
 
+
+@contextlib.contextmanager
+def served_directory(engine="threaded", **options):
+    """
+    Runs a server on an ephemeral port, on a daemon thread, serving an empty temporary directory. Meanwhile the working
+    directory is another empty temporary directory, the one the clients upload from and download to.
+    :param engine: key of ENGINES
+    :param options: keyword arguments of the engine
+    :return: (server, path of the served directory)
+    """
+    previous_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as workspace:
+        root = os.path.join(workspace, 'root')
+        local = os.path.join(workspace, 'local')
+        os.makedirs(root)
+        os.makedirs(local)
+        server = ENGINES[engine]('127.0.0.1', 0, root, **options)
+        threading.Thread(target=server.start, daemon=True).start()
+        assert server.ready.wait(10), 'server did not start'
+        os.chdir(local)
+        try:
+            yield server, root
+        finally:
+            os.chdir(previous_directory)
+            # End the sessions a failed test left open, their threads would keep the script from exiting
+            with server.metrics.lock:
+                sessions = list(server.metrics.sessions)
+            for session in sessions:
+                session.service_socket.shutdown()
+
+
+def connect(server, verbose=False):
+    """
+    :return: (client, client socket, eof token) of a new session on a server started by served_directory()
+    """
+    client = Client('127.0.0.1', server.port, verbose)
+    client_socket, eof_token = client.initialize('127.0.0.1', server.port)
+    return client, client_socket, eof_token
+
+
+def disconnect(client, client_socket):
+    """ Ends a session opened by connect() """
+    client.send_command(client_socket, 'exit')
+    client_socket.close()
+
+
+def test_benchmark():
+    """ A short run of the load generator completes every command without errors """
+    args = argparse.Namespace(sessions=2, operations=20, duration=0, mix=bench.parse_mix(bench.DEFAULT_MIX),
+                              sizes=[4096, 1 << 20], content='random', engine='threaded', server='inprocess',
+                              listing='full', dedup=False, seed=0)
+    results = bench.run_benchmark(args)
+    assert results['operations'] == 40, 'benchmark operations missing'
+    assert not any(figures['errors'] for figures in results['commands'].values()), 'benchmark errors'
+
+def test_streamed_transfer(engine='threaded'):
+    """ A file of several transfer chunks goes up and comes back unchanged """
+    with served_directory(engine) as (server, root):
+        client, client_socket, eof_token = connect(server)
+        data = os.urandom(3 * TRANSFER_CHUNK_SIZE + 12345)
+        with open('big.bin', 'wb') as file:
+            file.write(data)
+        assert client.issue_ul('ul big.bin', client_socket, eof_token), 'streamed ul failed'
+        with open(os.path.join(root, 'big.bin'), 'rb') as file:
+            assert file.read() == data, 'streamed ul corrupted the file'
+        os.remove('big.bin')
+        assert client.issue_dl('dl big.bin', client_socket, eof_token), 'streamed dl failed'
+        with open('big.bin', 'rb') as file:
+            assert file.read() == data, 'streamed dl corrupted the file'
+        assert client.last_transfer.raw_bytes == len(data), 'streamed dl stats'
+        disconnect(client, client_socket)
+
+
+
+def test_async_engine():
+    """ The asyncio engine serves concurrent sessions, each in its own directory """
+    test_streamed_transfer('async')
+    with served_directory('async') as (server, root):
+        errors = []
+
+        def session(index):
+            try:
+                client, client_socket, eof_token = connect(server)
+                with open(f'file{index}.bin', 'wb') as file:
+                    file.write(os.urandom(100000 + index))
+                client.issue_mkdir(f'mkdir dir{index}', client_socket, eof_token)
+                client.issue_cd(f'cd dir{index}', client_socket, eof_token)
+                assert client.issue_ul(f'ul file{index}.bin', client_socket, eof_token), 'async ul failed'
+                disconnect(client, client_socket)
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=session, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+        for index in range(8):
+            path = os.path.join(root, f'dir{index}', f'file{index}.bin')
+            assert os.path.getsize(path) == 100000 + index, 'async session lost its upload'
+
+
+
+def test_session_directories():
+    """ Every session has its own working directory, which cannot leave the served directory, by name or by link """
+    with served_directory() as (server, root), tempfile.TemporaryDirectory() as outside:
+        root = os.path.realpath(root)
+        os.makedirs(os.path.join(root, 'a', 'b'))
+        with open(os.path.join(outside, 'secret'), 'w') as file:
+            file.write('secret')
+        os.symlink(outside, os.path.join(root, 'out'))
+        os.symlink(os.path.join('a', 'b'), os.path.join(root, 'in'))
+        first, first_socket, eof_token = connect(server)
+        second, second_socket, _ = connect(server)
+        first.issue_cd('cd a', first_socket, eof_token)
+        assert first.request('pwd', first_socket)[0].decode() == os.path.join(root, 'a'), 'cd failed'
+        assert second.request('pwd', second_socket)[0].decode() == root, 'cd changed another session'
+        for command in ('cd ../..', 'cd /', 'info out/secret', 'cd out', 'mkdir ../out/new'):
+            try:
+                first.request(command, first_socket)
+                raise AssertionError(f'{command} left the served directory')
+            except ServerError:
+                pass
+        assert not os.path.exists(os.path.join(outside, 'new')), 'mkdir through a link left the served directory'
+        second.issue_cd('cd in', second_socket, eof_token)
+        assert second.request('pwd', second_socket)[0].decode() == os.path.join(root, 'in'), 'cd to an inner link'
+        disconnect(first, first_socket)
+        disconnect(second, second_socket)
+
+
+
+def test_listing_cache():
+    """ Listings are reused until the directory changes, and sent as deltas on request """
+    with tempfile.TemporaryDirectory() as directory:
+        hidden = os.path.join(directory, '.cas')
+        os.makedirs(hidden)
+        os.makedirs(os.path.join(directory, 'sub'))
+        cache = ListingCache(frozenset([hidden]), max_entries=2)
+        listing = cache.get(directory)
+        assert listing.directories == ['sub'] and listing.files == [], 'hidden path listed'
+        assert cache.get(directory) is listing, 'listing not reused'
+        with open(os.path.join(directory, 'new.txt'), 'w'):
+            pass
+        # The server invalidates the directories it modifies; the changes of others are seen through the mtime
+        cache.invalidate(directory)
+        changed = cache.get(directory)
+        assert changed is not listing and changed.files == ['new.txt'], 'invalidated listing reused'
+        os.utime(directory, ns=(0, changed.mtime_ns + 1))
+        assert cache.get(directory) is not changed, 'directory change not noticed'
+        delta = b''.join(changed.delta_pages(listing)).decode().split('\n')
+        assert delta[2:] == ['+ new.txt'], delta
+        assert b'unchanged' in changed.delta_pages(changed)[0], 'unchanged delta'
+        for name in ('sub', '.cas'):
+            cache.get(os.path.join(directory, name))
+        assert len(cache.entries) == 2, 'listing cache not bounded'
+
+
+
+def test_batch():
+    """ Pipelined commands, more than a window of them, are answered in order; a failure does not affect the others """
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        commands = [f'mkdir dir{index}' for index in range(600)]
+        commands[300] = 'rm missing'
+        results = client.issue_batch(commands + ['pwd'], client_socket, eof_token)
+        assert len(results) == 601, 'batch results missing'
+        assert results[300] is None and all(result == [] for result in results[:300] + results[301:600])
+        assert results[600] == [os.path.realpath(root).encode()], 'batch results out of order'
+        assert len(os.listdir(root)) == 599, 'batch commands not executed'
+        for command in ('dl dir0', 'delta dir0'):
+            try:
+                client.issue_batch([command], client_socket, eof_token)
+                raise AssertionError('transfer batched')
+            except ValueError:
+                pass
+        disconnect(client, client_socket)
+
+
+
+def test_parallel_transfer():
+    """ Files split in ranges over several sessions are reassembled unchanged, both ways """
+    with served_directory() as (server, root):
+        contents = {'a.bin': os.urandom(5 * TRANSFER_CHUNK_SIZE + 7), 'b.bin': os.urandom(1000), 'empty.bin': b''}
+        for name, data in contents.items():
+            with open(name, 'wb') as file:
+                file.write(data)
+        with ParallelTransfer('127.0.0.1', server.port, stripes=3, chunk_size=TRANSFER_CHUNK_SIZE) as pool:
+            assert sorted(pool.upload(['*.bin'])) == sorted(contents), 'parallel ul files'
+            for name, data in contents.items():
+                with open(os.path.join(root, name), 'rb') as file:
+                    assert file.read() == data, f'parallel ul corrupted {name}'
+                os.remove(name)
+            assert sorted(pool.download(['*.bin'])) == sorted(contents), 'parallel dl files'
+        for name, data in contents.items():
+            with open(name, 'rb') as file:
+                assert file.read() == data, f'parallel dl corrupted {name}'
+        assert not [name for name in os.listdir(root) + os.listdir('.') if name.endswith('.part')], 'partial files left'
+
+
+
+def test_resumable_transfers():
+    """ Interrupted transfers resume from their partial file, ranges are served, and content is verified """
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        data = os.urandom(3 * TRANSFER_CHUNK_SIZE)
+        digest = hashlib.sha256(data).hexdigest()
+        with open('big.bin', 'wb') as file:
+            file.write(data)
+        # The server keeps the beginning of an interrupted upload under a name derived from the sha256
+        with open(os.path.join(root, f'.big.bin.{digest[:16]}.part'), 'wb') as file:
+            file.write(data[:1234567])
+        assert client.issue_ul('ul big.bin', client_socket, eof_token), 'resumed ul failed'
+        with open(os.path.join(root, 'big.bin'), 'rb') as file:
+            assert file.read() == data, 'resumed ul corrupted the file'
+        assert not [name for name in os.listdir(root) if name.endswith('.part')], 'upload partial file left'
+        os.remove('big.bin')
+        for partial, transferred in ((data[:999], len(data) - 999), (b'x' * 999, len(data))):
+            # A partial file that does not match the server's file is downloaded again from the start
+            with open('big.bin.part', 'wb') as file:
+                file.write(partial)
+            assert client.issue_dl('dl big.bin', client_socket, eof_token), 'resumed dl failed'
+            with open('big.bin', 'rb') as file:
+                assert file.read() == data, 'resumed dl corrupted the file'
+            assert client.last_transfer.raw_bytes == transferred, 'dl did not resume'
+            os.remove('big.bin')
+        section = io.BytesIO()
+        client.request('dl big.bin 1000 5000', client_socket, section)
+        assert section.getvalue() == data[1000:6000], 'ranged dl'
+        # A range is neither checked against the sha256 of the whole file nor resumed from a partial file
+        with open('big.bin.part', 'wb') as file:
+            file.write(data[:999])
+        assert client.issue_dl('dl big.bin 1000 5000', client_socket, eof_token), 'ranged dl through issue_dl'
+        with open('big.bin', 'rb') as file:
+            assert file.read() == data[1000:6000], 'ranged dl through issue_dl'
+        assert os.path.getsize('big.bin.part') == 999, 'ranged dl touched the partial file'
+        os.remove('big.bin')
+        os.remove('big.bin.part')
+        for command in ('dl big.bin 99999999 1', f'ul other.bin 10 {"g" * 64}', f'ul other.bin 10 {"A" * 64}'):
+            try:
+                client.request(command, client_socket)
+                raise AssertionError(f'{command} accepted')
+            except ServerError:
+                pass
+        # A busy server does not cost the partial file
+        with open('big.bin.part', 'wb') as file:
+            file.write(data[:999])
+
+        def busy(*args, **kwargs):
+            raise ServerSideBusy('busy', 0.01)
+        handle_dl = server.handle_dl
+        server.handle_dl = busy
+        assert not client.issue_dl('dl big.bin', client_socket, eof_token), 'busy dl succeeded'
+        assert os.path.getsize('big.bin.part') == 999, 'busy dl removed the partial file'
+        server.handle_dl = handle_dl
+        assert not client.issue_dl('dl missing.bin', client_socket, eof_token), 'dl of a missing file'
+        assert not os.path.exists('missing.bin.part'), 'partial file of a missing file left'
+        disconnect(client, client_socket)
+
+
+
+def test_deduplication():
+    """ Content the server already stores is not sent again, and the copies sharing it stay independent """
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        data = os.urandom(100000)
+        digest = hashlib.sha256(data).hexdigest()
+        for name in ('a.bin', 'b.bin'):
+            with open(name, 'wb') as file:
+                file.write(data)
+        sent = []
+        send_file = client.send_file
+
+        def recording_send_file(*args, **kwargs):
+            sent.append(args)
+            return send_file(*args, **kwargs)
+        client.send_file = recording_send_file
+        assert client.issue_ul('ul a.bin', client_socket, eof_token), 'first ul failed'
+        assert len(sent) == 1, 'first ul not sent'
+        assert os.path.isfile(server.content_store.object_path(digest)), 'upload not stored'
+        assert client.issue_ul('ul b.bin', client_socket, eof_token), 'duplicate ul failed'
+        assert len(sent) == 1, 'duplicate content sent again'
+        with open('a.bin', 'wb') as file:
+            file.write(b'changed')
+        assert client.issue_ul('ul a.bin', client_socket, eof_token), 'ul of new content failed'
+        for name, content in (('a.bin', b'changed'), ('b.bin', data)):
+            with open(os.path.join(root, name), 'rb') as file:
+                assert file.read() == content, f'{name} changed through a shared copy'
+        with open(server.content_store.object_path(digest), 'rb') as file:
+            assert file.read() == data, 'stored object changed'
+        disconnect(client, client_socket)
+
+
+
+def test_compression():
+    """ Compressible files travel compressed with the negotiated codec, and chunks inflating too much are refused """
+    for codec_class in (StreamCodec, ServerStreamCodec):
+        for codec in COMPRESSION_CODECS:
+            compressor, decompressor = codec_class(codec), codec_class(codec)
+            chunks = [bytes([index]) * TRANSFER_CHUNK_SIZE for index in range(3)]
+            assert [decompressor.decompress(compressor.compress(chunk)) for chunk in chunks] == chunks, codec
+            for payload in (codec_class(codec).compress(b'\0' * (4 * TRANSFER_CHUNK_SIZE)), b'not compressed'):
+                try:
+                    codec_class(codec).decompress(payload)
+                    raise AssertionError(f'{codec} accepted an invalid chunk')
+                except ValueError:
+                    pass
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        assert client.compression == COMPRESSION_CODECS[0], 'codec not negotiated'
+        text = b''.join(b'line %d of a text file\n' % index for index in range(200000))
+        for name, data, codec in (('text.txt', text, client.compression), ('random.bin', os.urandom(100000), None)):
+            with open(name, 'wb') as file:
+                file.write(data)
+            assert client.issue_ul(f'ul {name}', client_socket, eof_token), 'ul failed'
+            os.remove(name)
+            assert client.issue_dl(f'dl {name}', client_socket, eof_token), 'dl failed'
+            with open(name, 'rb') as file:
+                assert file.read() == data, f'{name} corrupted'
+            assert client.last_transfer.codec == codec, f'{name} sent with {client.last_transfer.codec}'
+        disconnect(client, client_socket)
+
+
+
+def test_delta_sync():
+    """ Deltas rebuild the new version of a file from the old one, and sync only sends the changed blocks """
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        base_path, new_path = os.path.join(directory, 'base'), os.path.join(directory, 'new')
+        for size in (0, 1000, 100000, 3000001):
+            base = rng.randbytes(size)
+            edited = base[:size // 3] + b'inserted' + base[size // 3 + 50:] + b'tail'
+            # The last block of the base file is short unless its size is a multiple of the block size
+            for old, new in ((base, edited), (base, base), (b'', edited), (base, b'x'), (base, base[:-1])):
+                with open(base_path, 'wb') as file:
+                    file.write(old)
+                with open(new_path, 'wb') as file:
+                    file.write(new)
+                with open(base_path, 'rb') as base_file, open(new_path, 'rb') as new_file:
+                    signatures = file_signatures(base_file.fileno())
+                    rebuilt = io.BytesIO()
+                    writer = DeltaWriter(base_file.fileno(), SIGNATURE_HEADER.unpack_from(signatures)[0], rebuilt)
+                    for record in compute_delta(new_file.fileno(), signatures):
+                        writer.write(record)
+                    writer.close()
+                assert rebuilt.getvalue() == new, f'delta of {len(old)} to {len(new)} bytes'
+        with open(base_path, 'rb') as base_file:
+            for records in (b'X', DELTA_COPY.pack(b'C', 100000, 1), DELTA_DATA.pack(b'D', 10) + b'short'):
+                writer = DeltaWriter(base_file.fileno(), 1024, io.BytesIO())
+                try:
+                    writer.write(records)
+                    writer.close()
+                    raise AssertionError(f'invalid delta {records!r} accepted')
+                except ValueError:
+                    pass
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        os.makedirs(os.path.join('tree', 'sub'))
+        data = rng.randbytes(2 * TRANSFER_CHUNK_SIZE)
+        with open(os.path.join('tree', 'a.bin'), 'wb') as file:
+            file.write(data)
+        with open(os.path.join('tree', 'sub', 'b.txt'), 'w') as file:
+            file.write('b')
+        assert client.sync_up('tree', 'tree', client_socket)['transferred'] == 2, 'sync up'
+        with open(os.path.join('tree', 'a.bin'), 'wb') as file:
+            file.write(data[:100000] + b'edit' + data[100000:])
+        summary = client.sync_up('tree', 'tree', client_socket)
+        assert summary['transferred'] == 1 and summary['wire_bytes'] < len(data) // 10, summary
+        summary = client.sync_down('tree', 'copy', client_socket)
+        assert summary['transferred'] == 2, summary
+        for name in ('a.bin', os.path.join('sub', 'b.txt')):
+            for path in (os.path.join(root, 'tree', name), os.path.join('copy', name)):
+                with open(path, 'rb') as synced, open(os.path.join('tree', name), 'rb') as original:
+                    assert synced.read() == original.read(), f'{path} out of sync'
+        disconnect(client, client_socket)
+
+
+
+def test_stats():
+    """ The stats command and the Prometheus text count the sessions, the commands and their errors """
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        client.issue_mkdir('mkdir a', client_socket, eof_token)
+        client.issue_mkdir('mkdir b', client_socket, eof_token)
+        client.issue_rm('rm missing', client_socket, eof_token)
+        figures = client.issue_stats('stats', client_socket, eof_token)
+        assert figures['sessions_active'] == 1 and figures['sessions_total'] == 1, 'session counters'
+        assert figures['commands']['mkdir']['count'] == 2 and figures['commands']['mkdir']['errors'] == 0, 'mkdir'
+        assert figures['commands']['rm']['errors'] == 1, 'rm errors'
+        assert sum(figures['commands']['mkdir']['buckets']) == 2, 'latency histogram'
+        assert figures['sessions'][0]['commands'] == 4 and figures['bytes_in'] > 0, 'session figures'
+        text = server.metrics_text()
+        assert 'fileserver_command_duration_seconds_count{command="mkdir"} 2' in text, 'Prometheus histogram'
+        assert 'fileserver_sessions_active 1' in text, 'Prometheus gauge'
+        disconnect(client, client_socket)
+
+
+
+def test_workers():
+    """ Pre-forked workers share the port and the served directory, and stop on SIGTERM """
+    with tempfile.TemporaryDirectory() as root:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server_process = multiprocessing.Process(target=Server_main, kwargs=dict(
+            root=root, port=port, log_level='WARNING', workers=2, reuse_port=True))
+        server_process.start()
+        deadline = time.monotonic() + 10
+        pids = set()
+        while len(pids) < 2:
+            assert time.monotonic() < deadline, 'connections not spread over the workers'
+            try:
+                client = Client('127.0.0.1', port, False)
+                client_socket, eof_token = client.initialize('127.0.0.1', port)
+            except (ConnectionRefusedError, ServerError):
+                time.sleep(0.05)
+                continue
+            pids.add(client.issue_stats('stats', client_socket, eof_token)['pid'])
+            client.issue_mkdir(f'mkdir dir{len(pids)}', client_socket, eof_token)
+            disconnect(client, client_socket)
+        assert server_process.pid not in pids, 'the supervisor served a session'
+        assert sorted(os.listdir(root)) == ['dir1', 'dir2'], 'workers do not share the served directory'
+        server_process.terminate()
+        server_process.join(30)
+        assert server_process.exitcode == 0, 'supervisor did not stop cleanly'
+
+
+
+def test_admission():
+    """ Connections beyond the session slots wait in a bounded queue, then get OP_BUSY; so do excess transfers """
+    for engine in ENGINES:
+        admission = AdmissionControl(max_sessions=1, max_pending=1, queue_timeout=0.5, max_transfers=1)
+        with served_directory(engine, admission=admission) as (server, root):
+            first, first_socket, eof_token = connect(server)
+            outcome = {}
+
+            def queued():
+                client = Client('127.0.0.1', server.port, False)
+                client.busy_retries = 0
+                started = time.monotonic()
+                try:
+                    outcome['session'] = client, client.initialize('127.0.0.1', server.port)[0]
+                except ServerBusy:
+                    outcome['refused after'] = time.monotonic() - started
+            waiting = threading.Thread(target=queued)
+            waiting.start()
+            time.sleep(0.1)
+            refused = Client('127.0.0.1', server.port, False)
+            refused.busy_retries = 0
+            try:
+                refused.initialize('127.0.0.1', server.port)
+                raise AssertionError(f'{engine}: connection beyond the queue admitted')
+            except ServerBusy as busy:
+                assert busy.retry_after > 0, 'no retry delay'
+            waiting.join()
+            assert outcome.get('refused after', 0) >= 0.4, f'{engine}: queued connection not timed out'
+            # A waiting connection takes the slot of a session that ends
+            waiting = threading.Thread(target=queued)
+            waiting.start()
+            time.sleep(0.1)
+            disconnect(first, first_socket)
+            waiting.join()
+            second, second_socket = outcome.pop('session')
+            with open(os.path.join(root, 'file.bin'), 'wb') as file:
+                file.write(b'data')
+            os.makedirs('tree')
+            with open(os.path.join('tree', 'a.bin'), 'wb') as file:
+                file.write(b'tree')
+            with admission.transfer(4):
+                assert not second.issue_dl('dl file.bin', second_socket, eof_token), f'{engine}: excess transfer'
+                assert second.busy is not None, f'{engine}: transfer refused without OP_BUSY'
+                # The uploads streamed without waiting for an answer are refused too, their content is dropped
+                assert not second.issue_ul('ul tree', second_socket, eof_token), f'{engine}: excess archive ul'
+                try:
+                    second.sync_up('tree', 'synced', second_socket)
+                    raise AssertionError(f'{engine}: excess patch')
+                except ServerError:
+                    pass
+                request_id = second.send_command(second_socket, 'ulrange x1 0 4 4 stripe.bin')
+                with open(os.path.join('tree', 'a.bin'), 'rb') as file:
+                    second.send_file(second_socket, file, request_id, 0, 4)
+                assert second.receive_reply(second_socket, request_id) is None and second.busy is not None, \
+                    f'{engine}: excess ulrange'
+                assert second.request('pwd', second_socket), f'{engine}: session out of sync after a refused upload'
+            assert not os.path.exists(os.path.join(root, 'tree', 'a.bin')), f'{engine}: refused archive extracted'
+            assert not os.path.exists(os.path.join(root, 'synced', 'a.bin')), f'{engine}: refused patch applied'
+            assert second.issue_dl('dl file.bin', second_socket, eof_token), f'{engine}: transfer refused'
+            assert second.issue_ul('ul tree', second_socket, eof_token), f'{engine}: archive ul refused'
+            disconnect(second, second_socket)
+
+            async def stream_upload():
+                async def chunks():
+                    yield b'stream'
+                async with AsyncClient('127.0.0.1', server.port) as client:
+                    client.busy_retries = 0
+                    with admission.transfer(4):
+                        try:
+                            await client.ul('stream.bin', chunks())
+                            raise AssertionError(f'{engine}: excess stream ul')
+                        except ServerBusy:
+                            pass
+                    await client.ul('stream.bin', chunks())
+            asyncio.run(stream_upload())
+            with open(os.path.join(root, 'stream.bin'), 'rb') as file:
+                assert file.read() == b'stream', f'{engine}: stream ul after a refusal'
+
+
+
+def test_file_cache():
+    """ Hot files are mapped once requested often enough, and never served stale """
+    with tempfile.TemporaryDirectory() as directory:
+        cache = FileCache(max_bytes=3000)
+        paths = [os.path.join(directory, name) for name in ('a', 'b', 'c')]
+        for path in paths:
+            with open(path, 'wb') as file:
+                file.write(b'x' * 1000)
+
+        def get(path):
+            cached = cache.get(path, path)
+            return None if cached is None else bytes(cached.data)
+        for _ in range(FILE_CACHE_ADMISSION - 1):
+            assert get(paths[0]) is None, 'file mapped before its admission'
+        assert get(paths[0]) == b'x' * 1000 and paths[0] in cache.entries, 'hot file not mapped'
+        with open(paths[0], 'ab') as file:
+            file.write(b'y')
+        assert get(paths[0]) is None and paths[0] not in cache.entries, 'modified file served stale'
+        for _ in range(FILE_CACHE_ADMISSION):
+            get(paths[0])
+        with open(paths[0] + '.new', 'wb') as file:
+            file.write(b'z' * 1001)
+        os.replace(paths[0] + '.new', paths[0])
+        assert get(paths[0]) is None, 'replaced file served stale'
+        for path in paths:
+            for _ in range(FILE_CACHE_ADMISSION):
+                get(path)
+        assert list(cache.entries) == paths[1:] and cache.evictions == 1, 'least recently used file not evicted'
+        cache.invalidate(directory, recursive=True)
+        assert not cache.entries and cache.bytes == 0, 'files below an invalidated directory kept'
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        for content in (b'first version', b'second version'):
+            with open('hot.txt', 'wb') as file:
+                file.write(content)
+            assert client.issue_ul('ul hot.txt', client_socket, eof_token), 'ul failed'
+            for _ in range(FILE_CACHE_ADMISSION + 1):
+                os.remove('hot.txt')
+                assert client.issue_dl('dl hot.txt', client_socket, eof_token), 'dl failed'
+                with open('hot.txt', 'rb') as file:
+                    assert file.read() == content, 'cached file served stale'
+        assert server.file_cache.hits, 'hot file not served from the cache'
+        disconnect(client, client_socket)
+
+
+
+def test_async_client():
+    """ Concurrent requests share one connection, and a download abandoned midway does not block it """
+    async def scenario(port, root):
+        async with AsyncClient('127.0.0.1', port) as client:
+            contents = {f'file{index}.bin': os.urandom(100000 * (index + 1)) for index in range(4)}
+            await asyncio.gather(*(client.ul(name, data) for name, data in contents.items()))
+            infos = await asyncio.gather(*(client.info(name) for name in contents))
+            assert [info['size'] for info in infos] == [len(data) for data in contents.values()], 'async info'
+
+            async def download(name):
+                return b''.join([chunk async for chunk in client.dl(name)])
+            assert await asyncio.gather(*(download(name) for name in contents)) == list(contents.values())
+
+            async def chunks():
+                for index in range(5):
+                    yield bytes([index]) * 1000
+            await client.ul('stream.bin', chunks())
+            with open(os.path.join(root, 'stream.bin'), 'rb') as file:
+                assert file.read() == b''.join(bytes([index]) * 1000 for index in range(5)), 'async stream ul'
+            with open(os.path.join(root, 'big.bin'), 'wb') as file:
+                file.write(os.urandom(64 * TRANSFER_CHUNK_SIZE))
+            download = client.dl('big.bin')
+            await download.__anext__()
+            await asyncio.sleep(0.2)  # lets the frames of the download fill the queue of the connection
+            await download.aclose()
+            info = await asyncio.wait_for(client.info('file0.bin'), 10)
+            assert info['size'] == 100000, 'connection blocked by an abandoned download'
+            try:
+                await client.info('missing.bin')
+                raise AssertionError('info of a missing file')
+            except ServerError:
+                pass
+    for engine in ENGINES:
+        with served_directory(engine) as (server, root):
+            asyncio.run(scenario(server.port, root))
+
+
+
+def make_tree(root):
+    """ Creates a small directory tree, with a partial file and a link that archives and copies leave out """
+    os.makedirs(os.path.join(root, 'sub', 'deeper'))
+    os.makedirs(os.path.join(root, 'empty'))
+    for name, size in (('a.bin', 5000), (os.path.join('sub', 'b.txt'), 0), (os.path.join('sub', 'deeper', 'c'), 1)):
+        with open(os.path.join(root, name), 'wb') as file:
+            file.write(os.urandom(size))
+    with open(os.path.join(root, 'skipped.part'), 'wb') as file:
+        file.write(b'partial')
+    os.symlink('a.bin', os.path.join(root, 'link'))
+
+
+def same_tree(first, second):
+    """ :return: True if the regular files and directories of two trees are the same """
+    first_files, first_directories = walk_tree(first)
+    second_files, second_directories = walk_tree(second)
+    if first_directories != second_directories or sorted(first_files) != sorted(second_files):
+        return False
+    for name in first_files:
+        with open(os.path.join(first, name), 'rb') as one, open(os.path.join(second, name), 'rb') as other:
+            if one.read() != other.read():
+                return False
+    return True
+
+
+def test_archives():
+    """ Directories travel as tar archives extracted on the fly, unsafe members are refused; cp -r copies trees """
+    with tempfile.TemporaryDirectory() as directory:
+        source, destination = os.path.join(directory, 'source'), os.path.join(directory, 'destination')
+        make_tree(source)
+        archive = bytearray()
+        for piece in iter_archive(source):
+            archive += piece if isinstance(piece, bytes) else piece[1].read()
+        extractor = TarExtractor(destination)
+        for offset in range(0, len(archive), 700):  # headers split across writes
+            extractor.write(archive[offset:offset + 700])
+        extractor.close()
+        assert same_tree(source, destination), 'archive round trip'
+        assert not os.path.lexists(os.path.join(destination, 'link')), 'link extracted'
+        assert not os.path.exists(os.path.join(destination, 'skipped.part')), 'partial file archived'
+        outside = os.path.join(directory, 'outside')
+        os.makedirs(outside)
+        os.symlink(outside, os.path.join(destination, 'out'))
+        for name in ('../evil', '/absolute', 'out/through_link', '.cas/object'):
+            unsafe = io.BytesIO()
+            with tarfile.open(fileobj=unsafe, mode='w', format=tarfile.PAX_FORMAT) as tar:
+                member = tarfile.TarInfo(name)
+                member.size = 4
+                tar.addfile(member, io.BytesIO(b'evil'))
+            extractor = TarExtractor(destination, frozenset([os.path.join(destination, '.cas')]))
+            extractor.write(unsafe.getvalue())
+            try:
+                extractor.close()
+                raise AssertionError(f'{name} extracted')
+            except (ValueError, PermissionError):
+                pass
+        assert not os.listdir(outside) and not os.path.exists(os.path.join(destination, '.cas')), 'unsafe extraction'
+    with served_directory() as (server, root), tempfile.TemporaryDirectory() as outside:
+        client, client_socket, eof_token = connect(server)
+        make_tree('tree')
+        assert client.issue_ul('ul tree', client_socket, eof_token), 'ul of a directory failed'
+        assert same_tree('tree', os.path.join(root, 'tree')), 'ul of a directory'
+        shutil.rmtree('tree')
+        assert client.issue_dl('dl tree', client_socket, eof_token), 'dl of a directory failed'
+        assert same_tree(os.path.join(root, 'tree'), 'tree'), 'dl of a directory'
+        os.symlink('a.bin', os.path.join(root, 'tree', 'link'))
+        summary = client.issue_cp('cp -r tree copy', client_socket, eof_token)
+        assert summary['files'] == 3 and same_tree(os.path.join(root, 'tree'), os.path.join(root, 'copy')), summary
+        assert os.readlink(os.path.join(root, 'copy', 'link')) == 'a.bin', 'link not copied as a link'
+        os.symlink(outside, os.path.join(root, 'tree', 'sub', 'out'))
+        assert client.issue_cp('cp -r tree escape', client_socket, eof_token) is None, 'link outside copied'
+        assert not os.path.exists(os.path.join(root, 'escape')), 'failed copy left behind'
+        client.issue_mv('mv copy moved', client_socket, eof_token)
+        assert os.path.isdir(os.path.join(root, 'moved')) and not os.path.exists(os.path.join(root, 'copy')), 'mv'
+        disconnect(client, client_socket)
+
+
+
+def test_glob_regex():
+    """ Patterns match single names like fnmatchcase(), never across a '/' """
+    names = ['a.jpg', 'b.JPG', 'x', 'b', ']]', 'x]', '.hidden', 'x[1].txt', 'abc', 'a-c', 'a^c', 'a!c', 'a]c', 'a\\c',
+             'a&c', 'a|c', 'long.tar.gz', '']
+    patterns = ['*', '*.jpg', '?.jpg', 'a?c', '[ab]*', '[!a]*', '[a-c]bc', 'a[!-]c', 'a[]]c', 'a[^]c', 'a[!!]c',
+                'x[1].txt', 'x[[]1].txt', '[', 'a[', '*.tar.*', 'a\\c', '.*', '*c', 'a[&&]c', 'a[||~~]c',
+                '[!]]', 'a[!]]c', '[!]a]']
+    for pattern in patterns:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            regex = re.compile(glob_regex(pattern))
+        for name in names:
+            assert bool(regex.fullmatch(name)) == fnmatch.fnmatchcase(name, pattern), (pattern, name)
+        assert not regex.fullmatch('dir/' + pattern.replace('*', '').replace('?', 'x')), pattern
+    assert not re.fullmatch(glob_regex('a*c'), 'a/c') and not re.fullmatch(glob_regex('a?c'), 'a/c'), '/ matched'
+
+
+def test_tree_index():
+    """ find and du answer from an index kept current by the changes the server makes """
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root)
+        index = TreeIndex(root, frozenset([os.path.join(root, '.cas')]))
+        os.makedirs(os.path.join(root, '.cas'))
+        with open(os.path.join(root, '.cas', 'hidden.bin'), 'wb') as file:
+            file.write(b'hidden')
+        index.start()
+        assert index.ready.wait(10), 'index not built'
+        assert index.find(root, '*.bin') == ([['a.bin', 5000]], False), 'find'
+        assert index.find(root, '*e*') == ([['empty/', None], ['sub/deeper/', None]], False), 'find directories'
+        assert index.find(root, '*', limit=2)[1], 'find not truncated'
+        usage = index.du(root)
+        assert (usage['bytes'], usage['files'], usage['directories']) == (5001, 3, 3), usage
+        assert usage['entries'] == [['sub', 1], ['empty', 0]], usage
+        with open(os.path.join(root, 'sub', 'new.bin'), 'wb') as file:
+            file.write(b'x' * 10)
+        index.refresh(os.path.join(root, 'sub', 'new.bin'))
+        shutil.rmtree(os.path.join(root, 'sub', 'deeper'))
+        index.refresh(os.path.join(root, 'sub', 'deeper'))
+        assert index.find(root, '*.bin')[0] == [['a.bin', 5000], ['sub/new.bin', 10]], 'new file not indexed'
+        assert index.du(os.path.join(root, 'sub')) == {'bytes': 10, 'files': 2, 'directories': 0, 'entries': []}
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        make_tree('tree')
+        assert client.issue_ul('ul tree', client_socket, eof_token), 'ul of a directory failed'
+        client.issue_cd('cd tree', client_socket, eof_token)
+        assert client.issue_find('find c', client_socket, eof_token) == [['sub/deeper/c', 1]], 'find command'
+        assert client.issue_du('du sub', client_socket, eof_token)['files'] == 2, 'du command'
+        client.issue_rm('rm sub', client_socket, eof_token)
+        assert client.issue_find('find c', client_socket, eof_token) == [], 'index not updated by rm'
+        disconnect(client, client_socket)
+
+
+def test_rate_limits():
+    """ Token buckets hold a short burst then hold transfers to their rate, which changes while the server runs """
+    bucket = TokenBucket(1000000)
+    assert bucket.burst == 1000000 * SHAPING_BURST, 'burst size'
+    bucket.take(bucket.burst)
+    assert bucket.delay(time.monotonic()) == 0, 'burst delayed'
+    bucket.take(500000)
+    assert 0.4 < bucket.delay(time.monotonic()) <= 0.5, 'debt not delaying the next taker'
+    bucket.set_rate(None)
+    bucket.take(10 ** 9)
+    assert bucket.delay(time.monotonic()) == 0, 'unlimited bucket delayed'
+    assert TokenBucket(1000).burst == SHAPING_QUANTUM, 'burst smaller than a quantum'
+    with served_directory() as (server, root):
+        client, client_socket, eof_token = connect(server)
+        with open(os.path.join(root, 'file.bin'), 'wb') as file:
+            file.write(os.urandom(1500000))
+        limits = client.issue_stats('limit 1000000', client_socket, eof_token)
+        assert limits['session']['rate_limit'] == 1000000, 'session limit not applied'
+        started = time.monotonic()
+        assert client.issue_dl('dl file.bin', client_socket, eof_token), 'limited dl failed'
+        assert time.monotonic() - started >= 1, 'dl faster than the session limit'
+        limits = client.issue_stats('limit 0', client_socket, eof_token)
+        assert limits['session']['rate_limit'] is None, 'session limit not lifted'
+        try:
+            client.request('limit global 1000', client_socket)
+            raise AssertionError('server limit changed without --limit-control')
+        except ServerError:
+            pass
+        disconnect(client, client_socket)
+    with served_directory(shaper=TrafficShaper(session_rate=2000000), limit_control=True) as (server, root):
+        client, client_socket, eof_token = connect(server)
+        limits = client.issue_stats('limit 5000000', client_socket, eof_token)
+        assert limits['session']['rate_limit'] == 2000000, 'session limit above the server session rate'
+        limits = client.issue_stats('limit global 3000000', client_socket, eof_token)
+        assert limits['server']['global_rate'] == 3000000, 'global limit not applied'
+        disconnect(client, client_socket)
+
+
+
 if __name__ == '__main__':
 
     """ Starting Server """
     server_process = multiprocessing.Process(target=Server_main)
     server_process.start()
 
-    time.sleep(1)
     HOST = "127.0.0.1"
     PORT = 65432
+    # wait for the server to listen instead of sleeping a fixed time
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((HOST, PORT)).close()
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline, 'server did not start'
+            time.sleep(0.01)
 
     print('-'*8,'TESTING CLIENT','-'*8)
 
@@ -35,39 +825,54 @@ if __name__ == '__main__':
     """ Clear existing files """
     if os.path.exists('test_dir'):
         shutil.rmtree('test_dir')
-    time.sleep(0.5)
 
     """ Testing mkdir """
     sub_client.issue_mkdir(command_and_arg[0], sub_client_socket,eof_token)
-    time.sleep(0.5)
     assert os.path.exists(os.path.join(os.getcwd(),'test_dir')), 'mkdir failed'
 
     """ Testing cd """
     sub_client.issue_cd(command_and_arg[1], sub_client_socket,eof_token)
-    time.sleep(0.5)
 
 
     """ Testing ul """
     sub_client.issue_ul(command_and_arg[2], sub_client_socket,eof_token)
-    time.sleep(0.5)
     assert os.path.exists(os.path.join(os.getcwd(),'test_dir','jellyfish.jpg')) , 'ul failed'
     os.remove('jellyfish.jpg')
-    time.sleep(0.5)
 
     """ Testing dl """
     sub_client.issue_dl(command_and_arg[3], sub_client_socket,eof_token)
-    time.sleep(0.5)
     assert os.path.exists(os.path.join(os.getcwd(),'jellyfish.jpg')) , 'dl failed'
 
     """ Testing rm"""
     sub_client.issue_cd(command_and_arg[4],sub_client_socket,eof_token)
     sub_client.issue_rm(command_and_arg[5], sub_client_socket,eof_token)
     assert not os.path.exists(os.path.join(os.getcwd(),'test_dir')), 'rm failed'
-    time.sleep(0.5)
 
     print('*'*8,' CLIENT COMPLETE ','*'*8)
     sub_client_socket.close()
     server_process.terminate()
     del sub_client,sub_client_socket
 
+    """ Testing the features """
+    test_benchmark()
+    test_streamed_transfer()
+    test_async_engine()
+    test_session_directories()
+    test_listing_cache()
+    test_batch()
+    test_parallel_transfer()
+    test_resumable_transfers()
+    test_deduplication()
+    test_compression()
+    test_delta_sync()
+    test_stats()
+    test_workers()
+    test_admission()
+    test_file_cache()
+    test_async_client()
+    test_archives()
+    test_glob_regex()
+    test_tree_index()
+    test_rate_limits()
+
     print('Script completed gracefully!')
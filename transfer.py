@@ -0,0 +1,679 @@
+"""
+Code shared by the client and the server: everything both ends of a transfer must do the same way, from the framing
+limits and the compression of the content to the writers the received content goes through.
+"""
+import hashlib
+import math
+import mmap
+import os
+import stat
+import struct
+import tarfile
+import time
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # optional compression codec
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # optional compression codec
+    lz4 = None
+
+# Raised by the codecs on corrupt data (lz4 raises RuntimeError), reported as ValueError by StreamCodec
+CODEC_ERRORS = (zlib.error, RuntimeError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+TRANSFER_CHUNK_SIZE = 1 << 20  # payload size of each OP_DATA frame of a file transfer
+# Commands streaming file content: shaped by the server as bulk traffic, the other commands are interactive. A client
+# cannot batch them.
+BULK_COMMANDS = frozenset(["dl", "ul", "ulrange", "patch", "delta"])
+
+# Transfer compression, in order of preference. The codec is negotiated in the handshake, then every transfer decides
+# on its own whether compressing is worth it.
+COMPRESSION_CODECS = tuple(name for name, module in (("zstd", zstandard), ("lz4", lz4), ("zlib", zlib)) if module)
+COMPRESSED_EXTENSIONS = frozenset([
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".m4a", ".ogg", ".avi", ".mkv", ".mov", ".zip", ".gz",
+    ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar", ".jar", ".docx", ".xlsx", ".pptx",
+])
+TEXT_EXTENSIONS = frozenset([
+    ".txt", ".pdf", ".csv", ".json", ".xml", ".html", ".htm", ".md", ".log", ".py", ".js", ".css", ".svg", ".sql",
+])
+ENTROPY_SAMPLE_SIZE = 16384  # bytes sampled from the first chunk of files of unknown type
+ENTROPY_THRESHOLD = 7.2  # bits per byte above which the sample is considered already compressed
+
+# Delta sync (sync command). Files are cut in blocks, each described by a weak rolling checksum (adler32) and a strong
+# digest. The sender of the new version finds the blocks the receiver already has, at any offset, and only sends the
+# rest as literal bytes.
+SYNC_MIN_BLOCK_SIZE = 2048
+SYNC_MAX_BLOCK_SIZE = 1 << 17
+SYNC_ROLLING_LIMIT = 1 << 18  # bytes searched one by one after a mismatch before only trying whole blocks
+SIGNATURE_HEADER = struct.Struct("!IQ")  # block size, size of the file
+SIGNATURE = struct.Struct("!I16s")  # adler32 and blake2b digest of a block
+DELTA_COPY = struct.Struct("!cQI")  # b"C", first block of the base file, number of consecutive blocks
+DELTA_DATA = struct.Struct("!cI")  # b"D", number of literal bytes following the record
+
+# Directories are transferred as tar archives, generated and extracted as they are streamed
+ARCHIVE_SENDFILE_MIN = 64 << 10  # files at least this large are sent apart in a directory archive, with sendfile()
+ARCHIVE_MAX_HEADER = 1 << 20  # bytes of extended (pax / long name) header accepted in an archive
+
+
+class OffsetWriter:
+    """
+    File-like writer for the received content (receive_stream() / receive_reply()) that writes at increasing offsets
+    of a descriptor with pwrite(), without moving a shared file position. Writing past `limit` is refused.
+    """
+
+    def __init__(self, fd, offset, limit):
+        self.fd = fd
+        self.offset = offset
+        self.limit = limit
+
+    def write(self, data):
+        if self.offset + len(data) > self.limit:
+            raise ValueError("more data than announced")
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+        return len(data)
+
+
+class HashingWriter:
+    """File-like writer for the received content feeding everything written to a hash object on the way."""
+
+    def __init__(self, file, hasher=None):
+        self.file = file
+        self.hasher = hasher
+
+    def write(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return self.file.write(data)
+
+
+class StreamCodec:
+    """
+    Compresses or decompresses one transfer chunk by chunk with a negotiated codec. zlib keeps a single stream for the
+    whole transfer, flushed at the end of every chunk so each OP_DATA frame can be decompressed as soon as it arrives;
+    zstd and lz4 compress every chunk as an independent frame. A chunk decompressing to more than TRANSFER_CHUNK_SIZE
+    bytes, or that cannot be decompressed, raises ValueError.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data):
+        if self.name == "zlib":
+            if self.compressor is None:
+                self.compressor = zlib.compressobj(1)
+            return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.name == "zstd":
+            if self.compressor is None:
+                self.compressor = zstandard.ZstdCompressor(level=3)
+            return self.compressor.compress(data)
+        if self.name == "lz4":
+            return lz4.frame.compress(data)
+        raise ValueError(f"unknown compression codec: {self.name}")
+
+    def decompress(self, data):
+        try:
+            if self.name == "zlib":
+                if self.decompressor is None:
+                    self.decompressor = zlib.decompressobj()
+                data = self.decompressor.decompress(data, TRANSFER_CHUNK_SIZE)
+                if self.decompressor.unconsumed_tail:
+                    raise ValueError("compressed chunk larger than a transfer chunk")
+                return data
+            if self.name == "zstd":
+                if self.decompressor is None:
+                    self.decompressor = zstandard.ZstdDecompressor()
+                # max_output_size only bounds the frames that do not declare their size
+                if zstandard.frame_content_size(data) > TRANSFER_CHUNK_SIZE:
+                    raise ValueError("compressed chunk larger than a transfer chunk")
+                return self.decompressor.decompress(data, max_output_size=TRANSFER_CHUNK_SIZE)
+            if self.name == "lz4":
+                decompressor = lz4.frame.LZ4FrameDecompressor()
+                # One byte more than allowed tells a chunk too large from one of exactly a transfer chunk
+                data = decompressor.decompress(data, max_length=TRANSFER_CHUNK_SIZE + 1)
+                if len(data) > TRANSFER_CHUNK_SIZE:
+                    raise ValueError("compressed chunk larger than a transfer chunk")
+                if not decompressor.eof:
+                    raise ValueError("truncated compressed chunk")
+                return data
+        except CODEC_ERRORS as error:
+            raise ValueError(f"corrupt compressed chunk: {error}") from error
+        raise ValueError(f"unknown compression codec: {self.name}")
+
+
+class TransferStats:
+    """
+    Counters of one file transfer: the bytes of content, the bytes that went over the wire and the CPU time spent
+    compressing or decompressing them.
+    """
+
+    __slots__ = ("codec", "raw_bytes", "wire_bytes", "cpu_time", "started")
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+        self.started = time.monotonic()
+
+    def add(self, raw_bytes, wire_bytes):
+        self.raw_bytes += raw_bytes
+        self.wire_bytes += wire_bytes
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def as_dict(self):
+        return {"codec": self.codec, "raw_bytes": self.raw_bytes, "wire_bytes": self.wire_bytes,
+                "ratio": round(self.ratio, 3), "cpu_time": round(self.cpu_time, 6),
+                "elapsed": round(time.monotonic() - self.started, 6)}
+
+    def __str__(self):
+        return (f"{self.raw_bytes} bytes, {self.wire_bytes} on the wire ({self.codec or 'uncompressed'}, "
+                f"ratio {self.ratio:.2f}, {self.cpu_time * 1000:.1f} ms CPU)")
+
+
+def choose_compression(file_name, fd, codec, buffer, offset=0, sample=None):
+    """
+    Decides whether a transfer is worth compressing. Already compressed formats never are, text and PDF files always
+    are; anything else is compressed unless a sample of its first chunk looks random.
+    :param file_name: name of the file, for its extension
+    :param fd: descriptor of the file, read with pread() so the file position is left alone
+    :param codec: the codec negotiated for the session, or None
+    :param buffer: reusable bytearray the sample is read into
+    :param offset: position the transfer starts from
+    :param sample: the first bytes of the transfer when the file is already in memory, fd and buffer are then unused
+    :return: the codec to use, or None to send the file as is
+    """
+    if codec is None:
+        return None
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return None
+    if extension in TEXT_EXTENSIONS:
+        return codec
+    if sample is None:
+        view = memoryview(buffer)[:ENTROPY_SAMPLE_SIZE]
+        sample = view[:os.preadv(fd, [view], offset)]
+    return codec if len(sample) and sample_entropy(sample) < ENTROPY_THRESHOLD else None
+
+
+def sample_entropy(sample):
+    """
+    Shannon entropy of a sample of bytes.
+    :param sample: bytes-like object
+    :return: bits per byte, from 0 to 8
+    """
+    counts = Counter(bytes(sample))
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in counts.values())
+
+
+def hash_file(fd, hasher, buffer, length=None):
+    """
+    Feeds the content of a file to a hash object in chunks, with pread() so the file position is left alone.
+    :param fd: descriptor of the file
+    :param hasher: a hashlib object
+    :param buffer: reusable bytearray the file is read into
+    :param length: number of bytes to hash from the start of the file, defaults to the whole file
+    :return: the hash object
+    """
+    view = memoryview(buffer)
+    if length is None:
+        length = os.fstat(fd).st_size
+    offset = 0
+    while offset < length:
+        size = min(len(view), length - offset)
+        if hasattr(os, "preadv"):
+            count = os.preadv(fd, [view[:size]], offset)
+            chunk = view[:count]
+        else:
+            chunk = os.pread(fd, size, offset)
+            count = len(chunk)
+        if count == 0:
+            break
+        hasher.update(chunk)
+        offset += count
+    return hasher
+
+
+def preallocate(fd, size):
+    """
+    Reserves the disk space of a file about to be written out of order, growing it to `size` bytes.
+    :param fd: descriptor of the file
+    :param size: final size of the file
+    """
+    if os.fstat(fd).st_size >= size:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # not supported by the filesystem
+    os.ftruncate(fd, size)
+
+
+class DeltaWriter:
+    """
+    File-like writer for receive_stream() rebuilding a file from a stream of delta records: DELTA_COPY records are
+    copied from the base file, DELTA_DATA records carry the literal bytes. Records may be split across writes.
+    """
+
+    def __init__(self, base_fd, block_size, file):
+        self.base_fd = base_fd
+        self.base_size = os.fstat(base_fd).st_size if base_fd is not None else 0
+        self.block_size = block_size
+        self.file = file
+        self.pending = bytearray()
+        self.literal = 0  # literal bytes of the current DELTA_DATA record still to come
+        self.size = 0
+
+    def write(self, data):
+        pending = self.pending
+        pending += data
+        position = 0
+        while position < len(pending):
+            if self.literal:
+                count = min(self.literal, len(pending) - position)
+                self.file.write(pending[position:position + count])
+                self.literal -= count
+                self.size += count
+                position += count
+            elif pending[position] == ord("C"):
+                if len(pending) - position < DELTA_COPY.size:
+                    break
+                _, first, count = DELTA_COPY.unpack_from(pending, position)
+                self.copy(first * self.block_size, count * self.block_size)
+                position += DELTA_COPY.size
+            elif pending[position] == ord("D"):
+                if len(pending) - position < DELTA_DATA.size:
+                    break
+                _, self.literal = DELTA_DATA.unpack_from(pending, position)
+                position += DELTA_DATA.size
+            else:
+                raise ValueError("invalid delta record")
+        del pending[:position]
+        return len(data)
+
+    def copy(self, offset, length):
+        if self.base_fd is None:
+            raise ValueError("delta refers to a missing base file")
+        if offset + length - self.block_size >= self.base_size:
+            raise ValueError("delta refers past the end of the base file")
+        # The last block of the base file may be short
+        length = min(length, self.base_size - offset)
+        while length:
+            data = os.pread(self.base_fd, min(length, TRANSFER_CHUNK_SIZE), offset)
+            if not data:
+                raise ValueError("delta refers past the end of the base file")
+            self.file.write(data)
+            self.size += len(data)
+            offset += len(data)
+            length -= len(data)
+
+    def close(self):
+        if self.pending or self.literal:
+            raise ValueError("truncated delta")
+
+
+def file_signatures(fd):
+    """
+    Describes the blocks of a file for compute_delta(). The block size grows with the square root of the file size.
+    :param fd: descriptor of the file, read with pread()
+    :return: bytes: a SIGNATURE_HEADER followed by one SIGNATURE per block
+    """
+    size = os.fstat(fd).st_size
+    block_size = min(max(int(math.sqrt(size)) & ~1023, SYNC_MIN_BLOCK_SIZE), SYNC_MAX_BLOCK_SIZE)
+    signatures = bytearray(SIGNATURE_HEADER.pack(block_size, size))
+    offset = 0
+    while offset < size:
+        block = os.pread(fd, block_size, offset)
+        if not block:
+            break
+        signatures += SIGNATURE.pack(zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest())
+        offset += len(block)
+    return bytes(signatures)
+
+
+def compute_delta(fd, signatures=None):
+    """
+    Generates the delta records rebuilding the file open at `fd` from the base file the signatures describe. The
+    adler32 of the window is rolled one byte at a time, so blocks are found again after insertions and deletions;
+    after SYNC_ROLLING_LIMIT bytes without a match only block aligned positions are tried, which keeps rewritten files
+    cheap. The file is mapped in memory rather than read.
+    :param fd: descriptor of the new version of the file
+    :param signatures: output of file_signatures() for the base file, None when there is no base file
+    :return: iterator of bytes records, DELTA_COPY or DELTA_DATA followed by its literal bytes
+    """
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return
+    blocks = {}
+    block_size = tail = None
+    if signatures:
+        block_size, base_size = SIGNATURE_HEADER.unpack_from(signatures)
+        count = (len(signatures) - SIGNATURE_HEADER.size) // SIGNATURE.size
+        for index in range(count):
+            weak, strong = SIGNATURE.unpack_from(signatures, SIGNATURE_HEADER.size + index * SIGNATURE.size)
+            if index == count - 1 and base_size % block_size:
+                tail = (weak, strong, index, base_size % block_size)
+            else:
+                blocks.setdefault(weak, {}).setdefault(strong, index)
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as view:
+        position = literal_start = 0
+        copy_first = copy_count = 0
+        weak = None
+        rolling = True
+        missed = 0
+        while blocks and position + block_size <= size:
+            if weak is None:
+                weak = zlib.adler32(view[position:position + block_size])
+            candidates = blocks.get(weak)
+            if candidates is not None:
+                index = candidates.get(hashlib.blake2b(view[position:position + block_size], digest_size=16).digest())
+                if index is not None:
+                    if literal_start < position or index != copy_first + copy_count:
+                        if copy_count:
+                            yield DELTA_COPY.pack(b"C", copy_first, copy_count)
+                        yield from literal_records(view, literal_start, position)
+                        copy_first, copy_count = index, 0
+                    copy_count += 1
+                    position += block_size
+                    literal_start = position
+                    weak = None
+                    rolling = True
+                    missed = 0
+                    continue
+            if position + block_size == size:
+                break
+            if not rolling:
+                position += min(block_size, size - block_size - position)
+                weak = None
+                continue
+            # Slide the window by one byte: adler32 is a = 1 + sum(x), b = sum of the successive a
+            removed, added = view[position], view[position + block_size]
+            a = ((weak & 0xffff) - removed + added) % 65521
+            b = ((weak >> 16) - block_size * removed + a - 1) % 65521
+            weak = b << 16 | a
+            position += 1
+            missed += 1
+            rolling = missed < SYNC_ROLLING_LIMIT
+        if tail is not None and size - position == tail[3]:
+            block = view[position:size]
+            if zlib.adler32(block) == tail[0] and hashlib.blake2b(block, digest_size=16).digest() == tail[1]:
+                if literal_start < position or tail[2] != copy_first + copy_count:
+                    if copy_count:
+                        yield DELTA_COPY.pack(b"C", copy_first, copy_count)
+                    yield from literal_records(view, literal_start, position)
+                    copy_first, copy_count = tail[2], 0
+                copy_count += 1
+                literal_start = size
+        if copy_count:
+            yield DELTA_COPY.pack(b"C", copy_first, copy_count)
+        yield from literal_records(view, literal_start, size)
+
+
+def literal_records(view, start, end):
+    """
+    DELTA_DATA records carrying view[start:end], each fitting in a transfer chunk.
+    """
+    step = TRANSFER_CHUNK_SIZE - DELTA_DATA.size
+    for offset in range(start, end, step):
+        data = view[offset:min(offset + step, end)]
+        yield DELTA_DATA.pack(b"D", len(data)) + data
+
+
+class TarExtractor:
+    """
+    File-like writer for receive_stream() extracting a tar archive (see iter_archive()) below a directory as it
+    arrives: headers may be split across writes and the content of each file is written to its final path straight
+    away. Only directories and regular files are extracted, with their mode and mtime; links and special files are
+    skipped, as are pax global headers. Names leaving the directory, by name or through a symbolic link already on
+    disk, or reaching the hidden paths are refused.
+    An error stops the extraction but not the reading: the rest of the archive is dropped so the stream can be read
+    to its end, and close() raises it.
+    """
+
+    def __init__(self, root, hidden_paths=frozenset()):
+        self.root = os.path.abspath(root)
+        self.hidden_paths = hidden_paths
+        os.makedirs(self.root, exist_ok=True)
+        self.resolved_root = os.path.realpath(self.root)
+        self.header = bytearray()  # 512 bytes block of the next member, as it arrives
+        self.remaining = 0  # bytes of content of the current member still to come
+        self.padding = 0  # bytes padding the current member to a whole block
+        self.file = None  # file the content of the current member is written to
+        self.path = None
+        self.mtime = None
+        self.extended = None  # bytearray collecting the content of an extended header
+        self.extended_type = None
+        self.pax = {}  # pax extended header fields applying to the next member
+        self.long_name = None  # GNU long name applying to the next member
+        self.finished = False  # the end of archive block was seen
+        self.error = None
+        self.files = 0
+        self.directories = 0
+
+    def write(self, data):
+        if self.error is None and not self.finished:
+            try:
+                self.extract(memoryview(data))
+            except (OSError, ValueError, tarfile.TarError) as error:
+                self.error = error
+                self.discard()
+        return len(data)
+
+    def extract(self, view):
+        while view and not self.finished:
+            if self.remaining:
+                chunk = view[:self.remaining]
+                if self.file is not None:
+                    self.file.write(chunk)
+                elif self.extended is not None:
+                    self.extended += chunk
+                self.remaining -= len(chunk)
+                view = view[len(chunk):]
+                if not self.remaining:
+                    self.end_member()
+            elif self.padding:
+                count = min(self.padding, len(view))
+                self.padding -= count
+                view = view[count:]
+            else:
+                count = tarfile.BLOCKSIZE - len(self.header)
+                self.header += view[:count]
+                view = view[count:]
+                if len(self.header) == tarfile.BLOCKSIZE:
+                    block = bytes(self.header)
+                    self.header.clear()
+                    self.start_member(block)
+
+    def start_member(self, block):
+        if block == tarfile.NUL * tarfile.BLOCKSIZE:
+            self.finished = True
+            return
+        info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        size = info.size
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK):
+            if size > ARCHIVE_MAX_HEADER:
+                raise ValueError("archive extended header too large")
+            self.extended = bytearray()
+            self.extended_type = info.type
+        else:
+            name = self.pax.get("path") or self.long_name or info.name
+            size = int(self.pax.get("size", size))
+            self.mtime = float(self.pax.get("mtime", info.mtime))
+            self.pax = {}
+            self.long_name = None
+            path = self.target(name)
+            if info.type == tarfile.DIRTYPE:
+                os.makedirs(path, exist_ok=True)
+                os.chmod(path, stat.S_IMODE(info.mode) | stat.S_IRWXU)
+                os.utime(path, (self.mtime, self.mtime))
+                self.directories += 1
+            elif info.type in (tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.CONTTYPE) and path != self.root:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write a new inode rather than truncating: the old file may be hardlinked into the content store
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self.path = path
+                self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                              stat.S_IMODE(info.mode) | stat.S_IRUSR | stat.S_IWUSR), "wb")
+        self.remaining = size
+        self.padding = -size % tarfile.BLOCKSIZE
+        if not size:
+            self.end_member()
+
+    def end_member(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.utime(self.path, (self.mtime, self.mtime))
+            self.files += 1
+        elif self.extended is not None:
+            extended, self.extended = bytes(self.extended), None
+            if self.extended_type == tarfile.XHDTYPE:
+                self.pax.update(parse_pax_records(extended))
+            elif self.extended_type == tarfile.GNUTYPE_LONGNAME:
+                self.long_name = extended.rstrip(tarfile.NUL).decode("utf-8", "surrogateescape")
+
+    def target(self, name):
+        """
+        :param name: name of a member of the archive
+        :return: absolute path to extract it to
+        """
+        parts = [part for part in name.split("/") if part not in ("", ".")]
+        if name.startswith("/") or ".." in parts:
+            raise ValueError(f"{name}: unsafe path in the archive")
+        path = os.path.join(self.root, *parts)
+        resolved = os.path.realpath(path)
+        if os.path.commonpath([resolved, self.resolved_root]) != self.resolved_root:
+            raise PermissionError(f"{name}: leaves the directory through a symbolic link")
+        if any(os.path.commonpath([checked, hidden]) == hidden for checked in (path, resolved)
+               for hidden in self.hidden_paths):
+            raise PermissionError(f"{name}: reserved by the server")
+        return path
+
+    def discard(self):
+        """Closes the file being extracted, if any."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        """
+        :raises: the error that stopped the extraction, ValueError when the archive was truncated
+        """
+        self.discard()
+        if self.error is not None:
+            raise self.error
+        if not self.finished:
+            raise ValueError("truncated archive")
+
+
+def iter_archive(root, hidden_paths=frozenset()):
+    """
+    Generates the tar archive (POSIX pax format) of a directory tree as it is walked, for dl / ul of a directory. Only
+    the directories and the regular files are archived, with their mode and mtime; partial transfers (*.part), links
+    and the hidden paths are left out.
+    :param root: absolute path of the directory
+    :param hidden_paths: absolute paths to skip
+    :return: iterator over the pieces of the archive: bytes (headers and padding), and (name, file, size) tuples for
+        the content of the files, the file being open until the next piece is requested
+    """
+    for current, subdirectories, file_names in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories if os.path.join(current, name) not in hidden_paths)
+        relative = os.path.relpath(current, root)
+        prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+        if prefix:
+            yield tar_header(prefix, tarfile.DIRTYPE, os.stat(current))
+        for file_name in sorted(file_names):
+            if file_name.endswith(".part"):
+                continue
+            path = os.path.join(current, file_name)
+            try:
+                if not stat.S_ISREG(os.lstat(path).st_mode):
+                    continue
+                file = os.fdopen(os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0)), "rb")
+            except OSError:
+                continue  # removed, or replaced by a link, since listed
+            with file:
+                file_stats = os.fstat(file.fileno())
+                yield tar_header(prefix + file_name, tarfile.REGTYPE, file_stats)
+                yield file_name, file, file_stats.st_size
+                if file_stats.st_size % tarfile.BLOCKSIZE:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - file_stats.st_size % tarfile.BLOCKSIZE)
+    # End of archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def tar_header(name, member_type, file_stats):
+    """
+    :param name: name of the member, relative with '/' as separator
+    :param member_type: tarfile.DIRTYPE or tarfile.REGTYPE
+    :param file_stats: os.stat_result of the file or directory
+    :return: the header block(s) of the member
+    """
+    info = tarfile.TarInfo(name)
+    info.type = member_type
+    info.mode = stat.S_IMODE(file_stats.st_mode)
+    info.mtime = int(file_stats.st_mtime)
+    info.size = file_stats.st_size if member_type == tarfile.REGTYPE else 0
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def parse_pax_records(data):
+    """
+    :param data: content of a pax extended header: '<length> <key>=<value>\\n' records
+    :return: dict of the fields
+    """
+    fields = {}
+    position = 0
+    while position < len(data):
+        length_text, separator, _ = data[position:position + 32].partition(b" ")
+        if not separator or not length_text.isdigit() or int(length_text) <= len(length_text) + 1:
+            raise ValueError("invalid pax header")
+        record = data[position + len(length_text) + 1:position + int(length_text)]
+        key, _, value = record.rstrip(b"\n").partition(b"=")
+        fields[key.decode("utf-8", "surrogateescape")] = value.decode("utf-8", "surrogateescape")
+        position += int(length_text)
+    return fields
+
+
+def walk_tree(root, hidden_paths=frozenset()):
+    """
+    Lists a directory tree for the sync command. Partial transfers (*.part) and the hidden paths are left out.
+    :param root: absolute path of the directory
+    :param hidden_paths: absolute paths to skip
+    :return: (files, directories): {relative path: [size, mtime_ns]} and the sorted list of the sub directories, the
+    relative paths using '/' as separator.
+    """
+    files = {}
+    directories = []
+    for current, subdirectories, file_names in os.walk(root):
+        subdirectories[:] = [name for name in subdirectories if os.path.join(current, name) not in hidden_paths]
+        relative = os.path.relpath(current, root)
+        prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+        if prefix:
+            directories.append(prefix[:-1])
+        for file_name in file_names:
+            if file_name.endswith(".part"):
+                continue
+            file_stats = os.stat(os.path.join(current, file_name), follow_symlinks=False)
+            if stat.S_ISREG(file_stats.st_mode):
+                files[prefix + file_name] = [file_stats.st_size, file_stats.st_mtime_ns]
+    return files, sorted(directories)